@@ -1,9 +1,19 @@
-import bioimageio.core
 import napari.resources
-import numpy as np
 from napari._qt.qt_resources import get_stylesheet
 from napari.utils.notifications import show_error as notify_error
-from napari_bioimageio import show_model_selector, show_model_manager, load_model_by_id
+from napari_bioimageio import (
+    StageCache,
+    StageGraph,
+    assemble_channels,
+    cached_prediction,
+    measure_labels,
+    predict_tiled,
+    remove_labels,
+    run_inference,
+    show_model_selector,
+    show_model_manager,
+    use_pipeline,
+)
 from qtpy.QtWidgets import (
     QComboBox,
     QDialog,
@@ -15,7 +25,6 @@ from qtpy.QtWidgets import (
 from skimage.measure import label
 from skimage.segmentation import watershed
 from skimage.transform import rescale
-from xarray import DataArray
 
 nuclear_segmentation_model_filter = "10.5281/zenodo.6200999"
 cell_segmentation_model_filter = "10.5281/zenodo.6200635"
@@ -36,6 +45,9 @@ class QTHPASegmentation(QDialog):
         self.nucseg_id = "None"
         self.celseg_model_source = ""
         self.celseg_id = "None"
+        self.job = None
+        # intermediate results of the last runs, so that a run only recomputes what its changes affect
+        self.stage_cache = StageCache()
 
         self.setup_ui()
 
@@ -156,10 +168,18 @@ class QTHPASegmentation(QDialog):
         runBox.setContentsMargins(10, 20, 10, 10)
         self.layout.addLayout(runBox)
 
+        self.run_status = QLabel("")
+        self.run_status.setContentsMargins(10, 0, 10, 0)
+        self.layout.addWidget(self.run_status)
+
         self.layout.addStretch()
         self.setLayout(self.layout)
 
     def run_model(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.run_status.setText("Cancelling...")
+            return
         if self.cb_1.currentText() == "None":
             notify_error("Please select a valid Nucleus image layer")
             return
@@ -185,75 +205,62 @@ class QTHPASegmentation(QDialog):
             ]
         ]
 
-        cell_segmentation = None
-
-        run_nucleus_model = load_model_by_id(
-            self.nucseg_id + '/' + self.nucseg_version
-        )
-        run_cell_model = load_model_by_id(
-            self.celseg_id + '/' + self.celseg_version
-        )
+        nucleus_model_id = self.nucseg_id + '/' + self.nucseg_version
+        cell_model_id = self.celseg_id + '/' + self.celseg_version
 
-        axes = run_cell_model.inputs[0].axes
-        channels = ["red", "blue", "green"]
-        padding = {"x": 32, "y": 32}
         scale_factor = 1
 
-        def load_image(channels, scale_factor=None):
-            image = []
-            for chan in channels:
-                np_img_chan = []
-                if chan == "red":
-                    np_img_chan = self._viewer.layers[self.cb_2.currentText()].data
-                elif chan == "blue":
-                    np_img_chan = self._viewer.layers[self.cb_1.currentText()].data
-                if chan == "green":
-                    np_img_chan = self._viewer.layers[self.cb_3.currentText()].data
-                if scale_factor is not None:
-                    np_img_chan = rescale(np_img_chan, scale_factor)
-                image.append(np_img_chan[None])
-            image = np.concatenate(image, axis=0)
-
-            return image
-
-        def _segment(pp_cell, pp_nucleus):
-            image = load_image(channels, scale_factor=scale_factor)
-            print(np.shape(image))
-            print(np.shape(image[1:2]))
-            # run prediction with the nucleus model
-            input_nucleus = DataArray(
-                np.concatenate([image[1:2], image[1:2], image[1:2]], axis=0)[None],
-                dims=axes,
-            )
-            nuclei_pred = bioimageio.core.prediction.predict_with_padding(
-                pp_nucleus, input_nucleus, padding=padding
-            )[0].values[0]
-
+        # the layers are read here, in the GUI thread, and processed in a background thread
+        layer_data = {
+            "red": self._viewer.layers[self.cb_2.currentText()].data,
+            "blue": self._viewer.layers[self.cb_1.currentText()].data,
+            "green": self._viewer.layers[self.cb_3.currentText()].data,
+        }
+
+        def predict_cached(model_id, input_, progress, cancel):
+            # a run on the same input returns the cached prediction without loading the model
+            def run():
+                # the pipeline stays loaded after the run, so running again only costs the prediction
+                with use_pipeline(model_id) as pp:
+                    return predict_tiled(
+                        pp,
+                        input_,
+                        progress=progress,
+                        cancel=cancel,
+                    )
+
+            return cached_prediction(model_id, [input_], run)
+
+        def nucleus_prediction(blue, progress, cancel):
+            # the blue channel is converted once, the three channels are views of it
+            input_nucleus = assemble_channels([blue] * 3, scale_factor=scale_factor, preserve_range=False)
+            return predict_cached(nucleus_model_id, input_nucleus, progress, cancel)[0]
+
+        def cell_prediction(red, blue, green, progress, cancel):
+            input_cell = assemble_channels([red, blue, green], scale_factor=scale_factor, preserve_range=False)
+            return predict_cached(cell_model_id, input_cell, progress, cancel)[0]
+
+        def seeds(nuclei_pred, progress, cancel):
             # segment the nuclei in order to use them as seeds for the cell segmentation
             threshold = 0.5
             min_size = 250
             fg = nuclei_pred[-1]
             nuclei = label(fg > threshold)
-            ids, sizes = np.unique(nuclei, return_counts=True)
+            table = measure_labels(nuclei)
             # don't apply size filter on the border
-            border = np.ones_like(nuclei).astype("bool")
-            border[1:-1, 1:-1] = 0
-            filter_ids = ids[sizes < min_size]
-            border_ids = nuclei[border]
-            filter_ids = np.setdiff1d(filter_ids, border_ids)
-            nuclei[np.isin(nuclei, filter_ids)] = 0
-
-            # run prediction with the cell segmentation model
-            input_cells = DataArray(image[None], dims=axes)
-            cell_pred = bioimageio.core.prediction.predict_with_padding(
-                pp_cell, input_cells, padding=padding
-            )[0].values[0]
+            remove_labels(nuclei, table.labels[(table.sizes < min_size) & ~table.border])
+            return nuclei
+
+        def cell_watershed(cell_pred, nuclei, progress, cancel):
             # segment the cells
+            progress(0, 1)
             threshold = 0.5
             fg, bd = cell_pred[2], cell_pred[1]
             cell_seg = watershed(bd, markers=nuclei, mask=fg > threshold)
 
             # bring back to the orignial scale
+            if scale_factor == 1:
+                return cell_seg
             cell_seg = rescale(
                 cell_seg,
                 1.0 / scale_factor,
@@ -263,17 +270,49 @@ class QTHPASegmentation(QDialog):
             ).astype(cell_seg.dtype)
             return cell_seg
 
-        with bioimageio.core.create_prediction_pipeline(
-            bioimageio_model=run_cell_model
-        ) as pp_cell:
-            with bioimageio.core.create_prediction_pipeline(
-                bioimageio_model=run_nucleus_model
-            ) as pp_nucleus:
-                cell_segmentation = _segment(pp_cell, pp_nucleus)
+        # each stage only depends on the layers it reads: changing a layer only recomputes the stages it affects;
+        # the two models do not depend on each other, they run concurrently and the watershed waits for both
+        stages = StageGraph(self.stage_cache)
+        for chan, np_img_chan in layer_data.items():
+            stages.add_input(chan, np_img_chan)
+        prediction_key = {"scale_factor": scale_factor}
+        stages.add(
+            "nucleus prediction",
+            nucleus_prediction,
+            ["blue"],
+            label="Nucleus segmentation",
+            key={"model": nucleus_model_id, **prediction_key},
+        )
+        stages.add(
+            "cell prediction",
+            cell_prediction,
+            ["red", "blue", "green"],
+            label="Cell segmentation",
+            key={"model": cell_model_id, **prediction_key},
+        )
+        stages.add("seeds", seeds, ["nucleus prediction"], label="Nucleus seeds")
+        stages.add("segmentation", cell_watershed, ["cell prediction", "seeds"], label="Watershed", key=prediction_key)
 
+        def segment(progress, cancel):
+            return stages.run(["segmentation"], progress=progress, cancel=cancel)["segmentation"]
 
         def visualize(segmentation):
             v = self._viewer
-            v.add_labels(segmentation)
-
-        visualize(cell_segmentation)
+            # the stage cache keeps the segmentation, napari edits the layer data in place
+            v.add_labels(segmentation.copy())
+            self.run_status.setText("")
+
+        def finished():
+            self.job = None
+            self.run_btn.setText("Run")
+
+        # the models run in a background thread so that napari stays responsive
+        self.job = run_inference(
+            segment,
+            on_result=visualize,
+            on_progress=lambda stage, done, total: self.run_status.setText(f"{stage}: {done}/{total}"),
+            on_error=lambda excep: self.run_status.setText("Failed, please check logs!"),
+            on_cancelled=lambda: self.run_status.setText("Cancelled"),
+            on_finished=finished,
+        )
+        self.run_btn.setText("Cancel")
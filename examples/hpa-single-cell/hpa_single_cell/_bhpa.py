@@ -1,14 +1,27 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import bioimageio.core
 import napari
 import napari.resources
 import numpy as np
 from napari._qt.qt_resources import QColoredSVGIcon, get_stylesheet
 from napari.utils.notifications import show_error as notify_error
 from napari.utils.notifications import show_info
-from napari_bioimageio import show_model_selector, show_model_manager, load_model_by_id
+from napari_bioimageio import (
+    PredictionCancelled,
+    StageCache,
+    StageGraph,
+    assemble_channels,
+    cached_prediction,
+    measure_labels,
+    predict_tiled,
+    remove_labels,
+    run_inference,
+    show_model_selector,
+    show_model_manager,
+    use_pipeline,
+)
 from qtpy.QtCore import QObject, Qt
 from qtpy.QtGui import QFont, QMovie
 from qtpy.QtWidgets import (
@@ -20,11 +33,13 @@ from qtpy.QtWidgets import (
     QVBoxLayout,
     QWidget,
 )
-from skimage.measure import label, regionprops
+from skimage.measure import label
 from skimage.segmentation import watershed
-from skimage.transform import rescale, resize
+from skimage.transform import rescale
 from xarray import DataArray
 
+from ._crops import crop_cells
+
 HPA_CLASSES = {
     "Nucleoplasm": 0,
     "Nuclear membrane": 1,
@@ -83,6 +98,10 @@ classification_model_filter = "10.5281/zenodo.5910854"
 custom_style = get_stylesheet("dark")
 
 
+# memory the crops of the cells classified at once may use, bounding the classification batch size
+CLASSIFICATION_MEMORY = 256 << 20
+
+
 class QTHPASingleCell(QDialog):
     def __init__(self, viewer: "napari.viewer.Viewer"):
         super().__init__()
@@ -98,6 +117,9 @@ class QTHPASingleCell(QDialog):
         self.celseg_id = "None"
         self.classi_model_source = ""
         self.classi_id = "None"
+        self.job = None
+        # intermediate results of the last runs, so that a run only recomputes what its changes affect
+        self.stage_cache = StageCache()
 
         self.setup_ui()
 
@@ -253,10 +275,18 @@ class QTHPASingleCell(QDialog):
         runBox.setContentsMargins(10, 20, 10, 10)
         self.layout.addLayout(runBox)
 
+        self.run_status = QLabel("")
+        self.run_status.setContentsMargins(10, 0, 10, 0)
+        self.layout.addWidget(self.run_status)
+
         self.layout.addStretch()
         self.setLayout(self.layout)
 
     def run_model(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.run_status.setText("Cancelling...")
+            return
         if self.cb_1.currentText() == "None":
             notify_error("Please select a valid Nucleus image layer")
             return
@@ -289,80 +319,64 @@ class QTHPASingleCell(QDialog):
             ]
         ]
 
-        cell_segmentation = None
-        prediction_pkl = None
+        nucleus_model_id = self.nucseg_id + '/' + self.nucseg_version
+        cell_model_id = self.celseg_id + '/' + self.celseg_version
+        classification_model_id = self.classi_id + '/' + self.classi_version
 
-        run_nucleus_model = load_model_by_id(
-            self.nucseg_id + '/' + self.nucseg_version
-        )
-        run_cell_model = load_model_by_id(
-            self.celseg_id + '/' + self.celseg_version
-        )
-        run_classification_model = load_model_by_id(
-            self.classi_id + '/' + self.classi_version
-        )
-
-        axes = run_cell_model.inputs[0].axes
-        channels = ["red", "blue", "green"]
-        padding = {"x": 32, "y": 32}
         scale_factor = 1
 
-        def load_image(channels, scale_factor=None):
-            image = []
-            for chan in channels:
-                np_img_chan = []
-                if chan == "red":
-                    np_img_chan = self._viewer.layers[self.cb_2.currentText()].data
-                elif chan == "blue":
-                    np_img_chan = self._viewer.layers[self.cb_1.currentText()].data
-                if chan == "yellow":
-                    np_img_chan = self._viewer.layers[self.cb_3.currentText()].data
-                if chan == "green":
-                    np_img_chan = self._viewer.layers[self.cb_4.currentText()].data
-                if scale_factor is not None:
-                    np_img_chan = rescale(np_img_chan, scale_factor)
-                image.append(np_img_chan[None])
-            image = np.concatenate(image, axis=0)
-
-            return image
-
-        def _segment(pp_cell, pp_nucleus):
-            image = load_image(channels, scale_factor=scale_factor)
-
-            # run prediction with the nucleus model
-            input_nucleus = DataArray(
-                np.concatenate([image[1:2], image[1:2], image[1:2]], axis=0)[None],
-                dims=axes,
-            )
-            nuclei_pred = bioimageio.core.prediction.predict_with_padding(
-                pp_nucleus, input_nucleus, padding=padding
-            )[0].values[0]
-
+        # the layers are read here, in the GUI thread, and processed in a background thread
+        layer_data = {
+            "red": self._viewer.layers[self.cb_2.currentText()].data,
+            "blue": self._viewer.layers[self.cb_1.currentText()].data,
+            "yellow": self._viewer.layers[self.cb_3.currentText()].data,
+            "green": self._viewer.layers[self.cb_4.currentText()].data,
+        }
+
+        def predict_cached(model_id, input_, progress, cancel):
+            # a run on the same input returns the cached prediction without loading the model
+            def run():
+                # the pipeline stays loaded after the run, so running again only costs the prediction
+                with use_pipeline(model_id) as pp:
+                    return predict_tiled(
+                        pp,
+                        input_,
+                        progress=progress,
+                        cancel=cancel,
+                    )
+
+            return cached_prediction(model_id, [input_], run)
+
+        def nucleus_prediction(blue, progress, cancel):
+            # the blue channel is converted once, the three channels are views of it
+            input_nucleus = assemble_channels([blue] * 3, scale_factor=scale_factor, preserve_range=False)
+            return predict_cached(nucleus_model_id, input_nucleus, progress, cancel)[0]
+
+        def cell_prediction(red, blue, green, progress, cancel):
+            input_cell = assemble_channels([red, blue, green], scale_factor=scale_factor, preserve_range=False)
+            return predict_cached(cell_model_id, input_cell, progress, cancel)[0]
+
+        def seeds(nuclei_pred, progress, cancel):
             # segment the nuclei in order to use them as seeds for the cell segmentation
             threshold = 0.5
             min_size = 250
             fg = nuclei_pred[-1]
             nuclei = label(fg > threshold)
-            ids, sizes = np.unique(nuclei, return_counts=True)
+            table = measure_labels(nuclei)
             # don't apply size filter on the border
-            border = np.ones_like(nuclei).astype("bool")
-            border[1:-1, 1:-1] = 0
-            filter_ids = ids[sizes < min_size]
-            border_ids = nuclei[border]
-            filter_ids = np.setdiff1d(filter_ids, border_ids)
-            nuclei[np.isin(nuclei, filter_ids)] = 0
-
-            # run prediction with the cell segmentation model
-            input_cells = DataArray(image[None], dims=axes)
-            cell_pred = bioimageio.core.prediction.predict_with_padding(
-                pp_cell, input_cells, padding=padding
-            )[0].values[0]
+            remove_labels(nuclei, table.labels[(table.sizes < min_size) & ~table.border])
+            return nuclei
+
+        def cell_watershed(cell_pred, nuclei, progress, cancel):
             # segment the cells
+            progress(0, 1)
             threshold = 0.5
             fg, bd = cell_pred[2], cell_pred[1]
             cell_seg = watershed(bd, markers=nuclei, mask=fg > threshold)
 
             # bring back to the orignial scale
+            if scale_factor == 1:
+                return cell_seg
             cell_seg = rescale(
                 cell_seg,
                 1.0 / scale_factor,
@@ -372,72 +386,98 @@ class QTHPASingleCell(QDialog):
             ).astype(cell_seg.dtype)
             return cell_seg
 
-        with bioimageio.core.create_prediction_pipeline(
-            bioimageio_model=run_cell_model
-        ) as pp_cell:
-            with bioimageio.core.create_prediction_pipeline(
-                bioimageio_model=run_nucleus_model
-            ) as pp_nucleus:
-                cell_segmentation = _segment(pp_cell, pp_nucleus)
-
-        axes = run_classification_model.inputs[0].axes
-        expected_shape = run_classification_model.inputs[0].shape[1:]
-        channels = ["red", "green", "blue", "yellow"]
-
-        def _classifiy(pp, segmentation):
-            image = load_image(channels)
-            segments = regionprops(segmentation)
-
-            seg_ids = []
-            seg_images = []
-            for seg in segments:
-                seg_id = seg.label
-                bb = np.s_[seg.bbox[0] : seg.bbox[2], seg.bbox[1] : seg.bbox[3]]
-
-                im = image[(slice(None),) + bb]
-                mask = segmentation[bb] != seg_id
-                for c in range(im.shape[0]):
-                    im[c][mask] = 0
-                im = resize(im, expected_shape)
-                # after resize the value range is in [0, 1], but the model expects a value range of [0, 255]
-                # note that we could also use 'resize(..., preserve_range=True)', but we might also get other input ranges
-                # and this way we can make sure that the value range for the model is [0, 255]
-                im *= 255
-
-                # for debugging
-                # v = napari.Viewer()
-                # v.add_image(im)
-                # mask = resize(mask, expected_shape[1:], order=0, anti_aliasing=False, preserve_range=True)
-                # v.add_labels(np.logical_not(mask), name="cell_mask")
-                # napari.run()
-
-                seg_ids.append(seg_id)
-                seg_images.append(im[None])
-
-            input_ = DataArray(np.concatenate(seg_images, axis=0), dims=axes)
-            preds = pp(input_)[0].values
-            assert preds.shape[0] == len(seg_ids)
-            predictions = {seg_id: pred for seg_id, pred in zip(seg_ids, preds)}
+        # each stage only depends on the layers it reads: changing a layer only recomputes the stages it affects;
+        # the two models do not depend on each other, they run concurrently and the watershed waits for both
+        stages = StageGraph(self.stage_cache)
+        for chan, np_img_chan in layer_data.items():
+            stages.add_input(chan, np_img_chan)
+        prediction_key = {"scale_factor": scale_factor}
+        stages.add(
+            "nucleus prediction",
+            nucleus_prediction,
+            ["blue"],
+            label="Nucleus segmentation",
+            key={"model": nucleus_model_id, **prediction_key},
+        )
+        stages.add(
+            "cell prediction",
+            cell_prediction,
+            ["red", "blue", "green"],
+            label="Cell segmentation",
+            key={"model": cell_model_id, **prediction_key},
+        )
+        stages.add("seeds", seeds, ["nucleus prediction"], label="Nucleus seeds")
+        stages.add("segmentation", cell_watershed, ["cell prediction", "seeds"], label="Watershed", key=prediction_key)
+
+        classification_channels = ["red", "green", "blue", "yellow"]
+
+        def _classifiy(pp, image, segmentation, cells, axes, expected_shape, progress, cancel):
+            labels, boxes = cells.labels, cells.bboxes
+
+            # the cells are classified in fixed size batches, so the memory used does not grow with their number
+            cell_bytes = 3 * 4 * int(np.prod(expected_shape))
+            batch_size = max(1, CLASSIFICATION_MEMORY // cell_bytes)
+            batches = [slice(start, start + batch_size) for start in range(0, len(labels), batch_size)]
+            predictions = {}
+            with ThreadPoolExecutor(max_workers=1) as executor:
+
+                def prepare(batch):
+                    return executor.submit(crop_cells, image, segmentation, labels[batch], boxes[batch], expected_shape)
+
+                # the crops of the next batch are prepared while the model runs on the current one
+                next_crops = prepare(batches[0]) if batches else None
+                for index, batch in enumerate(batches):
+                    if cancel.is_set():
+                        raise PredictionCancelled()
+                    crops = next_crops.result()
+                    if index + 1 < len(batches):
+                        next_crops = prepare(batches[index + 1])
+                    preds = pp(DataArray(crops, dims=axes))[0].values
+                    assert preds.shape[0] == len(crops)
+                    predictions.update(zip(labels[batch].tolist(), preds))
+                    progress(index + 1, len(batches))
 
             return predictions
 
-        with bioimageio.core.create_prediction_pipeline(
-            bioimageio_model=run_classification_model
-        ) as pp:
-            prediction_pkl = _classifiy(pp, cell_segmentation)
+        def classification(cell_segmentation, cells, *channel_data, progress, cancel):
+            progress(0, 1)
+
+            def classify():
+                image = assemble_channels(channel_data, axes="cyx", dtype=None)
+                with use_pipeline(classification_model_id) as pp:
+                    axes = pp.input_specs[0].axes
+                    expected_shape = pp.input_specs[0].shape[1:]
+                    return _classifiy(pp, image, cell_segmentation, cells, axes, expected_shape, progress, cancel)
+
+            return cached_prediction(classification_model_id, [cell_segmentation, *channel_data], classify)
+
+        # the sizes and bounding boxes of the cells, measured once for the classification and the display
+        stages.add(
+            "cells", lambda cell_segmentation, progress, cancel: measure_labels(cell_segmentation), ["segmentation"]
+        )
+        stages.add(
+            "classification",
+            classification,
+            ["segmentation", "cells"] + classification_channels,
+            label="Classification",
+            key={"model": classification_model_id},
+        )
+
+        def predict(progress, cancel):
+            results = stages.run(["segmentation", "cells", "classification"], progress=progress, cancel=cancel)
+            return results["segmentation"], results["cells"], results["classification"]
 
         reverse_class_dict = {v: k for k, v in HPA_CLASSES.items()}
 
-        def visualize(segmentation, pred):
-            segments = regionprops(segmentation)
+        def visualize(segmentation, cells, pred):
             bounding_boxes = []
             classes = []
             likelihoods = []
-            for seg in segments:
-                scores = pred[seg.label]
+            for seg_label, bbox in zip(cells.labels.tolist(), cells.bboxes):
+                scores = pred[seg_label]
                 if scores is None:
                     continue
-                xmin, ymin, xmax, ymax = seg.bbox
+                xmin, ymin, xmax, ymax = bbox
                 bounding_boxes.append(np.array([[xmin, ymin], [xmax, ymax]]))
                 # apply softmax to find the class probabilities and the most likely class
                 scores = scores.squeeze()
@@ -458,7 +498,8 @@ class QTHPASingleCell(QDialog):
             }
 
             v = self._viewer
-            v.add_labels(segmentation)
+            # the stage cache keeps the segmentation, napari edits the layer data in place
+            v.add_labels(segmentation.copy())
             v.add_shapes(
                 bounding_boxes,
                 properties=properties,
@@ -469,5 +510,19 @@ class QTHPASingleCell(QDialog):
                 face_color="transparent",
             )
             # napari.run()
-
-        visualize(cell_segmentation, prediction_pkl)
+            self.run_status.setText("")
+
+        def finished():
+            self.job = None
+            self.run_btn.setText("Run")
+
+        # the models run in a background thread so that napari stays responsive
+        self.job = run_inference(
+            predict,
+            on_result=lambda result: visualize(*result),
+            on_progress=lambda stage, done, total: self.run_status.setText(f"{stage}: {done}/{total}"),
+            on_error=lambda excep: self.run_status.setText("Failed, please check logs!"),
+            on_cancelled=lambda: self.run_status.setText("Cancelled"),
+            on_finished=finished,
+        )
+        self.run_btn.setText("Cancel")
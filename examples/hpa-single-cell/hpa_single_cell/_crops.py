@@ -0,0 +1,71 @@
+"""Crops of the cells given to the classifier, made for a whole batch of cells at once."""
+
+import numpy as np
+
+# at most this many bilinear samples per output pixel and axis when shrinking a cell crop
+SUPERSAMPLING_MAX = 4
+
+
+def _sample_positions(start, stop, size, offset):
+    # bilinear sample positions along one axis of each crop, mirrored at its borders as skimage's resize does
+    length = (stop - start)[:, None]
+    coords = (np.arange(size)[None] + offset[:, None]) * (length / size) - 0.5
+    coords = np.abs(coords)
+    coords = np.clip(np.where(coords > length - 1, 2 * (length - 1) - coords, coords), 0, length - 1)
+    low = np.floor(coords).astype(np.intp)
+    high = np.minimum(low + 1, length - 1)
+    return start[:, None] + low, start[:, None] + high, (coords - low).astype(np.float32)
+
+
+def _samples(start, stop, size):
+    # bilinear samples per output pixel along one axis of each crop: one unless the crop is shrunk
+    return np.clip(np.ceil((stop - start) / size), 1, SUPERSAMPLING_MAX).astype(np.intp)
+
+
+def crop_cells(image, segmentation, labels, boxes, shape):
+    """Crops, masks and resizes cells to the classifier input shape, all cells of a batch at once.
+
+    Zeroes the pixels of other cells in the bounding box of each cell and resizes it bilinearly,
+    for the whole batch with array indexing. A crop that is not shrunk is the same as with
+    skimage.transform.resize(), up to float rounding. A shrunk crop is anti-aliased by averaging
+    up to SUPERSAMPLING_MAX bilinear samples per output pixel and axis instead of resize()'s
+    gaussian prefilter, so it differs from resize() near edges and fine details.
+    Args:
+        image: array with the channels first (cyx)
+        segmentation: label image (yx)
+        labels: array of the labels of the cells
+        boxes: array (cells x 4) of the bounding boxes (min row, min column, max row, max column)
+        shape: classifier input shape (channels, height, width)
+    Returns:
+        float32 array (cells, channels, height, width), in the value range [0, 255] expected by the classifier
+    """
+    channels, height, width = shape
+    if image.shape[0] != channels:
+        raise ValueError(f"The classifier expects {channels} channels, the image has {image.shape[0]}")
+    labels = np.asarray(labels)[:, None, None]
+    boxes = np.asarray(boxes)
+    # per cell, so that a crop does not depend on the other cells of its batch
+    samples_y = _samples(boxes[:, 0], boxes[:, 2], height)
+    samples_x = _samples(boxes[:, 1], boxes[:, 3], width)
+
+    crops = np.zeros((channels, len(boxes), height, width), dtype=np.float32)
+    for sample_y in range(samples_y.max()):
+        offset_y = (sample_y + 0.5) / samples_y
+        rows_low, rows_high, weight_y = _sample_positions(boxes[:, 0], boxes[:, 2], height, offset_y)
+        # the cells with fewer samples along y than sample_y do not take this one
+        active_y = (sample_y < samples_y)[:, None].astype(np.float32)
+        for sample_x in range(samples_x.max()):
+            offset_x = (sample_x + 0.5) / samples_x
+            cols_low, cols_high, weight_x = _sample_positions(boxes[:, 1], boxes[:, 3], width, offset_x)
+            active_x = (sample_x < samples_x)[:, None].astype(np.float32)
+            for rows, factor_y in ((rows_low, (1 - weight_y) * active_y), (rows_high, weight_y * active_y)):
+                for cols, factor_x in ((cols_low, (1 - weight_x) * active_x), (cols_high, weight_x * active_x)):
+                    index = rows[:, :, None] * segmentation.shape[1] + cols[:, None, :]
+                    # the pixels of other cells count as zero, as if masked before resizing
+                    weight = factor_y[:, :, None] * factor_x[:, None, :] * (np.take(segmentation, index) == labels)
+                    for channel in range(channels):
+                        crops[channel] += np.take(image[channel], index) * weight
+    # resize() brings integer images to [0, 1], the classifier expects [0, 255]
+    value_range = np.iinfo(image.dtype).max if np.issubdtype(image.dtype, np.integer) else 1
+    crops *= (255 / value_range / (samples_y * samples_x)).astype(np.float32)[None, :, None, None]
+    return np.ascontiguousarray(crops.transpose(1, 0, 2, 3))
@@ -0,0 +1,73 @@
+"""Compare the vectorized cell crops with masking and resizing each cell with skimage."""
+
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+from skimage import data
+from skimage.measure import regionprops
+from skimage.transform import resize
+
+
+def _load_crops():
+    # loaded from its file, so that the test runs without napari and Qt, which the plugin package imports
+    path = os.path.join(os.path.dirname(__file__), "..", "hpa_single_cell", "_crops.py")
+    spec = importlib.util.spec_from_file_location("hpa_single_cell_crops", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+crop_cells = _load_crops().crop_cells
+
+
+def _sample():
+    # the astronaut image cut into 60 voronoi cells of very different sizes
+    image = np.ascontiguousarray(np.moveaxis(data.astronaut(), -1, 0))
+    rng = np.random.default_rng(0)
+    seeds = rng.integers(0, image.shape[1], (60, 2))
+    rows, cols = np.mgrid[: image.shape[1], : image.shape[2]]
+    distances = (rows[None] - seeds[:, 0, None, None]) ** 2 + (cols[None] - seeds[:, 1, None, None]) ** 2
+    return image, (distances.argmin(axis=0) + 1).astype(np.int32)
+
+
+def _baseline(image, segmentation, shape):
+    # the per cell path crop_cells replaced
+    labels, boxes, crops = [], [], []
+    for region in regionprops(segmentation):
+        bbox = np.s_[region.bbox[0] : region.bbox[2], region.bbox[1] : region.bbox[3]]
+        crop = image[(slice(None),) + bbox].copy()
+        crop[:, segmentation[bbox] != region.label] = 0
+        labels.append(region.label)
+        boxes.append(region.bbox)
+        crops.append(resize(crop, shape) * 255)
+    return np.array(labels), np.array(boxes), np.stack(crops)
+
+
+@pytest.mark.parametrize("shape", [(3, 128, 128), (3, 32, 32)])
+def test_crop_cells_close_to_resize(shape):
+    image, segmentation = _sample()
+    labels, boxes, expected = _baseline(image, segmentation, shape)
+    crops = crop_cells(image, segmentation, labels, boxes, shape)
+    assert crops.shape == expected.shape
+    assert crops.dtype == np.float32
+
+    difference = np.abs(crops - expected)
+    # the crops that are not shrunk are the same as with resize()
+    enlarged = (boxes[:, 2] - boxes[:, 0] <= shape[1]) & (boxes[:, 3] - boxes[:, 1] <= shape[2])
+    if enlarged.any():
+        assert difference[enlarged].max() < 1e-3
+    # the shrunk ones are anti-aliased by supersampling instead of a gaussian prefilter
+    assert difference.mean() < 2.0
+    for crop, reference in zip(crops, expected):
+        assert np.corrcoef(crop.ravel(), reference.ravel())[0, 1] > 0.95
+
+
+def test_crop_cells_independent_of_batch():
+    image, segmentation = _sample()
+    labels, boxes, _ = _baseline(image, segmentation, (3, 64, 64))
+    together = crop_cells(image, segmentation, labels, boxes, (3, 64, 64))
+    for index in range(0, len(labels), 7):
+        alone = crop_cells(image, segmentation, labels[index : index + 1], boxes[index : index + 1], (3, 64, 64))
+        np.testing.assert_allclose(alone[0], together[index], atol=1e-3)
@@ -1,12 +1,10 @@
-import bioimageio.core
 import napari.resources
 import numpy as np
-from xarray import DataArray
 from skimage.measure import label
 from skimage.io import imread
 from napari._qt.qt_resources import get_stylesheet
 from napari.utils.notifications import show_error as notify_error
-from napari_bioimageio import show_model_selector, load_model_by_id
+from napari_bioimageio import cached_prediction, predict_tiled, run_inference, show_model_selector, use_pipeline
 from qtpy.QtWidgets import (
     QComboBox,
     QDialog,
@@ -30,6 +28,7 @@ class QTLiveCellSegBound(QDialog):
         self.image_layer = ""
         self.cellseg_model_source = ""
         self.cellseg_id = "None"
+        self.job = None
 
         self.setup_ui()
 
@@ -95,10 +94,18 @@ class QTLiveCellSegBound(QDialog):
         runBox.setContentsMargins(10, 20, 10, 10)
         self.layout.addLayout(runBox)
 
+        self.run_status = QLabel("")
+        self.run_status.setContentsMargins(10, 0, 10, 0)
+        self.layout.addWidget(self.run_status)
+
         self.layout.addStretch()
         self.setLayout(self.layout)
 
     def run_model(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.run_status.setText("Cancelling...")
+            return
         if self.cb.currentText() == "None":
             notify_error("Please select a valid image layer")
             return
@@ -108,29 +115,50 @@ class QTLiveCellSegBound(QDialog):
 
         np_img = self._viewer.layers[self.cb.currentText()].data
 
-        run_cell_model = load_model_by_id(
-            self.cellseg_id + '/' + self.cellseg_version
-        )
-
-        axes = run_cell_model.inputs[0].axes
-        padding = {"x": 16, "y": 16}
-        input_img = DataArray(
-            [[np_img]],
-            dims=axes,
+        model_id = self.cellseg_id + '/' + self.cellseg_version
+
+        def segment(progress, cancel):
+            def predict():
+                # the pipeline stays loaded after the run, so running again only costs the prediction
+                with use_pipeline(model_id) as pp_cell:
+                    # predicted tile by tile, so that the memory used does not grow with the image
+                    return predict_tiled(
+                        pp_cell,
+                        np_img[None, None],
+                        progress=lambda done, total: progress("Predicting", done, total),
+                        cancel=cancel,
+                    )
+
+            # a run on the same image returns the cached prediction without loading the model
+            segmentation = cached_prediction(model_id, [np_img], predict)[0]
+
+            progress("Labeling", 0, 1)
+            threshold = 0.5
+            fg = segmentation[0]
+            nuclei = label(fg > threshold)
+
+            fg = segmentation[1]
+            boundaries = label(fg > threshold)
+            return nuclei, boundaries
+
+        def visualize(result):
+            nuclei, boundaries = result
+            v = self._viewer
+            v.add_labels(nuclei, name="segmentation")
+            v.add_labels(boundaries, name="bondaries")
+            self.run_status.setText("")
+
+        def finished():
+            self.job = None
+            self.run_btn.setText("Run")
+
+        # the models run in a background thread so that napari stays responsive
+        self.job = run_inference(
+            segment,
+            on_result=visualize,
+            on_progress=lambda stage, done, total: self.run_status.setText(f"{stage}: {done}/{total}"),
+            on_error=lambda excep: self.run_status.setText("Failed, please check logs!"),
+            on_cancelled=lambda: self.run_status.setText("Cancelled"),
+            on_finished=finished,
         )
-
-        segmentation = bioimageio.core.prediction.predict_with_padding(
-            bioimageio.core.create_prediction_pipeline(
-                bioimageio_model=run_cell_model
-            ), input_img, padding=padding)[0].values[0]
-
-        threshold = 0.5
-        fg = segmentation[0]
-        nuclei = label(fg > threshold)
-
-        fg = segmentation[1]
-        boundaries = label(fg > threshold)
-
-        v = self._viewer
-        v.add_labels(nuclei, name="segmentation")
-        v.add_labels(boundaries, name="bondaries")
\ No newline at end of file
+        self.run_btn.setText("Cancel")
@@ -1,8 +1,55 @@
-from ._bmm import show_model_selector, show_model_manager, show_model_uploader, load_model_by_id
+import importlib
+
+from ._channels import assemble_channels
+from ._pool import InferencePool, close_inference_pools, get_inference_pool
+from ._labels import measure_labels, remove_labels
+from ._pipelines import clear_pipelines, get_pipeline, release_pipeline, use_pipeline
+from ._results import cached_prediction
+from ._stages import StageCache, StageGraph
+from ._tiling import PredictionCancelled, predict_tiled
+from ._tuning import get_tuning, tune_model
+from ._utils import download_models, get_disk_usage, watch_models
 
 __all__ = [
     "show_model_selector",
     "show_model_manager",
     "show_model_uploader",
     "load_model_by_id",
+    "download_models",
+    "get_disk_usage",
+    "watch_models",
+    "get_pipeline",
+    "release_pipeline",
+    "use_pipeline",
+    "clear_pipelines",
+    "predict_tiled",
+    "PredictionCancelled",
+    "StageGraph",
+    "StageCache",
+    "measure_labels",
+    "remove_labels",
+    "assemble_channels",
+    "cached_prediction",
+    "tune_model",
+    "get_tuning",
+    "run_inference",
+    "InferencePool",
+    "get_inference_pool",
+    "close_inference_pools",
 ]
+
+# the Qt widgets and workers are imported on first use: the worker processes of the inference pools
+# import this package too, and must not load Qt and napari
+_QT_EXPORTS = {
+    "show_model_selector": "._bmm",
+    "show_model_manager": "._bmm",
+    "show_model_uploader": "._bmm",
+    "load_model_by_id": "._bmm",
+    "run_inference": "._inference",
+}
+
+
+def __getattr__(name):
+    if name in _QT_EXPORTS:
+        return getattr(importlib.import_module(_QT_EXPORTS[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,187 @@
+"""Content-addressed store deduplicating model files across model versions."""
+
+import concurrent.futures
+import hashlib
+import mmap
+import os
+import shutil
+import typing
+import uuid
+
+from ._locks import LOCKS_DIRECTORY_NAME, locked
+
+HASH_CHUNK_SIZE = 1 << 20
+HASH_WORKERS_DEFAULT = min(8, os.cpu_count() or 1)
+# Linux ioctl cloning a file on copy-on-write file systems (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def hash_file(file_path: str) -> str:
+    """Computes the sha256 of a file.
+
+    The file is memory mapped when possible, so that it is hashed in a single call releasing the
+    GIL and several files can be hashed concurrently from threads.
+    Args:
+        file_path: string, path of the file
+    Returns:
+        Hexadecimal sha256 digest
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                sha256.update(mapped)
+            return sha256.hexdigest()
+        except (OSError, ValueError):
+            # empty files and file systems without mmap support
+            pass
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def hash_files(file_paths: typing.Sequence[str], max_workers: int = HASH_WORKERS_DEFAULT) -> typing.List[str]:
+    """Computes the sha256 of several files concurrently.
+
+    Args:
+        file_paths: list of strings, paths of the files
+        max_workers: int, number of files hashed in parallel
+    Returns:
+        List of hexadecimal sha256 digests, in the order of file_paths
+    """
+    if len(file_paths) <= 1 or max_workers <= 1:
+        return [hash_file(file_path) for file_path in file_paths]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(file_paths))) as executor:
+        return list(executor.map(hash_file, file_paths))
+
+
+def _clone_or_copy(source: str, destination: str) -> None:
+    try:
+        import fcntl
+
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(source, destination)
+
+
+def _link(source: str, destination: str) -> bool:
+    """Replaces destination by a hard link to source, or a reflink/copy if hard links are not supported.
+
+    Returns:
+        True if a hard link was created
+    """
+    tmp_file = f"{destination}.{uuid.uuid4().hex}.tmp"
+    linked = True
+    try:
+        os.link(source, tmp_file)
+    except OSError:
+        linked = False
+        _clone_or_copy(source, tmp_file)
+    os.replace(tmp_file, destination)
+    if os.path.lexists(tmp_file):
+        # renaming a hard link over another link to the same file does nothing
+        os.remove(tmp_file)
+    return linked
+
+
+class BlobStore:
+    """Files stored once by sha256 and hard linked into the model version directories.
+
+    A blob is referenced by every hard link to it, so the number of links of a blob tells if a model
+    still uses it: collect_garbage() removes the blobs no model links to anymore. Installed files
+    are shared between versions and must not be modified in place. Linking a blob holds the lock
+    of the store shared and collect_garbage() holds it exclusively, so another process cannot
+    remove a blob between the check that it exists and its link.
+    """
+
+    def __init__(self, root: str, lock_file: typing.Optional[str] = None):
+        """Creates the store.
+
+        Args:
+            root: string, path of the directory of the blobs
+            lock_file: string, path of the lock of the store, by default in the locks directory
+                next to root
+        """
+        self.root = root
+        if lock_file is None:
+            lock_file = os.path.join(os.path.dirname(os.path.abspath(root)), LOCKS_DIRECTORY_NAME, "blobs.lock")
+        self.lock_file = lock_file
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, "sha256", digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def add(self, file_path: str, digest: typing.Optional[str] = None) -> str:
+        """Moves a file into the store, leaving a link to the stored blob in its place.
+
+        If an identical blob is already stored, the file is replaced by a link to it.
+        Args:
+            file_path: string, path of the file to store
+            digest: string, sha256 of the file if already known
+        Returns:
+            Hexadecimal sha256 digest of the file
+        """
+        if digest is None:
+            digest = hash_file(file_path)
+        blob = self.path(digest)
+        with locked(self.lock_file, shared=True):
+            if os.path.exists(blob):
+                if not os.path.samefile(blob, file_path):
+                    _link(blob, file_path)
+                return digest
+
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(file_path, blob)
+            except FileExistsError:
+                # stored concurrently by another install
+                _link(blob, file_path)
+            except OSError:
+                # no hard links on this file system, keep the file as is
+                pass
+        return digest
+
+    def materialize(self, digest: str, destination: str) -> bool:
+        """Links a stored blob to destination.
+
+        Args:
+            digest: string, sha256 of the blob
+            destination: string, path of the file to create
+        Returns:
+            True if the blob was stored and linked
+        """
+        blob = self.path(digest)
+        with locked(self.lock_file, shared=True):
+            if not os.path.exists(blob):
+                return False
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            _link(blob, destination)
+        return True
+
+    def collect_garbage(self) -> int:
+        """Removes the blobs that are not linked from any model directory anymore.
+
+        Returns:
+            Number of bytes freed
+        """
+        freed = 0
+        with locked(self.lock_file):
+            for directory, _, files in os.walk(self.root):
+                for file_name in files:
+                    blob = os.path.join(directory, file_name)
+                    try:
+                        stat = os.stat(blob)
+                        if stat.st_nlink <= 1:
+                            os.remove(blob)
+                            freed += stat.st_size
+                    except OSError:
+                        continue
+        return freed
@@ -3,7 +3,7 @@ from pathlib import Path
 
 import napari.resources
 from napari._qt.qt_resources import QColoredSVGIcon, get_stylesheet
-from qtpy.QtCore import QObject, QSize, Qt, QThread, Signal
+from qtpy.QtCore import QObject, QSize, Qt, QThread, QTimer, Signal
 from qtpy.QtGui import QFont, QMovie
 from qtpy.QtWidgets import (
     QAction,
@@ -27,7 +27,10 @@ from qtpy.QtWidgets import (
 )
 from superqt import QElidingLabel
 
-from . import _utils
+from . import _pipelines, _utils
+from ._search import SearchIndex
+
+FILTER_DEBOUNCE_MS = 150
 
 # TODO find a proper way to import style from napari
 custom_style = (
@@ -84,12 +87,10 @@ class Downloader(QObject):
     model_info = {}
     selected_version = ""
     destination_file = ""
-    filter_id_text = ""
-    filter_tag_text = ""
     inspect_data = ""
     validate_data = ""
-    already_downloaded = {}
-    ready_to_download = {}
+    downloaded_models = None
+    available_models = None
     exit_code = 0
     finished = Signal()
 
@@ -98,27 +99,19 @@ class Downloader(QObject):
     ):
         super().__init__()
 
-    def download(
-        self,
-    ):
-        try:
-            _utils.download_model(self.model_info["id"] + '/' + self.selected_version, True)
-        except Exception as e:
-            print("Could not download model:", str(e))
-            self.exit_code = -1
-
-        self.refresh()
-
     def remove(
         self,
     ):
         try:
-            _utils.remove_model(self.model_info["id"][:self.model_info["id"].rfind('/') + 1] + self.selected_version)
+            model_id = self.model_info["id"][:self.model_info["id"].rfind('/') + 1] + self.selected_version
+            # the pipelines kept loaded by this process would otherwise keep the model in use
+            _pipelines.get_pipeline_cache().discard(model_id)
+            _utils.remove_model(model_id)
         except Exception as e:
             print("Could not remove model:", str(e))
             self.exit_code = -1
 
-        self.refresh()
+        self.refresh_local()
 
     def inspect(
         self,
@@ -142,41 +135,17 @@ class Downloader(QObject):
 
         self.finished.emit()
 
-    def _filter(self, models, filter_id, filter_tag):
-        filtered = {}
-        filters_id = filter_id.split(";")
-        filters_id = filters_id.remove('') if '' in filters_id else filters_id
-        filters_tag = filter_tag.split(";")
-        filters_tag = filters_tag.remove('') if '' in filters_tag else filters_tag
-        for curr_model in models:
-            if not filters_id and not filters_tag:
-                filtered[curr_model["id"]] = curr_model
-            else:
-                model_key = str(curr_model["id"]).lower()
-                if filters_id:
-                    for curr_filter in filters_id:
-                        if (
-                            curr_filter.lower() in curr_model["name"].lower()
-                            or "nickname" in curr_model and curr_filter.lower() in curr_model["nickname"].lower()
-                            or curr_filter.lower() in model_key
-                        ):
-                            filtered[curr_model["id"]] = curr_model
-                            break
-                if filters_tag:
-                    for curr_filter in filters_tag:
-                        if curr_filter.lower() in (",".join(curr_model["tags"])).lower():
-                            filtered[curr_model["id"]] = curr_model
-                            break
-        return filtered
+    def refresh_local(
+        self,
+    ):
+        self.downloaded_models = _utils.get_downloaded_models()
+        self.finished.emit()
 
     def refresh(
         self,
     ):
-        model_list = _utils.get_downloaded_models()
-        self.already_downloaded = self._filter(model_list, self.filter_id_text, self.filter_tag_text)
-
-        model_list = _utils.get_model_list()
-        self.ready_to_download = self._filter(model_list, self.filter_id_text, self.filter_tag_text)
+        self.downloaded_models = _utils.get_downloaded_models()
+        self.available_models = _utils.get_model_list()
         self.finished.emit()
 
 
@@ -368,20 +337,108 @@ class QtModelList(QListWidget):
         self.setItemWidget(item, widg)
 
 class QtBioImageIOModelManager(QDialog):
-    def __init__(self, parent=None, filter_id=None, filter_tag=None, select_mode=False):
+    store_changed = Signal(object)
+    download_progress = Signal(object)
+
+    def __init__(self, parent=None, filter_id=None, filter_tag=None, select_mode=False, watch=True):
         super().__init__(parent)
         self.setStyleSheet(custom_style)
         self.models_folder = _utils.get_models_path()
         self.validation_file = ""
 
         self.RUNNING = False
+        # a local refresh asked for while another action runs, started once its thread is done
+        self.refresh_pending = False
+        self.downloaded_models = {}
+        self.downloaded_index = SearchIndex()
+        self.available_index = SearchIndex()
+        self.watch = watch
+        self.watcher = None
+        self.download_manager = None
+        # a bound method is a new object at each access, the same one must be added and removed
+        self._download_listener = self.download_progress.emit
+        self.download_failed = False
         self.select_mode = select_mode
         self.selected = None
         self.filter_id = filter_id
         self.filter_tag = filter_tag
+        # the watcher calls back from its own thread, the signal delivers the events on the GUI thread
+        self.store_changed.connect(self.patch_downloaded)
+        self.download_progress.connect(self.update_downloads)
+        self.finished.connect(self.stop_watcher)
+        self.finished.connect(self.stop_download_updates)
         self.setup_ui()
 
+    def start_watcher(self):
+        if self.watch and self.watcher is None:
+            self.watcher = _utils.watch_models(self.store_changed.emit)
+
+    def stop_watcher(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def queue_download(self, model_info, selected_version):
+        if self.download_manager is None:
+            self.download_manager = _utils.get_download_manager()
+            self.download_manager.add_listener(self._download_listener)
+        self.download_manager.submit(model_info["id"] + '/' + selected_version, True)
+
+    def stop_download_updates(self):
+        if self.download_manager is not None:
+            self.download_manager.remove_listener(self._download_listener)
+            self.download_manager = None
+
+    def cancel_downloads(self):
+        if self.download_manager is not None:
+            for job in self.download_manager.jobs():
+                job.cancel()
+
+    def update_downloads(self, job):
+        if self.download_manager is None:
+            return
+        if job.finished:
+            if job.state == "failed":
+                self.download_failed = True
+            elif job.state == "done" and self.watcher is None:
+                self.run_thread("refresh_local")
+
+        jobs = self.download_manager.jobs()
+        if jobs:
+            self.working_indicator.show()
+            self.cancel_btn.show()
+            bytes_done = sum(curr_job.bytes_done for curr_job in jobs) / 1e6
+            bytes_total = sum(curr_job.bytes_total for curr_job in jobs) / 1e6
+            throughput = sum(curr_job.throughput for curr_job in jobs if curr_job.state == "running") / 1e6
+            self.run_status.setText(
+                f"Downloading {len(jobs)} model(s): {bytes_done:.1f}/{bytes_total:.1f} MB at {throughput:.1f} MB/s"
+            )
+        else:
+            self.cancel_btn.hide()
+            if not self.RUNNING:
+                self.working_indicator.hide()
+                self.run_status.setText("Failed, please check logs!" if self.download_failed else "")
+            self.download_failed = False
+
+    def patch_downloaded(self, events):
+        for event in events:
+            if event.kind == "removed":
+                self.downloaded_models.pop(event.summary["id"], None)
+            else:
+                self.downloaded_models[event.summary["id"]] = event.summary
+        self.downloaded_index.sync(self.downloaded_models.values())
+        self.apply_filters()
+
     def run_thread(self, action_name, model_info=None, selected_version=""):
+        if action_name == "download":
+            # downloads go to the shared queue and run in parallel with anything else
+            self.queue_download(model_info, selected_version)
+            return
+
+        if action_name == "refresh_local" and self.RUNNING:
+            self.refresh_pending = True
+            return
+
         if self.RUNNING == False:
             if action_name == "select":
                 self.selected = model_info
@@ -397,11 +454,11 @@ class QtBioImageIOModelManager(QDialog):
 
             self.worker.model_info = model_info
             self.worker.selected_version = selected_version
-            self.worker.filter_id_text = self.filter_id_text.text()
-            self.worker.filter_tag_text = self.filter_tag_text.text()
-            if action_name == "download":
-                self.thread.started.connect(self.worker.download)
-                self.run_status.setText("Downloading...")
+            if action_name in ("refresh_local", "refresh"):
+                self.refresh_pending = False
+            if action_name == "refresh_local":
+                self.thread.started.connect(self.worker.refresh_local)
+                self.run_status.setText("Refreshing...")
                 self.worker.finished.connect(self.refresh)
             elif action_name == "remove":
                 self.thread.started.connect(self.worker.remove)
@@ -424,14 +481,40 @@ class QtBioImageIOModelManager(QDialog):
             self.worker.finished.connect(self.thread.quit)
             self.worker.finished.connect(self.worker.deleteLater)
             self.thread.finished.connect(self.thread.deleteLater)
+            self.thread.finished.connect(self.run_pending_refresh)
             self.thread.start()
 
+    def run_pending_refresh(self):
+        if self.refresh_pending and not self.RUNNING:
+            self.refresh_pending = False
+            self.run_thread("refresh_local")
+
     def refresh(self):
+        if self.worker.downloaded_models is not None:
+            self.downloaded_models = {model["id"]: model for model in self.worker.downloaded_models}
+            self.downloaded_index.sync(self.downloaded_models.values())
+        if self.worker.available_models is not None:
+            self.available_index.sync(self.worker.available_models)
+        self.apply_filters()
+
+        self.working_indicator.hide()
+        if self.worker.exit_code == -1:
+            self.run_status.setText("Failed, please check logs!")
+        else:
+            self.run_status.setText("")
+        self.RUNNING = False
+        self.start_watcher()
+
+    def apply_filters(self):
+        # filters the already loaded lists in memory, without touching the disk or the network
+        already_downloaded = self.downloaded_index.search(self.filter_id_text.text(), self.filter_tag_text.text())
+        ready_to_download = self.available_index.search(self.filter_id_text.text(), self.filter_tag_text.text())
+
         self.downloaded_list.clear()
         self.available_list.clear()
 
         downloaded_versions = {}
-        for curr_model_key in self.worker.already_downloaded:
+        for curr_model_key in already_downloaded:
             pure_model_id = curr_model_key[:curr_model_key.rfind('/')]
             pure_model_version = curr_model_key[len(pure_model_id) + 1:]
             if pure_model_id not in downloaded_versions:
@@ -440,23 +523,17 @@ class QtBioImageIOModelManager(QDialog):
 
         for curr_model_key in downloaded_versions:
             self.downloaded_list.addItem(
-                self.worker.already_downloaded[curr_model_key + '/' + downloaded_versions[curr_model_key][0]],
+                already_downloaded[curr_model_key + '/' + downloaded_versions[curr_model_key][0]],
                 sorted(downloaded_versions[curr_model_key], reverse=True),
                 downloaded=1
             )
 
-        for curr_model_key in self.worker.ready_to_download:
+        for curr_model_key in ready_to_download:
             self.available_list.addItem(
-                self.worker.ready_to_download[curr_model_key],
-                sorted(self.worker.ready_to_download[curr_model_key]["versions"], reverse=True),
+                ready_to_download[curr_model_key],
+                sorted(ready_to_download[curr_model_key]["versions"], reverse=True),
                 downloaded=0,
             )
-        self.working_indicator.hide()
-        if self.worker.exit_code == -1:
-            self.run_status.setText("Failed, please check logs!")
-        else:
-            self.run_status.setText("")
-        self.RUNNING = False
 
     def inspect_popup(self):
         self.RUNNING = False
@@ -512,6 +589,9 @@ class QtBioImageIOModelManager(QDialog):
         self.modfol_value = QLabel(self.models_folder)
         modfol_folder_btn = QPushButton("Change")
         modfol_folder_btn.clicked.connect(self.getfiles)
+        self.cancel_btn = QPushButton("Cancel downloads")
+        self.cancel_btn.clicked.connect(self.cancel_downloads)
+        self.cancel_btn.hide()
         self.run_status = QLabel(self)
         self.run_status.setObjectName("small_italic_text")
         self.run_status.setAlignment(Qt.AlignRight | Qt.AlignTrailing | Qt.AlignVCenter)
@@ -533,22 +613,29 @@ class QtBioImageIOModelManager(QDialog):
         folderBox.addSpacing(10)
         folderBox.addWidget(self.run_status)
         folderBox.addWidget(self.working_indicator)
+        folderBox.addWidget(self.cancel_btn)
         folderBox.setContentsMargins(0, 0, 4, 0)
         vlay_1.addLayout(folderBox)
 
+        # restarted on every keystroke so only the latest query is applied once typing pauses
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(FILTER_DEBOUNCE_MS)
+        self.filter_timer.timeout.connect(self.apply_filters)
+
         filterBox = QHBoxLayout()
         filter_label = QLabel("Filters:")
         self.filter_id_text = QLineEdit()
         self.filter_id_text.setPlaceholderText("Filter by id...")
         self.filter_id_text.setMaximumWidth(200)
         self.filter_id_text.setClearButtonEnabled(True)
-        self.filter_id_text.textChanged.connect(lambda: self.run_thread("refresh"))
+        self.filter_id_text.textChanged.connect(lambda _: self.filter_timer.start())
 
         self.filter_tag_text = QLineEdit()
         self.filter_tag_text.setPlaceholderText("Filter by tag...")
         self.filter_tag_text.setMaximumWidth(200)
         self.filter_tag_text.setClearButtonEnabled(True)
-        self.filter_tag_text.textChanged.connect(lambda: self.run_thread("refresh"))
+        self.filter_tag_text.textChanged.connect(lambda _: self.filter_timer.start())
         filterBox.addWidget(filter_label)
         filterBox.addSpacing(10)
         filterBox.addWidget(self.filter_id_text)
@@ -600,8 +687,7 @@ class QtBioImageIOModelManager(QDialog):
                 self.filter_tag_text.setText(self.filter_tag)
                 self.filter_tag_text.setReadOnly(True)
                 self.filter_tag_text.setEnabled(False)
-        else:
-            self.run_thread("refresh", None)
+        self.run_thread("refresh", None)
 
     def getfiles(self):
         dlg = QFileDialog()
@@ -610,6 +696,7 @@ class QtBioImageIOModelManager(QDialog):
 
         if dlg.exec_():
             filenames = dlg.selectedFiles()
+            self.stop_watcher()
             _utils.set_models_path(filenames[0])
             self.models_folder = _utils.get_models_path()
             self.modfol_value.setText(self.models_folder)
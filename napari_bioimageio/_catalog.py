@@ -0,0 +1,118 @@
+"""Compact in-memory representation of the BioImage.IO collection catalog."""
+
+import collections.abc
+import sys
+import typing
+
+CATALOG_FIELDS = (
+    "id",
+    "type",
+    "name",
+    "description",
+    "nickname",
+    "nickname_icon",
+    "tags",
+    "versions",
+    "rdf_source",
+)
+
+
+class CatalogEntry(collections.abc.Mapping):
+    """One model of the collection, stored as slots instead of a nested dictionary.
+
+    Entries behave like a read-only dictionary restricted to the catalog fields, so existing code
+    indexing them (model_info["id"], "nickname" in model_info, ...) keeps working. Missing optional
+    fields are not reported as keys. A plain dictionary is only built by to_dict() when a caller
+    really needs one.
+    """
+
+    __slots__ = CATALOG_FIELDS + ("_dict",)
+
+    def __init__(
+        self,
+        id: str,
+        name: str,
+        description: str = "",
+        nickname: typing.Optional[str] = None,
+        nickname_icon: typing.Optional[str] = None,
+        tags: typing.Tuple[str, ...] = (),
+        versions: typing.Tuple[str, ...] = (),
+        rdf_source: typing.Optional[str] = None,
+        type: str = "model",
+    ):
+        self.id = id
+        self.type = type
+        self.name = name
+        self.description = description
+        self.nickname = nickname
+        self.nickname_icon = nickname_icon
+        self.tags = tags
+        self.versions = versions
+        self.rdf_source = rdf_source
+        self._dict = None
+
+    @classmethod
+    def from_summary(cls, summary: typing.Dict[str, typing.Any]) -> "CatalogEntry":
+        """Builds an entry from one item of the parsed collection JSON.
+
+        Args:
+            summary: dictionary, collection item as parsed from JSON
+        Returns:
+            Catalog entry holding only the catalog fields
+        """
+        bioimageio_config = (summary.get("config") or {}).get("bioimageio") or {}
+        nickname = summary.get("nickname", bioimageio_config.get("nickname"))
+        nickname_icon = summary.get("nickname_icon", bioimageio_config.get("nickname_icon"))
+        return cls(
+            id=str(summary["id"]),
+            type=sys.intern(str(summary.get("type", "model"))),
+            name=str(summary.get("name", "")),
+            description=str(summary.get("description", "")),
+            nickname=None if nickname is None else str(nickname),
+            nickname_icon=None if nickname_icon is None else str(nickname_icon),
+            tags=tuple(sys.intern(str(tag)) for tag in summary.get("tags") or ()),
+            versions=tuple(str(version) for version in summary.get("versions") or ()),
+            rdf_source=summary.get("rdf_source"),
+        )
+
+    def __getitem__(self, key: str) -> typing.Any:
+        if key in CATALOG_FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                if isinstance(value, tuple):
+                    return list(value)
+                return value
+        raise KeyError(key)
+
+    def __iter__(self) -> typing.Iterator[str]:
+        return (field for field in CATALOG_FIELDS if getattr(self, field) is not None)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"CatalogEntry(id={self.id!r}, name={self.name!r})"
+
+    def to_dict(self) -> typing.Dict[str, typing.Any]:
+        """Gets a plain dictionary view of the entry, built on first use."""
+        if self._dict is None:
+            self._dict = {key: self[key] for key in self}
+        return self._dict
+
+
+def parse_collection(data: typing.Any) -> typing.List[CatalogEntry]:
+    """Builds the model catalog in a single pass over the parsed collection JSON.
+
+    Args:
+        data: parsed collection JSON
+    Returns:
+        List of catalog entries for all the models, sorted by name
+    """
+    result: typing.List[CatalogEntry] = []
+    if isinstance(data, dict) and isinstance(data.get("collection"), list):
+        for summary in data["collection"]:
+            if isinstance(summary, dict) and summary.get("type") == "model" and "id" in summary:
+                result.append(CatalogEntry.from_summary(summary))
+    result.sort(key=lambda entry: entry.name)
+
+    return result
@@ -0,0 +1,85 @@
+"""Assembly of model input tensors from the channels of napari layers."""
+
+import typing
+
+import numpy as np
+
+CHANNEL_AXES_DEFAULT = "bcyx"
+
+
+def _is_noop_scale(scale_factor: typing.Any) -> bool:
+    return scale_factor is None or np.all(np.asarray(scale_factor) == 1)
+
+
+def assemble_channels(
+    channels: typing.Sequence[typing.Any],
+    axes: str = CHANNEL_AXES_DEFAULT,
+    dtype: typing.Any = "float32",
+    scale_factor: typing.Union[float, typing.Sequence[float], None] = None,
+    preserve_range: bool = True,
+) -> np.ndarray:
+    """Builds a model input tensor from one array per channel, e.g. the data of napari layers.
+
+    The channels are written once, converted on the fly, into a single array allocated in the
+    layout and dtype of the model input, instead of being stacked as float64 copies. When every
+    channel is the same array (e.g. a grayscale image given to a model expecting RGB), it is
+    converted once and copied along the channel axis. The tensor is always a contiguous array the
+    caller may modify. The channels are only rescaled if scale_factor is not 1.
+    Args:
+        channels: list of arrays with the spatial axes of the input, in order (e.g. yx)
+        axes: string, axes of the tensor (e.g. "bcyx", "byxc"); the batch axis has size 1
+        dtype: data type of the tensor (e.g. input_spec.data_type), None for the one of the channels
+        scale_factor: float, or one per spatial axis, rescaling factor of the channels (skimage.transform.rescale)
+        preserve_range: bool, False to bring integer channels to [0, 1] as skimage's img_as_float does,
+            e.g. to get the same values as after skimage.transform.rescale
+    Returns:
+        Array with the given axes, one channel along "c"
+    """
+    if not channels:
+        raise ValueError("At least one channel is needed")
+    if "c" not in axes:
+        raise ValueError(f"The axes {axes} have no channel axis")
+    spatial = [axis for axis in axes if axis not in "bc"]
+    dtype = np.dtype(np.result_type(*[channel.dtype for channel in channels]) if dtype is None else dtype)
+    if not preserve_range and not np.issubdtype(dtype, np.floating):
+        raise ValueError("Integer channels brought to [0, 1] need a floating point dtype")
+
+    def convert(channel: typing.Any, out: np.ndarray) -> None:
+        channel = np.asarray(channel)
+        value_range = None
+        if not preserve_range and np.issubdtype(channel.dtype, np.integer):
+            value_range = np.iinfo(channel.dtype).max
+        if not _is_noop_scale(scale_factor):
+            from skimage.transform import rescale
+
+            channel = rescale(channel, scale_factor, preserve_range=True)
+        if value_range is not None:
+            np.multiply(channel, 1 / value_range, out=out, casting="unsafe")
+        else:
+            np.copyto(out, channel, casting="unsafe")
+
+    first = channels[0]
+    spatial_shape = tuple(first.shape)
+    if not _is_noop_scale(scale_factor):
+        factors = np.broadcast_to(np.asarray(scale_factor, dtype=float), (len(spatial_shape),))
+        spatial_shape = tuple(int(round(size * factor)) for size, factor in zip(spatial_shape, factors))
+    if len(spatial_shape) != len(spatial):
+        raise ValueError(f"The channels have {len(spatial_shape)} dimensions, the axes {axes} expect {len(spatial)}")
+    for channel in channels[1:]:
+        if tuple(channel.shape) != tuple(first.shape):
+            raise ValueError(f"The channels have different shapes {tuple(first.shape)} and {tuple(channel.shape)}")
+
+    def shape(channel_count: int) -> typing.Tuple[int, ...]:
+        return tuple(
+            1 if axis == "b" else channel_count if axis == "c" else spatial_shape[spatial.index(axis)] for axis in axes
+        )
+
+    if all(channel is first for channel in channels):
+        single = np.empty(shape(1), dtype=dtype)
+        convert(first, single[tuple(0 if axis in "bc" else slice(None) for axis in axes)])
+        return np.repeat(single, len(channels), axis=axes.index("c"))
+
+    tensor = np.empty(shape(len(channels)), dtype=dtype)
+    for index, channel in enumerate(channels):
+        convert(channel, tensor[tuple(0 if axis == "b" else index if axis == "c" else slice(None) for axis in axes)])
+    return tensor
@@ -0,0 +1,565 @@
+"""Streaming, resumable download of model packages."""
+
+import http.client
+import json
+import os
+import queue
+import shutil
+import socket
+import threading
+import time
+import typing
+import urllib.error
+import urllib.request
+import uuid
+
+import bioimageio.spec
+import yaml
+
+from ._blobs import BlobStore, hash_files
+
+JOURNAL_FILE_NAME = ".download.json"
+PARTIAL_SUFFIX = ".part"
+STAGING_SUFFIX = ".staging"
+OLD_SUFFIX = ".old-"
+STAGING_MAX_AGE = 24 * 3600
+CHUNK_SIZE = 1 << 20
+PROGRESS_INTERVAL = 0.2
+# seconds without data from the server before a transfer fails, and is retried as a transient error
+DOWNLOAD_TIMEOUT = 30
+
+
+class DownloadCancelled(Exception):
+    """Raised inside a download when its job was cancelled."""
+
+
+class ChecksumError(ValueError):
+    """Raised when a downloaded file does not match the sha256 declared by its rdf.yaml."""
+
+
+def is_transient(excep: BaseException) -> bool:
+    """Tells if a download error may go away on a retry: a lost connection, a timeout or a server error.
+
+    Errors such as an unknown model id, a checksum mismatch or a 404 are permanent.
+    """
+    while excep is not None:
+        if isinstance(excep, urllib.error.HTTPError):
+            # server errors, request timeout and too many requests
+            return excep.code >= 500 or excep.code in (408, 429)
+        if isinstance(
+            excep, (urllib.error.URLError, socket.timeout, TimeoutError, ConnectionError, http.client.IncompleteRead)
+        ):
+            return True
+        # e.g. a library error raised from the network error
+        excep = excep.__cause__
+    return False
+
+
+def _check_cancelled(cancel: typing.Optional[threading.Event]) -> None:
+    if cancel is not None and cancel.is_set():
+        raise DownloadCancelled()
+
+
+def get_package_content(
+    model_id: str, weight_formats: typing.Optional[typing.Sequence[str]] = None
+) -> typing.Dict[str, typing.Any]:
+    """Lists the files making up the package of a model, without downloading them.
+
+    Args:
+        model_id: string, id of the model (including the version)
+        weight_formats: list of weight formats by order of preference, only the first one the model
+            provides is part of the package; all the weights are included if None or if the model
+            provides none of them
+    Returns:
+        Python dictionary with the source (url or local path) by package file name,
+        and the content of the rdf.yaml under the "rdf" key
+    """
+    return bioimageio.spec.get_resource_package_content(
+        model_id, weights_priority_order=list(weight_formats) if weight_formats else None
+    )
+
+
+def declared_hashes(rdf: str) -> typing.Dict[str, str]:
+    """Gets the sha256 the rdf.yaml of a package declares for its files.
+
+    Args:
+        rdf: string, content of the rdf.yaml
+    Returns:
+        Python dictionary with the sha256 by package file name
+    """
+    try:
+        data = yaml.load(rdf, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    except yaml.YAMLError:
+        return {}
+    hashes = {}
+    weights = data.get("weights") if isinstance(data, dict) else None
+    if isinstance(weights, dict):
+        for weights_entry in weights.values():
+            if isinstance(weights_entry, dict) and weights_entry.get("sha256") and weights_entry.get("source"):
+                hashes[str(weights_entry["source"])] = str(weights_entry["sha256"])
+    return hashes
+
+
+def _read_journal(journal_file: str) -> typing.Dict[str, typing.Any]:
+    try:
+        with open(journal_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_journal(journal_file: str, journal: typing.Dict[str, typing.Any]) -> None:
+    with open(journal_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(journal, f)
+    os.replace(journal_file + ".tmp", journal_file)
+
+
+def is_partial(model_folder: str) -> bool:
+    """Tells if model_folder holds an interrupted download that can be resumed."""
+    return os.path.exists(os.path.join(model_folder, JOURNAL_FILE_NAME))
+
+
+def fetch_file(
+    source: str,
+    destination: str,
+    progress: typing.Optional[typing.Callable[[int, int], None]] = None,
+    cancel: typing.Optional[threading.Event] = None,
+) -> None:
+    """Streams a file to disk, resuming a previous partial transfer if possible.
+
+    The bytes are written to destination + ".part" as they arrive; if that file already exists
+    the transfer continues from its end with an HTTP Range request. The file is renamed to
+    destination once complete. A server sending nothing for DOWNLOAD_TIMEOUT seconds fails the
+    transfer with a timeout, which is also when a cancelled transfer of a stalled server stops.
+    Args:
+        source: string, url or local path of the file
+        destination: string, path of the downloaded file
+        progress: function called with (bytes received, expected file size or 0 if unknown)
+        cancel: event, when set the transfer stops with DownloadCancelled, keeping the partial file
+    """
+    partial_file = destination + PARTIAL_SUFFIX
+    if not source.startswith(("http://", "https://")):
+        shutil.copyfile(source, partial_file)
+        os.replace(partial_file, destination)
+        if progress is not None:
+            size = os.path.getsize(destination)
+            progress(size, size)
+        return
+
+    offset = os.path.getsize(partial_file) if os.path.exists(partial_file) else 0
+    request = urllib.request.Request(source)
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
+    try:
+        response = urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as excep:
+        if excep.code != 416 or not offset:
+            raise
+        # the partial file cannot be resumed, start over
+        os.remove(partial_file)
+        offset = 0
+        response = urllib.request.urlopen(urllib.request.Request(source), timeout=DOWNLOAD_TIMEOUT)
+
+    with response:
+        if offset and response.status != 206:
+            # the server ignored the Range header and sends the whole file
+            offset = 0
+        length = int(response.headers.get("Content-Length") or 0)
+        size = offset + length if length else 0
+        if progress is not None and offset:
+            progress(offset, size)
+        received = offset
+        with open(partial_file, "ab" if offset else "wb") as f:
+            while True:
+                _check_cancelled(cancel)
+                # whatever has arrived, so a stalled transfer keeps the bytes received so far
+                chunk = response.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                received += len(chunk)
+                if progress is not None:
+                    progress(len(chunk), size)
+        if size and received < size:
+            # the connection was closed early, unlike read(), read1() does not raise
+            raise http.client.IncompleteRead(b"", size - received)
+    os.replace(partial_file, destination)
+
+
+def fetch_package(
+    model_id: str,
+    model_folder: str,
+    weight_formats: typing.Optional[typing.Sequence[str]] = None,
+    progress: typing.Optional[typing.Callable[[str, int, int], None]] = None,
+    cancel: typing.Optional[threading.Event] = None,
+    blobs: typing.Optional[BlobStore] = None,
+) -> None:
+    """Downloads the files of a model package straight into model_folder.
+
+    Files are streamed one by one to their final location, so no zip archive is written and the
+    disk usage stays that of the installed model. Progress is recorded in a journal inside the
+    folder: calling this function again after an interruption skips the files already downloaded
+    and resumes the partial one. The rdf.yaml is written last, so an interrupted download is never
+    listed as an installed model.
+    Once all the files are there, they are hashed concurrently and checked against the sha256 the
+    rdf.yaml declares; a mismatching file is deleted and ChecksumError raised, so that a new call
+    downloads it again.
+    With a blob store, every downloaded file is stored by sha256 and linked into the folder, and
+    the files whose sha256 is declared by the rdf.yaml and already stored are linked instead of
+    downloaded.
+    Args:
+        model_id: string, id of the model (including the version)
+        model_folder: string, directory to download the model to
+        weight_formats: list of weight formats by order of preference, only the first one available is downloaded
+        progress: function called with (file name, bytes received, expected file size or 0 if unknown)
+        cancel: event, when set the download stops with DownloadCancelled and can be resumed later
+        blobs: content-addressed store used to deduplicate the files, None to store plain files
+    """
+    os.makedirs(model_folder, exist_ok=True)
+    journal_file = os.path.join(model_folder, JOURNAL_FILE_NAME)
+    weight_formats = list(weight_formats) if weight_formats else None
+    journal = _read_journal(journal_file)
+    if journal.get("model_id") != model_id or journal.get("weight_formats") != weight_formats:
+        journal = {"model_id": model_id, "weight_formats": weight_formats, "done": []}
+    _write_journal(journal_file, journal)
+
+    content = get_package_content(model_id, weight_formats)
+    rdf = content.pop("rdf")
+    if not isinstance(rdf, str):
+        rdf = bioimageio.spec.serialize_raw_resource_description(rdf)
+    hashes = declared_hashes(rdf)
+
+    to_verify = []
+    for file_name, source in content.items():
+        _check_cancelled(cancel)
+        destination = os.path.join(model_folder, file_name)
+        if file_name in journal["done"] and os.path.exists(destination):
+            if progress is not None:
+                size = os.path.getsize(destination)
+                progress(file_name, size, size)
+            to_verify.append(file_name)
+            continue
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if blobs is not None and file_name in hashes and blobs.materialize(hashes[file_name], destination):
+            if progress is not None:
+                size = os.path.getsize(destination)
+                progress(file_name, size, size)
+        else:
+            file_progress = None
+            if progress is not None:
+                file_progress = lambda received, size, file_name=file_name: progress(file_name, received, size)
+            fetch_file(str(source), destination, progress=file_progress, cancel=cancel)
+            to_verify.append(file_name)
+        journal["done"].append(file_name)
+        _write_journal(journal_file, journal)
+
+    _check_cancelled(cancel)
+    digests = hash_files([os.path.join(model_folder, file_name) for file_name in to_verify])
+    for file_name, digest in zip(to_verify, digests):
+        if file_name in hashes and hashes[file_name].lower() != digest:
+            os.remove(os.path.join(model_folder, file_name))
+            journal["done"].remove(file_name)
+            _write_journal(journal_file, journal)
+            raise ChecksumError(f"{file_name} of {model_id} does not match its sha256 {hashes[file_name]}")
+    if blobs is not None:
+        for file_name, digest in zip(to_verify, digests):
+            blobs.add(os.path.join(model_folder, file_name), digest)
+
+    with open(os.path.join(model_folder, "rdf.yaml"), "w", encoding="utf-8") as f:
+        f.write(rdf)
+    os.remove(journal_file)
+
+
+def staging_folder(model_folder: str) -> str:
+    """Gets the hidden sibling directory a model is downloaded to before being swapped in."""
+    parent, version = os.path.split(os.path.normpath(model_folder))
+    return os.path.join(parent, "." + version + STAGING_SUFFIX)
+
+
+def swap_in(staging: str, model_folder: str) -> None:
+    """Replaces model_folder by the fully downloaded staging directory.
+
+    Each step is a rename, so model_folder is at any time either the complete previous
+    install, the complete new one, or briefly missing, but never half populated. While it is
+    missing, the previous install sits next to it, see swap_in_progress().
+    Args:
+        staging: string, path of the staging directory
+        model_folder: string, path of the installed model directory
+    """
+    if not os.path.exists(model_folder):
+        os.rename(staging, model_folder)
+        return
+
+    parent, version = os.path.split(os.path.normpath(model_folder))
+    old_folder = os.path.join(parent, f".{version}{OLD_SUFFIX}{uuid.uuid4().hex}")
+    os.rename(model_folder, old_folder)
+    os.rename(staging, model_folder)
+    shutil.rmtree(old_folder, ignore_errors=True)
+
+
+def swap_in_progress(model_folder: str) -> bool:
+    """Tells if the previous install of model_folder was renamed aside by swap_in().
+
+    Either swap_in() is about to rename the new install into place, or it was interrupted and
+    sweep_staging() will remove the previous install.
+    """
+    parent, version = os.path.split(os.path.normpath(model_folder))
+    prefix = f".{version}{OLD_SUFFIX}"
+    try:
+        with os.scandir(parent) as it:
+            return any(entry.name.startswith(prefix) for entry in it)
+    except OSError:
+        return False
+
+
+def _last_modified(folder: str) -> float:
+    last_modified = os.stat(folder).st_mtime
+    for entry in os.scandir(folder):
+        try:
+            last_modified = max(last_modified, entry.stat(follow_symlinks=False).st_mtime)
+        except OSError:
+            continue
+    return last_modified
+
+
+def sweep_staging(parent_directories: typing.Iterable[str], max_age: float = STAGING_MAX_AGE) -> int:
+    """Removes the leftovers of interrupted installs from the directories holding model versions.
+
+    The staging directories and the replaced installs are hidden siblings of the version
+    directories, so only the directories given are listed, not the whole models directory.
+    Replaced installs that could not be deleted are always removed. Staging directories are kept
+    for a later resume unless nothing was written to them for max_age seconds.
+    Args:
+        parent_directories: list of paths of the directories holding the version directories of
+            a model, e.g. [models directory]/10.5281/zenodo.6200999
+        max_age: float, seconds after which an untouched staging directory is considered orphaned
+    Returns:
+        Number of directories removed
+    """
+    removed = 0
+    now = time.time()
+    for directory in parent_directories:
+        try:
+            with os.scandir(directory) as it:
+                # the staging directories and the replaced installs are hidden
+                names = [entry.name for entry in it if entry.name.startswith(".") and entry.is_dir()]
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                orphaned = OLD_SUFFIX in name or (
+                    name.endswith(STAGING_SUFFIX) and now - _last_modified(path) > max_age
+                )
+            except OSError:
+                continue
+            if orphaned:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+    return removed
+
+
+class DownloadJob:
+    """Download of one model handled by a DownloadManager.
+
+    The state goes from "queued" to "running" and ends as "done", "failed" or "cancelled".
+    Byte counts only include the files whose transfer has started, as the package size is not
+    known upfront.
+    """
+
+    def __init__(self, model_id: str, overwrite: bool, weight_formats: typing.Optional[typing.Sequence[str]] = None):
+        self.model_id = model_id
+        self.overwrite = overwrite
+        self.weight_formats = weight_formats
+        self.state = "queued"
+        self.error: typing.Optional[str] = None
+        self.attempts = 0
+        self.result: typing.Any = None
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self.started_at: typing.Optional[float] = None
+        self.finished_at: typing.Optional[float] = None
+        self._file_sizes: typing.Dict[str, int] = {}
+        self._cancel = threading.Event()
+        self._finished = threading.Event()
+
+    def __repr__(self) -> str:
+        return f"DownloadJob({self.model_id!r}, state={self.state!r})"
+
+    @property
+    def throughput(self) -> float:
+        """Average transfer rate in bytes per second."""
+        if self.started_at is None:
+            return 0.0
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return self.bytes_done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self._finished.is_set()
+
+    def cancel(self) -> None:
+        """Requests the download to stop, files already downloaded are kept for a later resume.
+
+        A transfer stalled on the server stops once it times out, after DOWNLOAD_TIMEOUT seconds,
+        which frees its worker and the install lock of the model.
+        """
+        self._cancel.set()
+
+    def wait(self, timeout: typing.Optional[float] = None) -> bool:
+        """Waits for the job to finish.
+
+        Args:
+            timeout: float, maximum time to wait in seconds, None to wait forever
+        Returns:
+            True if the job finished
+        """
+        return self._finished.wait(timeout)
+
+    def _progress(self, file_name: str, received: int, size: int) -> None:
+        if size and self._file_sizes.get(file_name) != size:
+            self.bytes_total += size - self._file_sizes.get(file_name, 0)
+            self._file_sizes[file_name] = size
+        self.bytes_done += received
+
+
+class DownloadManager:
+    """Queue of model downloads processed by a pool of worker threads.
+
+    Each job is retried with an exponential backoff when it fails with a transient error (see
+    is_transient()), a retry resuming the transfer where it stopped; other errors fail it at once.
+    Listeners are called from the worker threads with the job whose progress or state changed,
+    at most every PROGRESS_INTERVAL seconds for progress updates.
+    """
+
+    def __init__(
+        self,
+        install: typing.Callable[..., typing.Any],
+        max_workers: int = 3,
+        retries: int = 3,
+        backoff: float = 1.0,
+    ):
+        """Creates the manager, the worker threads are started on the first submitted job.
+
+        Args:
+            install: function installing a model, called as
+                install(model_id, overwrite, weight_formats=..., progress=..., cancel=...)
+            max_workers: int, number of models downloaded in parallel
+            retries: int, number of retries of a download failed with a transient error
+            backoff: float, seconds to wait before the first retry, doubled on each retry
+        """
+        self.install = install
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self._queue: "queue.Queue[DownloadJob]" = queue.Queue()
+        self._jobs: typing.Dict[str, DownloadJob] = {}
+        self._listeners: typing.List[typing.Callable[[DownloadJob], None]] = []
+        self._workers: typing.List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener: typing.Callable[[DownloadJob], None]) -> None:
+        with self._lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener: typing.Callable[[DownloadJob], None]) -> None:
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def jobs(self) -> typing.List[DownloadJob]:
+        """Gets the jobs that are queued or running."""
+        with self._lock:
+            return list(self._jobs.values())
+
+    def submit(
+        self, model_id: str, overwrite: bool = False, weight_formats: typing.Optional[typing.Sequence[str]] = None
+    ) -> DownloadJob:
+        """Queues the download of a model.
+
+        Args:
+            model_id: string, id of the model (including the version)
+            overwrite: bool, true to force re-install
+            weight_formats: list of weight formats by order of preference, None to download all of them
+        Returns:
+            Job of the download, the already queued or running one if the model is being downloaded
+        """
+        with self._lock:
+            job = self._jobs.get(model_id)
+            if job is not None:
+                return job
+            job = DownloadJob(model_id, overwrite, weight_formats)
+            self._jobs[model_id] = job
+            while len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work, name="DownloadManager", daemon=True)
+                self._workers.append(worker)
+                worker.start()
+        self._queue.put(job)
+        self._notify(job)
+        return job
+
+    def _notify(self, job: DownloadJob) -> None:
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(job)
+            except Exception as excep:
+                print("Download listener failed:", str(excep))
+
+    def _run(self, job: DownloadJob) -> None:
+        last_notified = 0.0
+
+        def progress(file_name, received, size):
+            nonlocal last_notified
+            job._progress(file_name, received, size)
+            now = time.time()
+            if now - last_notified >= PROGRESS_INTERVAL:
+                last_notified = now
+                self._notify(job)
+
+        job.state = "running"
+        job.started_at = time.time()
+        self._notify(job)
+        while True:
+            job.attempts += 1
+            try:
+                job.result = self.install(
+                    job.model_id,
+                    job.overwrite,
+                    weight_formats=job.weight_formats,
+                    progress=progress,
+                    cancel=job._cancel,
+                )
+                job.state = "done"
+                return
+            except DownloadCancelled:
+                job.state = "cancelled"
+                return
+            except Exception as excep:
+                job.error = str(excep)
+                if job.attempts > self.retries or not is_transient(excep):
+                    print("Could not download model:", job.model_id, job.error)
+                    job.state = "failed"
+                    return
+                # a retry resumes the download, only count the bytes received from now on
+                job.bytes_done, job.bytes_total, job._file_sizes = 0, 0, {}
+                if job._cancel.wait(self.backoff * 2 ** (job.attempts - 1)):
+                    job.state = "cancelled"
+                    return
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            try:
+                if job._cancel.is_set():
+                    job.state = "cancelled"
+                else:
+                    self._run(job)
+            finally:
+                job.finished_at = time.time()
+                with self._lock:
+                    self._jobs.pop(job.model_id, None)
+                job._finished.set()
+                self._notify(job)
+                self._queue.task_done()
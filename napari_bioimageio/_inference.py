@@ -0,0 +1,172 @@
+"""Worker running model inference in a QThread, off the napari GUI thread."""
+
+import threading
+import typing
+
+from qtpy.QtCore import QObject, QThread, Signal, Slot
+
+from ._tiling import PredictionCancelled
+
+
+class InferenceWorker(QObject):
+    """Runs function(*args, progress=..., cancel=..., **kwargs) once moved to a QThread.
+
+    The function reports its progress by calling progress(stage, done, total), e.g. once per tile
+    or per processing stage, and should stop with PredictionCancelled when the cancel event is set
+    (predict_tiled() does both when given them).
+    """
+
+    progress = Signal(str, int, int)
+    result = Signal(object)
+    error = Signal(object)
+    cancelled = Signal()
+    finished = Signal()
+
+    def __init__(self, function: typing.Callable[..., typing.Any], *args, **kwargs):
+        super().__init__()
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.cancel_event = threading.Event()
+
+    def report(self, stage: str, done: int, total: int) -> None:
+        self.progress.emit(stage, done, total)
+
+    def run(self) -> None:
+        try:
+            result = self.function(*self.args, progress=self.report, cancel=self.cancel_event, **self.kwargs)
+        except PredictionCancelled:
+            self.cancelled.emit()
+        except Exception as excep:
+            if self.cancel_event.is_set():
+                self.cancelled.emit()
+            else:
+                print("Inference failed:", str(excep))
+                self.error.emit(excep)
+        else:
+            if self.cancel_event.is_set():
+                self.cancelled.emit()
+            else:
+                self.result.emit(result)
+        self.finished.emit()
+
+
+class InferenceJob(QObject):
+    """Handle of an inference running in a QThread, delivering its outcome on the GUI thread.
+
+    The callbacks are called from this object's slots; as it lives in the thread that started the
+    job (the GUI thread), they run there and may update the viewer.
+    """
+
+    def __init__(
+        self,
+        worker: InferenceWorker,
+        on_result: typing.Optional[typing.Callable[[typing.Any], None]] = None,
+        on_progress: typing.Optional[typing.Callable[[str, int, int], None]] = None,
+        on_error: typing.Optional[typing.Callable[[Exception], None]] = None,
+        on_cancelled: typing.Optional[typing.Callable[[], None]] = None,
+        on_finished: typing.Optional[typing.Callable[[], None]] = None,
+    ):
+        super().__init__()
+        self.worker = worker
+        self.on_result = on_result
+        self.on_progress = on_progress
+        self.on_error = on_error
+        self.on_cancelled = on_cancelled
+        self.on_finished = on_finished
+        self.running = False
+        self.thread = QThread()
+        self.worker.moveToThread(self.thread)
+
+        self.thread.started.connect(self.worker.run)
+        self.worker.progress.connect(self._progress)
+        self.worker.result.connect(self._result)
+        self.worker.error.connect(self._error)
+        self.worker.cancelled.connect(self._cancelled)
+        self.worker.finished.connect(self._finished)
+        self.worker.finished.connect(self.thread.quit)
+        self.worker.finished.connect(self.worker.deleteLater)
+        # the QThread belongs to the job, which is kept alive until the thread has really stopped:
+        # destroying a QThread that is still running aborts the process
+        self.thread.finished.connect(self._thread_finished)
+
+    def start(self) -> "InferenceJob":
+        self.running = True
+        _running_jobs.add(self)
+        self.thread.start()
+        return self
+
+    def cancel(self) -> None:
+        """Asks the inference to stop, on_cancelled is called once it did."""
+        self.worker.cancel_event.set()
+
+    @Slot(str, int, int)
+    def _progress(self, stage: str, done: int, total: int) -> None:
+        if self.on_progress is not None:
+            self.on_progress(stage, done, total)
+
+    @Slot(object)
+    def _result(self, result: typing.Any) -> None:
+        if self.on_result is not None:
+            self.on_result(result)
+
+    @Slot(object)
+    def _error(self, excep: Exception) -> None:
+        if self.on_error is not None:
+            self.on_error(excep)
+
+    @Slot()
+    def _cancelled(self) -> None:
+        if self.on_cancelled is not None:
+            self.on_cancelled()
+
+    @Slot()
+    def _finished(self) -> None:
+        self.running = False
+        if self.on_finished is not None:
+            self.on_finished()
+
+    @Slot()
+    def _thread_finished(self) -> None:
+        _running_jobs.discard(self)
+
+
+# keeps the running jobs alive until their thread stopped, whether or not the caller holds them
+_running_jobs: typing.Set[InferenceJob] = set()
+
+
+def run_inference(
+    function: typing.Callable[..., typing.Any],
+    *args,
+    on_result: typing.Optional[typing.Callable[[typing.Any], None]] = None,
+    on_progress: typing.Optional[typing.Callable[[str, int, int], None]] = None,
+    on_error: typing.Optional[typing.Callable[[Exception], None]] = None,
+    on_cancelled: typing.Optional[typing.Callable[[], None]] = None,
+    on_finished: typing.Optional[typing.Callable[[], None]] = None,
+    **kwargs,
+) -> InferenceJob:
+    """Runs an inference function in a background QThread, keeping napari responsive.
+
+    Must be called from the GUI thread. function is called as
+    function(*args, progress=progress, cancel=cancel, **kwargs) and its return value is given to
+    on_result; all the callbacks are called on the GUI thread, where the results can be added to
+    the viewer.
+    Args:
+        function: callable running the models, e.g. with use_pipeline() and predict_tiled()
+        on_result: function called with the return value of function
+        on_progress: function called with (stage name, steps done, number of steps)
+        on_error: function called with the exception raised by function
+        on_cancelled: function called when the inference stopped after cancel()
+        on_finished: function called last, whatever the outcome
+    Returns:
+        The running job, whose cancel() method stops the inference
+    """
+    worker = InferenceWorker(function, *args, **kwargs)
+    return InferenceJob(
+        worker,
+        on_result=on_result,
+        on_progress=on_progress,
+        on_error=on_error,
+        on_cancelled=on_cancelled,
+        on_finished=on_finished,
+    ).start()
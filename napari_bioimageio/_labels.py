@@ -0,0 +1,103 @@
+"""Measurements of the objects of a label image, in one pass over the image."""
+
+import typing
+
+import numpy as np
+from scipy.ndimage import find_objects
+
+# pixels read at once when summing the coordinates, bounding the memory of the coordinate arrays
+MEASURE_CHUNK_PIXELS = 1 << 24
+
+
+class LabelTable(typing.NamedTuple):
+    """Measurements of each object of a label image, one row per label present, by increasing label."""
+
+    labels: np.ndarray  # (objects,) label of each object
+    sizes: np.ndarray  # (objects,) number of pixels
+    bboxes: np.ndarray  # (objects, 2 * dimensions) min then max (exclusive) coordinates, as regionprops' bbox
+    centroids: np.ndarray  # (objects, dimensions) mean coordinates
+    border: np.ndarray  # (objects,) whether the object touches the image border
+
+    def index(self, labels: typing.Any) -> np.ndarray:
+        """Gets the rows of labels in the table."""
+        return np.searchsorted(self.labels, labels)
+
+
+def measure_labels(labels: np.ndarray) -> LabelTable:
+    """Measures the size, bounding box, centroid and border contact of every object of a label image.
+
+    Replaces np.unique(..., return_counts=True), border masks and regionprops: the sizes and
+    coordinate sums come from np.bincount, read a few rows at a time, the bounding boxes from
+    scipy.ndimage.find_objects and the border contact from the border pixels only, so no full
+    size temporary image is allocated.
+    Args:
+        labels: array of non negative integer labels, 0 being the background
+    Returns:
+        LabelTable with one row per label present in the image
+    """
+    labels = np.asarray(labels)
+    if labels.size == 0:
+        return _empty_table(labels.ndim)
+    count = int(labels.max()) + 1
+    sizes = np.zeros(count, dtype=np.int64)
+    sums = np.zeros((labels.ndim, count), dtype=np.float64)
+    row_pixels = max(1, labels.size // labels.shape[0])
+    rows = max(1, MEASURE_CHUNK_PIXELS // row_pixels)
+    for start in range(0, labels.shape[0], rows):
+        chunk = labels[start : start + rows]
+        flat = chunk.ravel()
+        sizes += np.bincount(flat, minlength=count)
+        for axis in range(labels.ndim):
+            coords = np.arange(chunk.shape[axis], dtype=np.float64) + (start if axis == 0 else 0)
+            shape = [1] * labels.ndim
+            shape[axis] = chunk.shape[axis]
+            weights = np.broadcast_to(coords.reshape(shape), chunk.shape).ravel()
+            sums[axis] += np.bincount(flat, weights=weights, minlength=count)
+
+    present = np.flatnonzero(sizes[1:]) + 1
+    objects = find_objects(labels, max_label=count - 1) if count > 1 else []
+    bboxes = np.array(
+        [[s.start for s in objects[label - 1]] + [s.stop for s in objects[label - 1]] for label in present],
+        dtype=np.intp,
+    ).reshape(-1, 2 * labels.ndim)
+
+    touching = np.zeros(count, dtype=bool)
+    for axis in range(labels.ndim):
+        touching[np.take(labels, 0, axis=axis)] = True
+        touching[np.take(labels, -1, axis=axis)] = True
+
+    return LabelTable(
+        labels=present,
+        sizes=sizes[present],
+        bboxes=bboxes,
+        centroids=(sums[:, present] / sizes[present]).T,
+        border=touching[present],
+    )
+
+
+def _empty_table(ndim: int) -> LabelTable:
+    return LabelTable(
+        labels=np.zeros(0, dtype=np.intp),
+        sizes=np.zeros(0, dtype=np.int64),
+        bboxes=np.zeros((0, 2 * ndim), dtype=np.intp),
+        centroids=np.zeros((0, ndim), dtype=np.float64),
+        border=np.zeros(0, dtype=bool),
+    )
+
+
+def remove_labels(labels: np.ndarray, removed: typing.Any) -> np.ndarray:
+    """Sets the pixels of some labels to 0, in place, with a lookup table instead of np.isin.
+
+    Args:
+        labels: array of non negative integer labels
+        removed: list of the labels to remove
+    Returns:
+        labels
+    """
+    removed = np.asarray(removed, dtype=np.intp)
+    if removed.size == 0 or labels.size == 0:
+        return labels
+    lookup = np.arange(int(labels.max()) + 1, dtype=labels.dtype)
+    lookup[removed[removed < len(lookup)]] = 0
+    np.take(lookup, labels, out=labels)
+    return labels
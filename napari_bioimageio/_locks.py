@@ -0,0 +1,173 @@
+"""Advisory locks coordinating the processes and threads sharing a models directory."""
+
+import contextlib
+import os
+import threading
+import time
+import typing
+
+try:
+    import fcntl
+except ImportError:  # no flock on Windows, the locks then only coordinate the threads of this process
+    fcntl = None
+
+LOCKS_DIRECTORY_NAME = ".locks"
+LOCK_POLL_INTERVAL = 0.1
+
+
+class ModelLockedError(RuntimeError):
+    """Raised when a model version cannot be locked because another thread or process uses it."""
+
+
+class _ThreadLock:
+    """Shared/exclusive lock between the threads of this process."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+
+    def acquire(self, shared: bool, blocking: bool) -> bool:
+        with self.condition:
+            while self.writer or (not shared and self.readers):
+                if not blocking:
+                    return False
+                self.condition.wait(LOCK_POLL_INTERVAL)
+            if shared:
+                self.readers += 1
+            else:
+                self.writer = True
+            return True
+
+    def release(self, shared: bool) -> None:
+        with self.condition:
+            if shared:
+                self.readers -= 1
+            else:
+                self.writer = False
+            self.condition.notify_all()
+
+
+_thread_locks: typing.Dict[str, _ThreadLock] = {}
+_thread_locks_lock = threading.Lock()
+
+
+def _thread_lock(lock_file: str) -> _ThreadLock:
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(lock_file, _ThreadLock())
+
+
+class FileLock:
+    """Shared/exclusive advisory lock held on a file, between processes (flock) and threads.
+
+    Each acquisition opens its own file descriptor, so the lock can be held several times in
+    shared mode, by several threads or processes. Lock files are never deleted: deleting a lock
+    file while another process waits on it would let two processes hold the lock.
+    """
+
+    def __init__(self, lock_file: str):
+        self.lock_file = os.path.abspath(lock_file)
+        self._fd: typing.Optional[int] = None
+        self._shared = False
+
+    def acquire(
+        self, shared: bool = False, blocking: bool = True, cancel: typing.Optional[threading.Event] = None
+    ) -> bool:
+        """Acquires the lock.
+
+        Args:
+            shared: bool, true for a shared lock, false for an exclusive one
+            blocking: bool, false to return immediately if the lock is held
+            cancel: event, when set a blocking acquisition gives up and returns False
+        Returns:
+            True if the lock was acquired
+        """
+        thread_lock = _thread_lock(self.lock_file)
+        while not thread_lock.acquire(shared, blocking=False):
+            if not blocking or (cancel is not None and cancel.is_set()):
+                return False
+            time.sleep(LOCK_POLL_INTERVAL)
+
+        if fcntl is None:
+            self._shared = shared
+            return True
+
+        try:
+            os.makedirs(os.path.dirname(self.lock_file), exist_ok=True)
+            fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o666)
+        except OSError:
+            thread_lock.release(shared)
+            raise
+        mode = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB
+        while True:
+            try:
+                fcntl.flock(fd, mode)
+                break
+            except BlockingIOError:
+                if not blocking or (cancel is not None and cancel.is_set()):
+                    os.close(fd)
+                    thread_lock.release(shared)
+                    return False
+                time.sleep(LOCK_POLL_INTERVAL)
+        self._fd = fd
+        self._shared = shared
+        return True
+
+    def release(self) -> None:
+        """Releases the lock."""
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        _thread_lock(self.lock_file).release(self._shared)
+
+
+def lock_file(models_directory: str, model_id: str, kind: str) -> str:
+    """Gets the path of the file locking a model version.
+
+    Args:
+        models_directory: string, path of the models directory
+        model_id: string, id of the model version, relative to the models directory
+        kind: string, "install" for the lock serializing downloads, "use" for the one held by loaders
+    """
+    parts = [part for part in str(model_id).split("/") if part]
+    return os.path.join(models_directory, LOCKS_DIRECTORY_NAME, *parts) + f".{kind}.lock"
+
+
+def locked_model_ids(models_directory: str, kind: str) -> typing.List[str]:
+    """Lists the model versions that ever had a lock of a kind, e.g. every version whose install started.
+
+    Args:
+        models_directory: string, path of the models directory
+        kind: string, "install" or "use"
+    Returns:
+        List of the ids of the model versions, relative to the models directory
+    """
+    locks_directory = os.path.join(models_directory, LOCKS_DIRECTORY_NAME)
+    suffix = f".{kind}.lock"
+    model_ids = []
+    for directory, _, files in os.walk(locks_directory):
+        rel_dir = os.path.relpath(directory, locks_directory)
+        for file_name in files:
+            if file_name.endswith(suffix):
+                version = file_name[: -len(suffix)]
+                model_ids.append(version if rel_dir == "." else "/".join(rel_dir.split(os.sep) + [version]))
+    return sorted(model_ids)
+
+
+@contextlib.contextmanager
+def locked(
+    path: str, shared: bool = False, blocking: bool = True, cancel: typing.Optional[threading.Event] = None
+) -> typing.Iterator[None]:
+    """Context manager holding a FileLock.
+
+    Raises:
+        ModelLockedError: if the lock could not be acquired without blocking, or cancel was set
+    """
+    lock = FileLock(path)
+    if not lock.acquire(shared=shared, blocking=blocking, cancel=cancel):
+        raise ModelLockedError(f"{path} is locked by another thread or process")
+    try:
+        yield
+    finally:
+        lock.release()
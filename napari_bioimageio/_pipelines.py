@@ -0,0 +1,319 @@
+"""Process-wide cache of loaded models and of their live prediction pipelines."""
+
+import collections
+import contextlib
+import os
+import threading
+import typing
+
+import bioimageio.core
+
+from . import _usage, _utils
+from ._locks import FileLock, lock_file
+
+# the HPA single cell workflow runs three models: nucleus, cell and classification
+PIPELINES_DEFAULT = 3
+
+
+def set_max_pipelines(max_pipelines: int) -> None:
+    """Sets the number of prediction pipelines kept loaded when not in use.
+
+    Args:
+        max_pipelines: int, number of warm pipelines, 0 to unload every pipeline once released
+    """
+    os.environ["BIOIMAGEIO_NAPARI_PIPELINES"] = str(max_pipelines)
+
+
+def get_max_pipelines() -> int:
+    """Gets the number of prediction pipelines kept loaded when not in use."""
+    try:
+        return max(0, int(os.environ.get("BIOIMAGEIO_NAPARI_PIPELINES", PIPELINES_DEFAULT)))
+    except ValueError:
+        return PIPELINES_DEFAULT
+
+
+def set_pipelines_memory(memory: typing.Union[int, str, None]) -> None:
+    """Sets the memory the warm prediction pipelines may hold, as estimated from their weights.
+
+    Args:
+        memory: int, bytes, or string with a K, M, G or T suffix (e.g. "4G"); None for no limit
+    """
+    os.environ["BIOIMAGEIO_NAPARI_PIPELINES_MEMORY"] = "" if memory is None else str(memory)
+
+
+def get_pipelines_memory() -> typing.Optional[int]:
+    """Gets the memory in bytes the warm prediction pipelines may hold, None if unlimited."""
+    try:
+        return _usage.parse_size(os.environ.get("BIOIMAGEIO_NAPARI_PIPELINES_MEMORY"))
+    except ValueError:
+        return None
+
+
+class _CachedPipeline:
+    def __init__(self, key: typing.Tuple, rdf_mtime_ns: int):
+        self.key = key
+        self.rdf_mtime_ns = rdf_mtime_ns
+        self.model = None
+        self.pipeline = None
+        self.size = 0
+        self.users = 0
+        self.lock: typing.Optional[FileLock] = None
+        self.loaded = threading.Event()
+        self.error: typing.Optional[BaseException] = None
+
+
+def _unload(entry: _CachedPipeline) -> None:
+    try:
+        if entry.pipeline is not None and hasattr(entry.pipeline, "unload"):
+            entry.pipeline.unload()
+    except Exception as excep:
+        print("Could not unload the prediction pipeline:", str(excep))
+    finally:
+        entry.pipeline = None
+        entry.model = None
+        if entry.lock is not None:
+            entry.lock.release()
+            entry.lock = None
+
+
+class PipelineCache:
+    """Prediction pipelines kept loaded between runs, keyed by model version, weight format and devices.
+
+    A pipeline is checked out with get() and given back with release() (or both at once with the
+    use() context manager); while checked out it is never unloaded, and it can be checked out by
+    several users at once. Released pipelines stay loaded, so that running the same model again
+    only costs the inference, and the least recently used ones are unloaded once there are more
+    than max_pipelines of them or their estimated memory exceeds max_memory.
+    A cached model holds the shared "use" lock of its version, so it cannot be removed meanwhile;
+    a pipeline is loaded again if its rdf.yaml changed since (e.g. the model was reinstalled).
+    """
+
+    def __init__(self, max_pipelines: typing.Optional[int] = None, max_memory: typing.Optional[int] = None):
+        self.max_pipelines = get_max_pipelines() if max_pipelines is None else max_pipelines
+        self.max_memory = get_pipelines_memory() if max_memory is None else max_memory
+        self._lock = threading.Lock()
+        self._entries: "collections.OrderedDict[typing.Tuple, _CachedPipeline]" = collections.OrderedDict()
+        self._checked_out: typing.Dict[int, _CachedPipeline] = {}
+
+    @staticmethod
+    def _key(model_id: str, weight_format: typing.Optional[str], devices: typing.Optional[typing.Sequence[str]]):
+        return (_utils._model_folder_id(model_id).strip("/"), weight_format, tuple(devices) if devices else None)
+
+    def _load(self, entry: _CachedPipeline, model_id: str) -> None:
+        folder_id, weight_format, devices = entry.key
+        models_directory = _utils.get_models_path()
+        entry.lock = FileLock(lock_file(models_directory, folder_id, "use"))
+        entry.lock.acquire(shared=True)
+        try:
+            entry.model = _utils.load_model(model_id)
+            if entry.model is None:
+                raise FileNotFoundError(f"Model {model_id} is not installed")
+            entry.pipeline = bioimageio.core.create_prediction_pipeline(
+                bioimageio_model=entry.model,
+                devices=list(devices) if devices else None,
+                weight_format=weight_format,
+            )
+            # the weights dominate the memory of a pipeline, estimate it by their size on disk
+            entry.size = _usage.folder_usage(os.path.join(models_directory, folder_id))[0]
+        except BaseException:
+            _unload(entry)
+            raise
+
+    def _evict(self) -> typing.List[_CachedPipeline]:
+        # called with the lock held, returns the entries to unload once it is released
+        evicted = []
+        idle = [entry for entry in self._entries.values() if entry.users == 0 and entry.loaded.is_set()]
+        while idle and (
+            len(self._entries) > self.max_pipelines
+            or (self.max_memory is not None and sum(e.size for e in self._entries.values()) > self.max_memory)
+        ):
+            entry = idle.pop(0)
+            del self._entries[entry.key]
+            evicted.append(entry)
+        return evicted
+
+    def get(
+        self,
+        model_id: str,
+        weight_format: typing.Optional[str] = None,
+        devices: typing.Optional[typing.Sequence[str]] = None,
+    ) -> typing.Any:
+        """Checks out the prediction pipeline of a model, loading it only if it is not cached.
+
+        Args:
+            model_id: string, id of the model, as given to load_model_by_id()
+            weight_format: string, weight format to run, None to let bioimageio.core choose
+            devices: list of device names (e.g. ["cuda"]), None to let bioimageio.core choose
+        Returns:
+            The prediction pipeline, to give back with release()
+        """
+        key = self._key(model_id, weight_format, devices)
+        rdf_file = os.path.join(_utils.get_models_path(), key[0], "rdf.yaml")
+        rdf_mtime_ns = os.stat(rdf_file).st_mtime_ns if os.path.exists(rdf_file) else 0
+        stale = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.loaded.is_set() and entry.rdf_mtime_ns != rdf_mtime_ns:
+                del self._entries[key]
+                stale, entry = (entry if entry.users == 0 else None), None
+            owner = entry is None
+            if owner:
+                entry = self._entries[key] = _CachedPipeline(key, rdf_mtime_ns)
+            entry.users += 1
+            self._entries.move_to_end(key)
+        if stale is not None:
+            _unload(stale)
+
+        if owner:
+            try:
+                self._load(entry, model_id)
+            except BaseException as excep:
+                entry.error = excep
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+                raise
+            finally:
+                entry.loaded.set()
+        else:
+            entry.loaded.wait()
+            if entry.error is not None:
+                raise entry.error
+            _utils.get_usage_log().touch(key[0])
+
+        with self._lock:
+            self._checked_out[id(entry.pipeline)] = entry
+            evicted = self._evict()
+        for old_entry in evicted:
+            _unload(old_entry)
+        return entry.pipeline
+
+    def release(self, pipeline: typing.Any) -> None:
+        """Gives back a pipeline checked out with get(), letting it be unloaded when needed."""
+        with self._lock:
+            entry = self._checked_out.get(id(pipeline))
+            if entry is None:
+                return
+            entry.users -= 1
+            if entry.users == 0:
+                del self._checked_out[id(pipeline)]
+            if entry.users == 0 and self._entries.get(entry.key) is not entry:
+                # replaced or discarded while checked out
+                evicted = [entry]
+            else:
+                evicted = self._evict()
+        for old_entry in evicted:
+            _unload(old_entry)
+
+    @contextlib.contextmanager
+    def use(
+        self,
+        model_id: str,
+        weight_format: typing.Optional[str] = None,
+        devices: typing.Optional[typing.Sequence[str]] = None,
+    ) -> typing.Iterator[typing.Any]:
+        """Context manager checking out a pipeline with get() and releasing it on exit."""
+        pipeline = self.get(model_id, weight_format, devices)
+        try:
+            yield pipeline
+        finally:
+            self.release(pipeline)
+
+    def model_id(self, pipeline: typing.Any) -> typing.Optional[str]:
+        """Gets the id of the model version of a checked out pipeline, None if it is not from this cache."""
+        with self._lock:
+            entry = self._checked_out.get(id(pipeline))
+            return None if entry is None else entry.key[0]
+
+    def discard(self, model_id: str) -> None:
+        """Unloads the pipelines of a model version that are not in use, e.g. before removing it.
+
+        Args:
+            model_id: string, id of the model version, as given to remove_model()
+        """
+        folder_id = str(model_id).strip("/")
+        self._drop(lambda entry: entry.key[0] == folder_id)
+
+    def clear(self) -> None:
+        """Unloads all the pipelines that are not in use."""
+        self._drop(lambda entry: True)
+
+    def _drop(self, predicate: typing.Callable[[_CachedPipeline], bool]) -> None:
+        with self._lock:
+            dropped = [
+                entry
+                for entry in self._entries.values()
+                if predicate(entry) and entry.users == 0 and entry.loaded.is_set()
+            ]
+            for entry in dropped:
+                del self._entries[entry.key]
+        for entry in dropped:
+            _unload(entry)
+
+    def info(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """Describes the cached pipelines, least recently used first.
+
+        Returns:
+            List of python dictionaries with the model id, weight format, devices, estimated size in
+            bytes and number of users of each pipeline
+        """
+        with self._lock:
+            return [
+                {
+                    "id": entry.key[0],
+                    "weight_format": entry.key[1],
+                    "devices": list(entry.key[2]) if entry.key[2] else None,
+                    "size": entry.size,
+                    "users": entry.users,
+                }
+                for entry in self._entries.values()
+            ]
+
+
+_pipeline_cache: typing.Optional[PipelineCache] = None
+_pipeline_cache_lock = threading.Lock()
+
+
+def get_pipeline_cache() -> PipelineCache:
+    """Gets the pipeline cache shared by the whole process."""
+    global _pipeline_cache
+    with _pipeline_cache_lock:
+        if _pipeline_cache is None:
+            _pipeline_cache = PipelineCache()
+        return _pipeline_cache
+
+
+def get_pipeline(
+    model_id: str,
+    weight_format: typing.Optional[str] = None,
+    devices: typing.Optional[typing.Sequence[str]] = None,
+) -> typing.Any:
+    """Checks out the cached prediction pipeline of an installed model, see PipelineCache.get()."""
+    return get_pipeline_cache().get(model_id, weight_format, devices)
+
+
+def release_pipeline(pipeline: typing.Any) -> None:
+    """Gives back a pipeline checked out with get_pipeline()."""
+    get_pipeline_cache().release(pipeline)
+
+
+def use_pipeline(
+    model_id: str,
+    weight_format: typing.Optional[str] = None,
+    devices: typing.Optional[typing.Sequence[str]] = None,
+) -> typing.ContextManager[typing.Any]:
+    """Context manager checking out the cached prediction pipeline of an installed model.
+
+    Args:
+        model_id: string, id of the model, as given to load_model_by_id()
+        weight_format: string, weight format to run, None to let bioimageio.core choose
+        devices: list of device names (e.g. ["cuda"]), None to let bioimageio.core choose
+    Returns:
+        The prediction pipeline, kept loaded after the block for the next runs
+    """
+    return get_pipeline_cache().use(model_id, weight_format, devices)
+
+
+def clear_pipelines() -> None:
+    """Unloads all the cached pipelines that are not in use."""
+    get_pipeline_cache().clear()
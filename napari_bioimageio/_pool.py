@@ -0,0 +1,254 @@
+"""Pool of processes each holding a warm prediction pipeline, to run tiles on all the CPU cores."""
+
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+import threading
+import typing
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, the pools cannot be used
+    shared_memory = None  # type: ignore
+
+import numpy as np
+import xarray as xr
+
+from . import _utils
+
+POOL_THREADS_DEFAULT = 4
+# environment variables read by the numerical libraries when they start
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS")
+
+
+def set_pool_workers(workers: typing.Optional[int]) -> None:
+    """Sets the number of worker processes of the inference pools.
+
+    Args:
+        workers: int, number of processes, None to use all the cores given the threads per worker
+    """
+    os.environ["BIOIMAGEIO_NAPARI_POOL_WORKERS"] = "" if workers is None else str(workers)
+
+
+def get_pool_workers() -> int:
+    """Gets the number of worker processes of the inference pools."""
+    try:
+        return max(1, int(os.environ["BIOIMAGEIO_NAPARI_POOL_WORKERS"]))
+    except (KeyError, ValueError):
+        return max(1, (os.cpu_count() or 1) // get_pool_threads())
+
+
+def set_pool_threads(threads: int) -> None:
+    """Sets the number of threads each worker process of the inference pools computes with.
+
+    Args:
+        threads: int, intra-op threads per worker process
+    """
+    os.environ["BIOIMAGEIO_NAPARI_POOL_THREADS"] = str(threads)
+
+
+def get_pool_threads() -> int:
+    """Gets the number of threads each worker process of the inference pools computes with."""
+    try:
+        threads = int(os.environ.get("BIOIMAGEIO_NAPARI_POOL_THREADS", POOL_THREADS_DEFAULT))
+    except ValueError:
+        threads = POOL_THREADS_DEFAULT
+    return max(1, min(threads, os.cpu_count() or 1))
+
+
+# state of a worker process
+_worker_pipeline = None
+
+
+def _attach(name: str) -> "shared_memory.SharedMemory":
+    # opens a block the parent created and unlinks, which this worker must not register with the
+    # resource tracker; before Python 3.13 the spawned workers share the tracker of the parent, where
+    # registering twice is harmless but unregistering would drop the registration of the parent
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+def _init_worker(models_directory: str, model_id: str, weight_format: typing.Optional[str], threads: int) -> None:
+    global _worker_pipeline
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(threads)
+    try:
+        import torch
+
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    from . import _pipelines
+
+    _utils.set_models_path(models_directory)
+    _worker_pipeline = _pipelines.get_pipeline(model_id, weight_format=weight_format, devices=["cpu"])
+
+
+def _predict_shared(
+    name: str, shape: typing.Tuple[int, ...], dtype: str, dims: typing.Tuple[str, ...]
+) -> typing.List[typing.Tuple[str, typing.Tuple[int, ...], str, typing.Tuple[str, ...]]]:
+    # runs in a worker: the pixels come and go through shared memory, only their description is pickled
+    block = _attach(name)
+    try:
+        outputs = _worker_pipeline(xr.DataArray(np.ndarray(shape, dtype=dtype, buffer=block.buf), dims=dims))
+        descriptions = []
+        for output in outputs:
+            values = np.ascontiguousarray(output.values)
+            out_block = shared_memory.SharedMemory(create=True, size=max(1, values.nbytes))
+            np.ndarray(values.shape, dtype=values.dtype, buffer=out_block.buf)[...] = values
+            descriptions.append((out_block.name, values.shape, values.dtype.str, tuple(output.dims)))
+            out_block.close()
+        # the outputs may be views of the input, they must be gone before closing its block
+        outputs = output = values = None
+    finally:
+        block.close()
+    return descriptions
+
+
+def _collect(description: typing.Tuple[str, typing.Tuple[int, ...], str, typing.Tuple[str, ...]]) -> xr.DataArray:
+    # the output blocks are created by the workers and unlinked here, which unregisters them
+    name, shape, dtype, dims = description
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        values = np.ndarray(shape, dtype=dtype, buffer=block.buf).copy()
+    finally:
+        block.close()
+        block.unlink()
+    return xr.DataArray(values, dims=dims)
+
+
+class InferencePool:
+    """Worker processes each holding a warm prediction pipeline of one model, running on the CPU.
+
+    Each worker computes with threads intra-op threads, so workers * threads can match the cores
+    of the machine. Tensors are passed to and from the workers through shared memory, without
+    pickling the pixels. Use submit() to run tensors (e.g. tiles) concurrently, or call the pool
+    like a pipeline to split a batch between the workers; predict_tiled() accepts a pool in place
+    of a pipeline and shards the tiles.
+    """
+
+    def __init__(
+        self,
+        model_id: str,
+        workers: typing.Optional[int] = None,
+        threads: typing.Optional[int] = None,
+        weight_format: typing.Optional[str] = None,
+    ):
+        if shared_memory is None:
+            raise RuntimeError("Inference pools need Python 3.8 or later")
+        self.model_id = model_id
+        self.workers = get_pool_workers() if workers is None else max(1, workers)
+        self.threads = get_pool_threads() if threads is None else max(1, threads)
+        # two tensors per worker in flight: one computed, one waiting
+        self.max_in_flight = 2 * self.workers
+        model = _utils.load_model(model_id)
+        if model is None:
+            raise FileNotFoundError(f"Model {model_id} is not installed")
+        self.input_specs = model.inputs
+        self.output_specs = model.outputs
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(_utils.get_models_path(), model_id, weight_format, self.threads),
+        )
+
+    def submit(self, tensor: xr.DataArray) -> "concurrent.futures.Future[typing.List[xr.DataArray]]":
+        """Runs the model on a tensor in a worker process.
+
+        Args:
+            tensor: DataArray with the axes of the model input
+        Returns:
+            Future of the list of the model outputs, as returned by a prediction pipeline
+        """
+        values = np.ascontiguousarray(tensor.values)
+        block = shared_memory.SharedMemory(create=True, size=max(1, values.nbytes))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[...] = values
+        result: "concurrent.futures.Future[typing.List[xr.DataArray]]" = concurrent.futures.Future()
+
+        def done(future: concurrent.futures.Future) -> None:
+            block.close()
+            block.unlink()
+            try:
+                # collected even if the result was cancelled, to free the shared memory of the outputs
+                outputs = [_collect(description) for description in future.result()]
+            except BaseException as excep:
+                if result.set_running_or_notify_cancel():
+                    result.set_exception(excep)
+                return
+            if result.set_running_or_notify_cancel():
+                result.set_result(outputs)
+
+        try:
+            job = self._executor.submit(
+                _predict_shared, block.name, values.shape, values.dtype.str, tuple(tensor.dims)
+            )
+        except BaseException:
+            block.close()
+            block.unlink()
+            raise
+        # cancelling the result cancels the job too, unless a worker already started it
+        result.add_done_callback(lambda result: job.cancel() if result.cancelled() else None)
+        job.add_done_callback(done)
+        return result
+
+    def __call__(self, tensor: xr.DataArray) -> typing.List[xr.DataArray]:
+        """Runs the model on a batch, split along its "b" axis between the workers, like a pipeline."""
+        if "b" not in tensor.dims or tensor.sizes["b"] <= 1:
+            return self.submit(tensor).result()
+        chunks = np.array_split(np.arange(tensor.sizes["b"]), min(self.workers, tensor.sizes["b"]))
+        futures = [self.submit(tensor.isel(b=slice(int(c[0]), int(c[-1]) + 1))) for c in chunks]
+        results = [future.result() for future in futures]
+        return [xr.concat([outputs[i] for outputs in results], dim="b") for i in range(len(results[0]))]
+
+    def close(self) -> None:
+        """Stops the worker processes."""
+        if sys.version_info >= (3, 9):
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self) -> "InferencePool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+_pools: typing.Dict[typing.Tuple, InferencePool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_inference_pool(
+    model_id: str,
+    workers: typing.Optional[int] = None,
+    threads: typing.Optional[int] = None,
+    weight_format: typing.Optional[str] = None,
+) -> InferencePool:
+    """Gets a pool for a model, started on first use and kept warm until close_inference_pools().
+
+    Args:
+        model_id: string, id of the model, as given to load_model_by_id()
+        workers: int, number of worker processes; defaults to get_pool_workers()
+        threads: int, threads per worker process; defaults to get_pool_threads()
+        weight_format: string, weight format to run, None to let bioimageio.core choose
+    """
+    workers = get_pool_workers() if workers is None else workers
+    threads = get_pool_threads() if threads is None else threads
+    key = (_utils.get_models_path(), model_id, workers, threads, weight_format)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = InferencePool(model_id, workers=workers, threads=threads, weight_format=weight_format)
+        return _pools[key]
+
+
+def close_inference_pools() -> None:
+    """Stops the worker processes of all the pools started by get_inference_pool()."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
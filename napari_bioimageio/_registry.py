@@ -0,0 +1,255 @@
+"""Persistent registry of the models installed in a models directory."""
+
+import concurrent.futures
+import json
+import os
+import threading
+import typing
+
+import bioimageio.core
+import bioimageio.spec
+
+REGISTRY_FORMAT = 1
+RDF_FILE_NAME = "rdf.yaml"
+SCAN_WORKERS_DEFAULT = min(16, (os.cpu_count() or 1) + 4)
+
+
+def parse_rdf(rdf_file: str) -> typing.Dict[str, typing.Any]:
+    """Parses a rdf.yaml into the dictionary shown by the model manager.
+
+    Args:
+        rdf_file: string, path of the rdf.yaml file
+    Returns:
+        Python dictionary with the serialized resource description
+    """
+    return bioimageio.spec.serialize_raw_resource_description_to_dict(
+        bioimageio.core.load_raw_resource_description(rdf_file)
+    )
+
+
+class ModelRegistry:
+    """Index of the rdf.yaml files found in a models directory, persisted as JSON.
+
+    The registry remembers the parsed summary of every installed model version along with the
+    mtime and size of its rdf.yaml, and the mtime of every directory leading to it. Listing the
+    models only stats those paths: a rdf.yaml is parsed again only if it changed, and only the
+    directories whose mtime changed are listed again to discover new model versions.
+    Hidden directories (starting with a dot) are never scanned.
+
+    When several rdf.yaml files must be parsed, they are parsed concurrently on a bounded thread
+    pool. A file that fails to parse is recorded with its error instead of aborting the listing,
+    and is only retried once it changes on disk.
+    """
+
+    def __init__(self, models_directory: str, registry_file: str, max_workers: int = SCAN_WORKERS_DEFAULT):
+        self.models_directory = models_directory
+        self.registry_file = registry_file
+        self.max_workers = max_workers
+        self._lock = threading.RLock()
+        self._dirs: typing.Dict[str, int] = {}
+        self._models: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        self._loaded_mtime_ns: typing.Optional[int] = None
+
+    def _path(self, rel_path: str) -> str:
+        return os.path.join(self.models_directory, rel_path) if rel_path else self.models_directory
+
+    def _load(self) -> None:
+        try:
+            mtime_ns = os.stat(self.registry_file).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        if mtime_ns is None or mtime_ns == self._loaded_mtime_ns:
+            return
+
+        try:
+            with open(self.registry_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("format") != REGISTRY_FORMAT or data.get("models_directory") != self.models_directory:
+                raise ValueError("incompatible registry")
+            self._dirs = {str(k): int(v) for k, v in data["dirs"].items()}
+            self._models = dict(data["models"])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            self._dirs, self._models = {}, {}
+        self._loaded_mtime_ns = mtime_ns
+
+    def _save(self) -> None:
+        data = {
+            "format": REGISTRY_FORMAT,
+            "models_directory": self.models_directory,
+            "dirs": self._dirs,
+            "models": self._models,
+        }
+        tmp_file = f"{self.registry_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.registry_file), exist_ok=True)
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(data, f, default=str)
+            os.replace(tmp_file, self.registry_file)
+            self._loaded_mtime_ns = os.stat(self.registry_file).st_mtime_ns
+        except OSError as excep:
+            print("Could not write the models registry:", str(excep))
+
+    def _discover(self, rel_dir: str, to_parse: typing.Set[str]) -> None:
+        path = self._path(rel_dir)
+        try:
+            self._dirs[rel_dir] = os.stat(path).st_mtime_ns
+            entries = list(os.scandir(path))
+        except OSError:
+            self._dirs.pop(rel_dir, None)
+            return
+
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if rel_path not in self._dirs:
+                    self._discover(rel_path, to_parse)
+            elif entry.name == RDF_FILE_NAME and rel_path not in self._models:
+                to_parse.add(rel_path)
+
+    def _parse(self, rel_rdf: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        rdf_file = self._path(rel_rdf)
+        try:
+            stat = os.stat(rdf_file)
+        except OSError:
+            return None
+        entry = {
+            "id": None,
+            "version": os.path.basename(os.path.dirname(rel_rdf)),
+            "rdf": rdf_file,
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "summary": None,
+        }
+        try:
+            entry["summary"] = parse_rdf(rdf_file)
+            entry["id"] = entry["summary"].get("id")
+        except Exception as excep:
+            entry["error"] = f"{type(excep).__name__}: {excep}"
+        return entry
+
+    def _record(self, rel_rdfs: typing.Iterable[str]) -> None:
+        rel_rdfs = sorted(rel_rdfs)
+        if len(rel_rdfs) > 1 and self.max_workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_workers, len(rel_rdfs))) as executor:
+                entries = list(executor.map(self._parse, rel_rdfs))
+        else:
+            entries = [self._parse(rel_rdf) for rel_rdf in rel_rdfs]
+
+        for rel_rdf, entry in zip(rel_rdfs, entries):
+            if entry is None:
+                self._models.pop(rel_rdf, None)
+            else:
+                self._models[rel_rdf] = entry
+
+    def _revalidate(self) -> bool:
+        changed = False
+        to_parse: typing.Set[str] = set()
+
+        dirty_dirs = [] if self._dirs else [""]
+        for rel_dir, mtime_ns in list(self._dirs.items()):
+            try:
+                if os.stat(self._path(rel_dir)).st_mtime_ns != mtime_ns:
+                    dirty_dirs.append(rel_dir)
+            except OSError:
+                del self._dirs[rel_dir]
+                changed = True
+
+        for rel_rdf, entry in list(self._models.items()):
+            try:
+                stat = os.stat(self._path(rel_rdf))
+            except OSError:
+                del self._models[rel_rdf]
+                changed = True
+                continue
+            if stat.st_mtime_ns != entry["mtime_ns"] or stat.st_size != entry["size"]:
+                to_parse.add(rel_rdf)
+
+        for rel_dir in dirty_dirs:
+            self._discover(rel_dir, to_parse)
+            changed = True
+
+        if to_parse:
+            self._record(to_parse)
+            changed = True
+
+        return changed
+
+    def entries(self) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+        """Gets the registry entries of all the installed models, revalidating the registry by stat.
+
+        Returns:
+            Python dictionary with the entry (id, version, rdf, mtime_ns, size, summary) by rdf.yaml path
+        """
+        with self._lock:
+            self._load()
+            if self._revalidate():
+                self._save()
+            return {entry["rdf"]: entry for _, entry in sorted(self._models.items())}
+
+    def list_models(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        """Gets the summaries of all the installed models, revalidating the registry by stat.
+
+        Returns:
+            List of python dictionaries with the serialized resource description of each model
+        """
+        return [entry["summary"] for entry in self.entries().values() if entry["summary"] is not None]
+
+    def failures(self) -> typing.Dict[str, str]:
+        """Gets the rdf.yaml files that could not be parsed during the last listing.
+
+        Returns:
+            Python dictionary with the error message by rdf.yaml path
+        """
+        with self._lock:
+            return {entry["rdf"]: entry["error"] for _, entry in sorted(self._models.items()) if "error" in entry}
+
+    def summary(self, rdf_file: str) -> typing.Dict[str, typing.Any]:
+        """Gets the summary of one rdf.yaml of the models directory, parsing it only if it changed.
+
+        Args:
+            rdf_file: string, path of the rdf.yaml file
+        Returns:
+            Python dictionary with the serialized resource description
+        """
+        rel_rdf = os.path.relpath(rdf_file, self.models_directory)
+        with self._lock:
+            self._load()
+            entry = self._models.get(rel_rdf)
+            stat = os.stat(rdf_file)
+            if entry is None or stat.st_mtime_ns != entry["mtime_ns"] or stat.st_size != entry["size"]:
+                self._record([rel_rdf])
+                self._save()
+                entry = self._models[rel_rdf]
+            if entry["summary"] is None:
+                raise ValueError(entry["error"])
+            return entry["summary"]
+
+    def add(self, model_folder: str) -> None:
+        """Records the model installed in model_folder.
+
+        Args:
+            model_folder: string, path of the model version directory holding the rdf.yaml
+        """
+        rel_rdf = os.path.relpath(os.path.join(model_folder, RDF_FILE_NAME), self.models_directory)
+        with self._lock:
+            self._load()
+            self._record([rel_rdf])
+            self._save()
+
+    def remove(self, model_folder: str) -> None:
+        """Forgets all the models recorded below model_folder.
+
+        Args:
+            model_folder: string, path of the removed model directory
+        """
+        rel_dir = os.path.relpath(model_folder, self.models_directory)
+        prefix = rel_dir + os.sep
+        with self._lock:
+            self._load()
+            for rel_path in [p for p in self._models if p.startswith(prefix)]:
+                del self._models[rel_path]
+            for rel_path in [p for p in self._dirs if p == rel_dir or p.startswith(prefix)]:
+                del self._dirs[rel_path]
+            self._save()
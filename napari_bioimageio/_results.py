@@ -0,0 +1,357 @@
+"""Opt-in cache of prediction results, keyed by the content of the inputs, the model and the parameters."""
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import typing
+import uuid
+
+import numpy as np
+
+from . import _usage, _utils
+
+RESULTS_DIRECTORY_NAME = "results"
+RESULT_CACHE_SIZE_DEFAULT = 2 << 30
+RESULT_CACHE_MEMORY_DEFAULT = 512 << 20
+RESULTS_FORMAT = 1
+# rows hashed at once for arrays that are not contiguous in memory, or not in memory at all
+HASH_CHUNK_BYTES = 64 << 20
+
+
+def set_result_cache_enabled(enabled: bool) -> None:
+    """Enables or disables the prediction result cache, disabled by default.
+
+    Args:
+        enabled: bool, True to return the cached result of a prediction already made on the same inputs
+    """
+    os.environ["BIOIMAGEIO_NAPARI_RESULT_CACHE"] = "1" if enabled else "0"
+
+
+def get_result_cache_enabled() -> bool:
+    """Gets whether the prediction result cache is enabled."""
+    return os.environ.get("BIOIMAGEIO_NAPARI_RESULT_CACHE", "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def set_result_cache_size(size: typing.Union[int, str, None]) -> None:
+    """Sets the disk space the cached prediction results may use.
+
+    Args:
+        size: int, bytes, or string with a K, M, G or T suffix (e.g. "20G"); None for no limit
+    """
+    os.environ["BIOIMAGEIO_NAPARI_RESULT_CACHE_SIZE"] = "none" if size is None else str(size)
+
+
+def get_result_cache_size() -> typing.Optional[int]:
+    """Gets the disk space in bytes the cached prediction results may use, None if unlimited."""
+    try:
+        return _usage.parse_size(os.environ.get("BIOIMAGEIO_NAPARI_RESULT_CACHE_SIZE", RESULT_CACHE_SIZE_DEFAULT))
+    except ValueError:
+        return RESULT_CACHE_SIZE_DEFAULT
+
+
+def set_result_cache_memory(memory: typing.Union[int, str]) -> None:
+    """Sets the memory the most recently used prediction results may be kept in.
+
+    Args:
+        memory: int, bytes, or string with a K, M, G or T suffix (e.g. "1G"); 0 to only cache on disk
+    """
+    os.environ["BIOIMAGEIO_NAPARI_RESULT_CACHE_MEMORY"] = str(memory)
+
+
+def get_result_cache_memory() -> int:
+    """Gets the memory in bytes the most recently used prediction results may be kept in."""
+    try:
+        memory = _usage.parse_size(os.environ.get("BIOIMAGEIO_NAPARI_RESULT_CACHE_MEMORY", RESULT_CACHE_MEMORY_DEFAULT))
+    except ValueError:
+        memory = None
+    return RESULT_CACHE_MEMORY_DEFAULT if memory is None else memory
+
+
+def hash_array(array: typing.Any) -> str:
+    """Hashes the shape, dtype and values of an array with blake2b.
+
+    Contiguous numpy arrays are hashed in place; other arrays (views, memmaps, zarr, dask...) are
+    read and hashed a few rows at a time, so the whole array is never copied.
+    Returns:
+        Hexadecimal digest
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    shape = tuple(int(size) for size in array.shape)
+    dtype = np.dtype(array.dtype)
+    digest.update(json.dumps([dtype.str, shape]).encode())
+    if isinstance(array, np.ndarray) and array.flags.c_contiguous:
+        # hashlib releases the GIL while hashing large buffers
+        digest.update(memoryview(array.reshape(-1).view(np.uint8)))
+    elif len(shape) == 0:
+        digest.update(np.ascontiguousarray(np.asarray(array)).tobytes())
+    else:
+        row_bytes = max(1, int(np.prod(shape[1:], dtype=np.int64)) * dtype.itemsize)
+        rows = max(1, HASH_CHUNK_BYTES // row_bytes)
+        for start in range(0, shape[0], rows):
+            chunk = np.ascontiguousarray(np.asarray(array[start : start + rows]))
+            digest.update(memoryview(chunk.reshape(-1).view(np.uint8)))
+    return digest.hexdigest()
+
+
+def _flatten(value: typing.Any, arrays: typing.List[np.ndarray]) -> typing.Any:
+    # describes value as JSON, with its arrays replaced by their index in arrays
+    if isinstance(value, np.ndarray) or (hasattr(value, "__array__") and hasattr(value, "shape")):
+        arrays.append(np.asarray(value))
+        return {"array": len(arrays) - 1}
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {"value": value}
+    if isinstance(value, (list, tuple)):
+        return {type(value).__name__: [_flatten(item, arrays) for item in value]}
+    if isinstance(value, dict):
+        items = []
+        for key, item in value.items():
+            if isinstance(key, np.generic):
+                key = key.item()
+            if not (key is None or isinstance(key, (bool, int, float, str))):
+                raise TypeError(f"Cannot cache a dictionary with {type(key).__name__} keys")
+            items.append([key, _flatten(item, arrays)])
+        return {"dict": items}
+    raise TypeError(f"Cannot cache a result of type {type(value).__name__}")
+
+
+def _unflatten(structure: typing.Any, arrays: typing.Sequence[np.ndarray]) -> typing.Any:
+    if "array" in structure:
+        return arrays[structure["array"]]
+    if "value" in structure:
+        return structure["value"]
+    if "list" in structure:
+        return [_unflatten(item, arrays) for item in structure["list"]]
+    if "tuple" in structure:
+        return tuple(_unflatten(item, arrays) for item in structure["tuple"])
+    return {key: _unflatten(item, arrays) for key, item in structure["dict"]}
+
+
+def _read_only(arrays: typing.Iterable[np.ndarray]) -> None:
+    # cached arrays are shared by every run returning them, they must not be modified in place
+    for array in arrays:
+        array.flags.writeable = False
+
+
+def _copy(value: typing.Any) -> typing.Any:
+    # the caller gets its own writable arrays, e.g. label layers napari can edit
+    arrays: typing.List[np.ndarray] = []
+    structure = _flatten(value, arrays)
+    return _unflatten(structure, [array.copy() for array in arrays])
+
+
+class ResultCache:
+    """Prediction results kept in memory and on disk, by the key of their inputs, model and parameters.
+
+    The most recently used results are kept in memory up to max_memory bytes; all results are
+    written to a directory, where the least recently used ones are removed once it uses more than
+    max_size bytes. Results are python values made of numpy arrays, numbers, strings, lists,
+    tuples and dictionaries; the cache keeps its own read-only copy of the arrays and returns
+    copies the caller may modify.
+    """
+
+    def __init__(self, directory: str, max_size: typing.Optional[int] = None, max_memory: typing.Optional[int] = None):
+        self.directory = directory
+        self.max_size = get_result_cache_size() if max_size is None else max_size
+        self.max_memory = get_result_cache_memory() if max_memory is None else max_memory
+        self._lock = threading.Lock()
+        self._memory: "collections.OrderedDict[str, typing.Tuple[typing.Any, int]]" = collections.OrderedDict()
+        self._memory_size = 0
+
+    @staticmethod
+    def key(
+        model_id: str,
+        inputs: typing.Sequence[typing.Any],
+        weight_format: typing.Optional[str] = None,
+        params: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    ) -> str:
+        """Computes the cache key of a prediction.
+
+        Args:
+            model_id: string, id of the model, as given to load_model_by_id()
+            inputs: list of the input arrays
+            weight_format: string, weight format the model runs with
+            params: python dictionary of the other parameters the result depends on, e.g. the
+                preprocessing and thresholds, which must be JSON serializable
+        Returns:
+            Hexadecimal key
+        """
+        folder_id = _utils._model_folder_id(model_id).strip("/")
+        rdf_file = os.path.join(_utils.get_models_path(), folder_id, "rdf.yaml")
+        # a reinstalled model may have other weights under the same version
+        rdf_mtime_ns = os.stat(rdf_file).st_mtime_ns if os.path.exists(rdf_file) else 0
+        digest = hashlib.blake2b(digest_size=20)
+        description = [RESULTS_FORMAT, folder_id, rdf_mtime_ns, weight_format, params or {}]
+        digest.update(json.dumps(description, sort_keys=True, default=str).encode())
+        for array in inputs:
+            digest.update(hash_array(array).encode())
+        return digest.hexdigest()
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".npz")
+
+    def _remember(self, key: str, value: typing.Any, size: int) -> None:
+        # called with the lock held
+        if key in self._memory:
+            self._memory_size -= self._memory.pop(key)[1]
+        if size > self.max_memory:
+            return
+        self._memory[key] = (value, size)
+        self._memory_size += size
+        while self._memory_size > self.max_memory:
+            self._memory_size -= self._memory.popitem(last=False)[1][1]
+
+    def get(self, key: str) -> typing.Tuple[bool, typing.Any]:
+        """Gets a cached result.
+
+        Returns:
+            Tuple (True, result) if the result is cached, (False, None) otherwise; the arrays of
+            the result are copies the caller may modify
+        """
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                self._memory.move_to_end(key)
+        if cached is not None:
+            return True, _copy(cached[0])
+        cache_file = self._file(key)
+        try:
+            with np.load(cache_file, allow_pickle=False) as data:
+                structure = json.loads(str(data["structure"]))
+                arrays = [data[f"array_{index}"] for index in range(int(data["count"]))]
+            # the access time marks the least recently used results
+            os.utime(cache_file)
+        except (OSError, ValueError, KeyError) as excep:
+            if os.path.exists(cache_file):
+                print("Could not read the cached result:", str(excep))
+            return False, None
+        _read_only(arrays)
+        value = _unflatten(structure, arrays)
+        with self._lock:
+            self._remember(key, value, sum(array.nbytes for array in arrays))
+        return True, _copy(value)
+
+    def put(self, key: str, value: typing.Any) -> typing.Any:
+        """Caches a result, in memory and on disk.
+
+        Returns:
+            The result, unchanged: the cache keeps read-only copies of its arrays
+        """
+        result = value
+        arrays: typing.List[np.ndarray] = []
+        structure = _flatten(value, arrays)
+        arrays = [array.copy() for array in arrays]
+        _read_only(arrays)
+        value = _unflatten(structure, arrays)
+        size = sum(array.nbytes for array in arrays)
+        with self._lock:
+            self._remember(key, value, size)
+
+        if self.max_size is not None and size > self.max_size:
+            return result
+        cache_file = self._file(key)
+        tmp_file = f"{cache_file}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_file, "wb") as f:
+                np.savez(
+                    f,
+                    structure=np.array(json.dumps(structure)),
+                    count=np.array(len(arrays)),
+                    **{f"array_{index}": array for index, array in enumerate(arrays)},
+                )
+            os.replace(tmp_file, cache_file)
+        except OSError as excep:
+            print("Could not write the cached result:", str(excep))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            return result
+        self.evict()
+        return result
+
+    def evict(self) -> None:
+        """Removes the least recently used results from disk until they fit in max_size."""
+        if self.max_size is None:
+            return
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(".npz"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+        used = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if used <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            used -= size
+
+    def clear(self) -> None:
+        """Removes all the cached results, from memory and from disk."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith((".npz", ".tmp")):
+                        os.remove(entry.path)
+        except OSError:
+            pass
+
+
+_result_caches: typing.Dict[str, ResultCache] = {}
+_result_caches_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    """Gets the result cache of the current models directory, inside its cache directory."""
+    directory = os.path.join(_utils.get_cache_path(), RESULTS_DIRECTORY_NAME)
+    with _result_caches_lock:
+        if directory not in _result_caches:
+            _result_caches[directory] = ResultCache(directory)
+        return _result_caches[directory]
+
+
+def cached_prediction(
+    model_id: str,
+    inputs: typing.Sequence[typing.Any],
+    predict: typing.Callable[[], typing.Any],
+    weight_format: typing.Optional[str] = None,
+    params: typing.Optional[typing.Dict[str, typing.Any]] = None,
+) -> typing.Any:
+    """Returns the cached result of a prediction on the same inputs, or runs it and caches its result.
+
+    Does nothing but run predict() unless the result cache is enabled, see set_result_cache_enabled().
+    Args:
+        model_id: string, id of the model, as given to load_model_by_id()
+        inputs: list of the arrays the prediction reads
+        predict: function running the prediction and returning its result
+        weight_format: string, weight format the model runs with
+        params: python dictionary of the other parameters the result depends on, e.g. the
+            preprocessing and thresholds, which must be JSON serializable
+    Returns:
+        The result of predict(), or a copy of the cached one, whose arrays the caller may modify
+    """
+    if not get_result_cache_enabled():
+        return predict()
+    cache = get_result_cache()
+    key = cache.key(model_id, inputs, weight_format=weight_format, params=params)
+    found, value = cache.get(key)
+    if found:
+        return value
+    value = predict()
+    try:
+        return cache.put(key, value)
+    except TypeError as excep:
+        print("Could not cache the prediction:", str(excep))
+        return value
@@ -0,0 +1,153 @@
+"""Inverted n-gram index answering the model manager id and tag filters."""
+
+import typing
+
+NGRAM_SIZE = 3
+FIELD_SEPARATOR = "\x00"
+
+
+def split_filter(filter_text: str) -> typing.List[str]:
+    """Splits a ';' separated filter into its lowercase, non-empty terms.
+
+    Args:
+        filter_text: string, filter as typed in the model manager
+    Returns:
+        List of filter terms
+    """
+    return [term.lower() for term in (filter_text or "").split(";") if term]
+
+
+def _ngrams(text: str) -> typing.Set[str]:
+    grams = set()
+    for size in range(1, NGRAM_SIZE + 1):
+        for start in range(len(text) - size + 1):
+            grams.add(text[start : start + size])
+    return grams
+
+
+class _Field:
+    """Postings of one searchable text per model: n-gram -> model keys."""
+
+    def __init__(self):
+        self.texts: typing.Dict[str, str] = {}
+        self.postings: typing.Dict[str, typing.Set[str]] = {}
+
+    def add(self, key: str, text: str) -> None:
+        self.texts[key] = text
+        for gram in _ngrams(text):
+            self.postings.setdefault(gram, set()).add(key)
+
+    def remove(self, key: str) -> None:
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+        for gram in _ngrams(text):
+            keys = self.postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.postings[gram]
+
+    def search(self, term: str) -> typing.Set[str]:
+        """Gets the keys of the models whose text contains term as a substring."""
+        if len(term) <= NGRAM_SIZE:
+            return set(self.postings.get(term, ()))
+
+        grams = sorted(
+            (self.postings.get(term[start : start + NGRAM_SIZE], set()) for start in range(len(term) - NGRAM_SIZE + 1)),
+            key=len,
+        )
+        candidates = grams[0].intersection(*grams[1:])
+        return {key for key in candidates if term in self.texts[key]}
+
+
+class SearchIndex:
+    """Search index over the id, name, nickname and tags of a list of models.
+
+    The index answers the same filters as the model manager: a model matches when any of the
+    ';' separated id terms is a substring of its name, nickname or id, or when any of the tag
+    terms is a substring of its comma-joined tags; matching is case insensitive. Call sync()
+    whenever the model list changes, only added, removed or modified models are re-indexed.
+    """
+
+    def __init__(self):
+        self._models: typing.Dict[str, typing.Any] = {}
+        self._positions: typing.Dict[str, int] = {}
+        self._ids = _Field()
+        self._tags = _Field()
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+    @staticmethod
+    def _texts(key: str, model: typing.Mapping) -> typing.Tuple[str, str]:
+        id_text = [str(model.get("name", "")), str(key)]
+        if "nickname" in model:
+            id_text.append(str(model["nickname"]))
+        return FIELD_SEPARATOR.join(id_text).lower(), ",".join(model.get("tags") or ()).lower()
+
+    def _add(self, key: str, texts: typing.Tuple[str, str], model: typing.Mapping) -> None:
+        self._models[key] = model
+        self._ids.add(key, texts[0])
+        self._tags.add(key, texts[1])
+
+    def _remove(self, key: str) -> None:
+        self._models.pop(key, None)
+        self._ids.remove(key)
+        self._tags.remove(key)
+
+    def sync(self, models: typing.Iterable[typing.Mapping]) -> bool:
+        """Updates the index to hold exactly the given models.
+
+        Args:
+            models: iterable of model information dictionaries with at least an "id" key
+        Returns:
+            True if models were added or removed or their indexed texts changed
+        """
+        current = {}
+        for model in models:
+            current[model["id"]] = model
+
+        changed = False
+        for key in [key for key in self._models if key not in current]:
+            self._remove(key)
+            changed = True
+        for key, model in current.items():
+            if self._models.get(key) is model:
+                continue
+            # a refetched catalog builds new entries, only those whose indexed texts differ are re-indexed
+            texts = self._texts(key, model)
+            if key in self._models and texts == (self._ids.texts[key], self._tags.texts[key]):
+                self._models[key] = model
+                continue
+            self._remove(key)
+            self._add(key, texts, model)
+            changed = True
+        self._positions = {key: position for position, key in enumerate(current)}
+        self._models = {key: self._models[key] for key in current}
+
+        return changed
+
+    def search(self, filter_id: str = "", filter_tag: str = "") -> typing.Dict[str, typing.Any]:
+        """Gets the models matching the filters.
+
+        Args:
+            filter_id: string, ';' separated terms matched against name, nickname and id
+            filter_tag: string, ';' separated terms matched against the tags
+        Returns:
+            Python dictionary of the matching models by id, in the order they were synced
+        """
+        terms_id = split_filter(filter_id)
+        terms_tag = split_filter(filter_tag)
+        if not terms_id and not terms_tag:
+            return dict(self._models)
+
+        keys: typing.Set[str] = set()
+        for term in terms_id:
+            keys |= self._ids.search(term)
+        for term in terms_tag:
+            keys |= self._tags.search(term)
+
+        if len(keys) * 8 > len(self._models):
+            return {key: model for key, model in self._models.items() if key in keys}
+        return {key: self._models[key] for key in sorted(keys, key=self._positions.__getitem__)}
@@ -0,0 +1,281 @@
+"""Graph of processing stages, running the stages that do not depend on each other concurrently."""
+
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import typing
+
+import numpy as np
+
+from . import _usage
+from ._results import hash_array
+from ._tiling import PredictionCancelled
+
+STAGE_WORKERS_DEFAULT = 4
+STAGE_CACHE_MEMORY_DEFAULT = 2 << 30
+# how often a run checks whether it was cancelled while stages are running, in seconds
+CANCEL_POLL_INTERVAL = 0.1
+
+
+def set_stage_cache_memory(memory: typing.Union[int, str]) -> None:
+    """Sets the memory the intermediate results of the stage caches may be kept in.
+
+    Args:
+        memory: int, bytes, or string with a K, M, G or T suffix (e.g. "4G")
+    """
+    os.environ["BIOIMAGEIO_NAPARI_STAGE_CACHE_MEMORY"] = str(memory)
+
+
+def get_stage_cache_memory() -> int:
+    """Gets the memory in bytes the intermediate results of the stage caches may be kept in."""
+    try:
+        memory = _usage.parse_size(os.environ.get("BIOIMAGEIO_NAPARI_STAGE_CACHE_MEMORY", STAGE_CACHE_MEMORY_DEFAULT))
+    except ValueError:
+        memory = None
+    return STAGE_CACHE_MEMORY_DEFAULT if memory is None else memory
+
+
+def _nbytes(value: typing.Any) -> int:
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(_nbytes(item) for item in value.values())
+    return 0
+
+
+def fingerprint(value: typing.Any) -> str:
+    """Fingerprint of an input of a stage graph: the hash of its content for arrays, of its JSON otherwise."""
+    if hasattr(value, "shape") and hasattr(value, "dtype"):
+        return hash_array(value)
+    return hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode(), digest_size=20).hexdigest()
+
+
+class StageCache:
+    """Results of stages kept in memory between runs, by the fingerprint of everything they depend on.
+
+    The least recently used results are dropped once they hold more than max_memory bytes. Give the
+    same cache to the graphs of successive runs, e.g. keep it in the widget, so that a run only
+    computes the stages whose inputs changed.
+    """
+
+    def __init__(self, max_memory: typing.Optional[int] = None):
+        self.max_memory = get_stage_cache_memory() if max_memory is None else max_memory
+        self._lock = threading.Lock()
+        self._results: "collections.OrderedDict[str, typing.Tuple[typing.Any, int]]" = collections.OrderedDict()
+        self._size = 0
+
+    def get(self, key: str) -> typing.Tuple[bool, typing.Any]:
+        """Gets a cached result.
+
+        Returns:
+            Tuple (True, result) if the result is cached, (False, None) otherwise
+        """
+        with self._lock:
+            if key not in self._results:
+                return False, None
+            self._results.move_to_end(key)
+            return True, self._results[key][0]
+
+    def put(self, key: str, value: typing.Any) -> None:
+        """Caches a result, dropping the least recently used ones if needed."""
+        size = _nbytes(value)
+        with self._lock:
+            if key in self._results:
+                self._size -= self._results.pop(key)[1]
+            if size > self.max_memory:
+                return
+            self._results[key] = (value, size)
+            self._size += size
+            while self._size > self.max_memory:
+                self._size -= self._results.popitem(last=False)[1][1]
+
+    def clear(self) -> None:
+        """Drops all the cached results."""
+        with self._lock:
+            self._results.clear()
+            self._size = 0
+
+
+class Stage(typing.NamedTuple):
+    """A step of a workflow, computed from the results of the stages it depends on."""
+
+    name: str
+    function: typing.Callable[..., typing.Any]
+    inputs: typing.Tuple[str, ...]
+    label: str  # shown in the progress reports
+    key: typing.Any  # JSON serializable parameters the result depends on besides its inputs
+
+
+class StageGraph:
+    """Workflow made of stages, each run once the stages it depends on are done.
+
+    A stage is called as function(*results of its inputs, progress=progress, cancel=cancel), where
+    progress(done, total) reports its progress under the stage label and cancel is an event set
+    when the run is cancelled or another stage failed. Stages that do not depend on each other
+    run concurrently in a thread pool, e.g. the predictions of two models on the same image, so
+    the run takes about as long as its slowest chain of stages rather than the sum of all of them.
+    Given a StageCache, the result of each stage is kept by the fingerprint of the graph inputs
+    it depends on and of the keys of the stages in between, and a stage whose fingerprint did not
+    change since an earlier run is not run again. Stages must then only read data given as graph
+    inputs (add_input) and must not modify the results they receive.
+    """
+
+    def __init__(self, cache: typing.Optional[StageCache] = None):
+        self.cache = cache
+        self.inputs: typing.Dict[str, typing.Any] = {}
+        self.stages: typing.Dict[str, Stage] = {}
+
+    def add_input(self, name: str, value: typing.Any) -> "StageGraph":
+        """Adds a value the stages can depend on, e.g. the data of a layer.
+
+        Args:
+            name: string, name of the input, which the stages depending on it list in their inputs
+            value: array, or JSON serializable value
+        Returns:
+            The graph, so that inputs and stages can be chained
+        """
+        if name in self.inputs or name in self.stages:
+            raise ValueError(f"The input {name} is already defined")
+        self.inputs[name] = value
+        return self
+
+    def add(
+        self,
+        name: str,
+        function: typing.Callable[..., typing.Any],
+        inputs: typing.Sequence[str] = (),
+        label: typing.Optional[str] = None,
+        key: typing.Any = None,
+    ) -> "StageGraph":
+        """Adds a stage, after the stages and inputs it depends on.
+
+        Args:
+            name: string, name of the stage, which the stages depending on it list in their inputs
+            function: callable computing the result of the stage
+            inputs: list of the names of the stages and graph inputs whose values are passed to
+                function, in order
+            label: string shown in the progress reports, defaults to the name
+            key: JSON serializable parameters the result depends on besides its inputs, e.g. the
+                id of the model it runs and its thresholds
+        Returns:
+            The graph, so that inputs and stages can be chained
+        """
+        if name in self.stages or name in self.inputs:
+            raise ValueError(f"The stage {name} is already defined")
+        for dependency in inputs:
+            if dependency not in self.stages and dependency not in self.inputs:
+                raise ValueError(f"The stage {name} depends on {dependency}, which must be added first")
+        self.stages[name] = Stage(name, function, tuple(inputs), label or name, key)
+        return self
+
+    def fingerprints(self) -> typing.Dict[str, str]:
+        """Computes the fingerprint of each input and stage, from what it depends on.
+
+        Returns:
+            Python dictionary with the hexadecimal fingerprint of each input and stage, by name
+        """
+        fingerprints = {name: fingerprint(value) for name, value in self.inputs.items()}
+        # the stages are added after their dependencies, so they are in order
+        for stage in self.stages.values():
+            description = [stage.name, stage.key, [fingerprints[dependency] for dependency in stage.inputs]]
+            fingerprints[stage.name] = fingerprint(description)
+        return fingerprints
+
+    def run(
+        self,
+        outputs: typing.Optional[typing.Sequence[str]] = None,
+        progress: typing.Optional[typing.Callable[[str, int, int], None]] = None,
+        cancel: typing.Optional[threading.Event] = None,
+        max_workers: int = STAGE_WORKERS_DEFAULT,
+    ) -> typing.Dict[str, typing.Any]:
+        """Runs the stages needed for outputs, concurrently when they do not depend on each other.
+
+        Args:
+            outputs: list of the names of the stages whose results are wanted, None for all of them
+            progress: function called with (stage label, steps done, number of steps)
+            cancel: event, when set the run stops with PredictionCancelled
+            max_workers: int, number of stages run at once
+        Returns:
+            Python dictionary with the result of each stage run, by name
+        """
+        results: typing.Dict[str, typing.Any] = dict(self.inputs)
+        fingerprints = self.fingerprints() if self.cache is not None else {}
+        needed = self._needed(self.stages if outputs is None else outputs, fingerprints, results)
+        # set to stop the running stages, when the run is cancelled or a stage failed
+        stop = threading.Event()
+        running: typing.Dict[concurrent.futures.Future, str] = {}
+        error: typing.Optional[BaseException] = None
+
+        def stage_progress(stage: Stage) -> typing.Callable[[int, int], None]:
+            return lambda done, total: progress(stage.label, done, total) if progress is not None else None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while True:
+                if error is None and not stop.is_set():
+                    for stage in self.stages.values():
+                        if (
+                            stage.name in needed
+                            and stage.name not in results
+                            and stage.name not in running.values()
+                            and all(dependency in results for dependency in stage.inputs)
+                        ):
+                            future = executor.submit(
+                                stage.function,
+                                *[results[dependency] for dependency in stage.inputs],
+                                progress=stage_progress(stage),
+                                cancel=stop,
+                            )
+                            running[future] = stage.name
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(
+                    running, timeout=CANCEL_POLL_INTERVAL, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                if cancel is not None and cancel.is_set():
+                    stop.set()
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                        if self.cache is not None:
+                            self.cache.put(fingerprints[name], results[name])
+                    except PredictionCancelled as excep:
+                        stop.set()
+                        error = error or excep
+                    except BaseException as excep:
+                        stop.set()
+                        # the first failure is reported, not the cancellations it caused
+                        if error is None or isinstance(error, PredictionCancelled):
+                            error = excep
+
+        if error is not None:
+            raise error
+        if cancel is not None and cancel.is_set():
+            raise PredictionCancelled()
+        return {name: value for name, value in results.items() if name in self.stages}
+
+    def _needed(
+        self, outputs: typing.Iterable[str], fingerprints: typing.Dict[str, str], results: typing.Dict[str, typing.Any]
+    ) -> typing.Set[str]:
+        # the stages to run for outputs; the cached ones are put in results, and what they depend on is not run
+        needed: typing.Set[str] = set()
+        pending = list(outputs)
+        while pending:
+            name = pending.pop()
+            if name in self.inputs or name in needed or name in results:
+                continue
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage {name}")
+            if self.cache is not None:
+                found, value = self.cache.get(fingerprints[name])
+                if found:
+                    results[name] = value
+                    continue
+            needed.add(name)
+            pending.extend(self.stages[name].inputs)
+        return needed
@@ -0,0 +1,301 @@
+"""Tiled inference with blended overlaps, for images larger than what fits in memory at once."""
+
+import collections
+import itertools
+import math
+import threading
+import typing
+
+import numpy as np
+import xarray as xr
+
+SPATIAL_AXES = "zyx"
+TILE_SIZE_DEFAULT = 512
+# used when the model does not declare the halo of its output
+HALO_DEFAULT = 16
+
+
+class PredictionCancelled(Exception):
+    """Raised inside a prediction when it was cancelled."""
+
+
+class AxisTiling(typing.NamedTuple):
+    """Tiling of one spatial axis, in input pixels."""
+
+    name: str
+    size: int  # size of the image along the axis
+    tile: int  # size of a tile, possibly larger than the image which is then padded
+    halo: int  # pixels at the tile borders discarded as unreliable
+    blend: int  # pixels over which overlapping tiles are cross-faded
+    starts: typing.Tuple[int, ...]
+    scale: float  # output pixels per input pixel
+
+
+def _valid_tile(shape: typing.Any, index: int, wanted: int) -> int:
+    # smallest tile size accepted by the input shape that is at least wanted
+    if isinstance(shape, (list, tuple)):
+        return int(shape[index])
+    minimum, step = int(shape.min[index]), int(shape.step[index])
+    if step == 0 or wanted <= minimum:
+        return minimum
+    return minimum + math.ceil((wanted - minimum) / step) * step
+
+
+def _output_scale(output_spec: typing.Any, axis: str) -> float:
+    shape = output_spec.shape
+    if isinstance(shape, (list, tuple)):
+        return 1.0
+    index = output_spec.axes.index(axis)
+    if shape.offset[index]:
+        raise ValueError(f"Tiled prediction does not support outputs with an offset along axis {axis}")
+    return float(shape.scale[index])
+
+
+def _output_halo(output_spec: typing.Any, axis: str) -> typing.Optional[int]:
+    halo = getattr(output_spec, "halo", None)
+    if not halo or axis not in output_spec.axes:
+        return None
+    return int(halo[output_spec.axes.index(axis)])
+
+
+def plan_tiling(
+    input_spec: typing.Any,
+    output_spec: typing.Any,
+    image_shape: typing.Sequence[int],
+    tile_size: typing.Union[int, typing.Dict[str, int]] = TILE_SIZE_DEFAULT,
+    halo: typing.Union[int, typing.Dict[str, int], None] = None,
+) -> typing.List[AxisTiling]:
+    """Derives the tiling of an image from the input and output description of a model.
+
+    The tile size is the smallest size accepted by the input shape (min + n * step) that is at least
+    tile_size, or the image size if smaller. The halo is the one the output declares, converted to
+    input pixels, HALO_DEFAULT if it declares none; overlapping tiles are cross-faded over as many
+    pixels again.
+    Args:
+        input_spec: input tensor description of the model (pipeline.input_specs[0])
+        output_spec: output tensor description of the model (pipeline.output_specs[0])
+        image_shape: shape of the image, with the axes of the input
+        tile_size: int, or dictionary by axis name, wanted tile size in input pixels
+        halo: int, or dictionary by axis name, halo in input pixels overriding the model's
+    Returns:
+        List of the tiling of each spatial axis of the input
+    """
+    tiling = []
+    for index, axis in enumerate(input_spec.axes):
+        if axis not in SPATIAL_AXES:
+            continue
+        size = int(image_shape[index])
+        scale = _output_scale(output_spec, axis) if axis in output_spec.axes else 1.0
+        if halo is None:
+            output_halo = _output_halo(output_spec, axis)
+            axis_halo = HALO_DEFAULT if output_halo is None else math.ceil(output_halo / scale)
+        else:
+            axis_halo = int(halo[axis] if isinstance(halo, dict) else halo)
+        wanted = int(tile_size.get(axis, TILE_SIZE_DEFAULT) if isinstance(tile_size, dict) else tile_size)
+
+        tile = _valid_tile(input_spec.shape, index, min(wanted, size))
+        if tile < size:
+            # the tiles must be larger than what overlaps, or they would not advance
+            tile = _valid_tile(input_spec.shape, index, max(tile, 4 * axis_halo + 1))
+        if tile >= size:
+            axis_halo, blend, starts = 0, 0, (0,)
+        else:
+            blend = axis_halo
+            stride = max(1, tile - 2 * axis_halo - blend)
+            end = size - 2 * axis_halo - blend
+            starts = tuple(sorted({min(start, size - tile) for start in range(0, end, stride)}))
+            if starts[-1] + tile < size:
+                starts += (size - tile,)
+        tiling.append(AxisTiling(axis, size, tile, axis_halo, blend, starts, scale))
+    return tiling
+
+
+def _axis_weights(axis: AxisTiling) -> typing.List[np.ndarray]:
+    """Blending weights of each tile along one axis, in output pixels, summing to one at every pixel."""
+    size = round(axis.size * axis.scale)
+    tile = round(axis.tile * axis.scale)
+    halo = round(axis.halo * axis.scale)
+    blend = round(axis.blend * axis.scale)
+    ramp = (np.arange(blend, dtype="float32") + 0.5) / blend if blend else np.zeros(0, dtype="float32")
+
+    weights = []
+    total = np.zeros(size, dtype="float32")
+    for start in axis.starts:
+        start = round(start * axis.scale)
+        weight = np.ones(tile, dtype="float32")
+        if start > 0:
+            weight[:halo] = 0
+            weight[halo : halo + blend] = ramp
+        if start + tile < size:
+            weight[tile - halo :] = 0
+            weight[tile - halo - blend : tile - halo] = ramp[::-1]
+        weight = weight[: size - start]
+        total[start : start + len(weight)] += weight
+        weights.append(weight)
+    starts = [round(start * axis.scale) for start in axis.starts]
+    return [weight / total[start : start + len(weight)] for start, weight in zip(starts, weights)]
+
+
+def _open_output(
+    out: typing.Any, shape: typing.Tuple[int, ...], dtype: typing.Any
+) -> typing.Any:
+    if out is None:
+        return np.zeros(shape, dtype=dtype)
+    if isinstance(out, str):
+        return np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=shape)
+    if tuple(out.shape) != shape:
+        raise ValueError(f"The output has shape {tuple(out.shape)}, expected {shape}")
+    out[...] = 0
+    return out
+
+
+def predict_tiled(
+    pipeline: typing.Any,
+    image: typing.Any,
+    tile_size: typing.Union[int, typing.Dict[str, int], None] = None,
+    halo: typing.Union[int, typing.Dict[str, int], None] = None,
+    batch_size: typing.Optional[int] = None,
+    out: typing.Any = None,
+    progress: typing.Optional[typing.Callable[[int, int], None]] = None,
+    cancel: typing.Optional[threading.Event] = None,
+) -> typing.Any:
+    """Runs a prediction pipeline tile by tile, blending the overlaps of neighbouring tiles.
+
+    Only one tile of the image is read and predicted at a time, so the memory used besides the
+    output is bounded by the tile size whatever the size of the image; the image can be any array
+    that is sliced lazily (numpy memmap, zarr, dask...). Given an InferencePool instead of a
+    pipeline, a few tiles per worker process are predicted concurrently. The halo of each tile is discarded and
+    neighbouring tiles are cross-faded, so no seam shows at the tile borders.
+    The tile size, batch size and thread count default to the ones tune_model() found for the model
+    on this machine, if it was tuned.
+    Args:
+        pipeline: prediction pipeline of the model, see use_pipeline(), or InferencePool
+        image: array with the axes of the model input (e.g. bcyx), its first input
+        tile_size: int, or dictionary by axis name, wanted tile size in input pixels;
+            None for the tuned one, else TILE_SIZE_DEFAULT
+        halo: int, or dictionary by axis name, halo in input pixels overriding the model's
+        batch_size: int, tiles predicted at once along the "b" axis of an image with a single
+            batch; None for the tuned one, else 1
+        out: array to write the output to, with the axes and shape of the first output;
+            or string, path of a .npy file created as a memory-mapped output; None to allocate it
+        progress: function called with (tiles done, number of tiles) after each tile
+        cancel: event, when set the prediction stops with PredictionCancelled
+    Returns:
+        The output array, with the axes of the first model output
+    """
+    input_spec, output_spec = pipeline.input_specs[0], pipeline.output_specs[0]
+    axes = tuple(input_spec.axes)
+    if len(image.shape) != len(axes):
+        raise ValueError(f"The image has {len(image.shape)} dimensions, the model expects axes {''.join(axes)}")
+
+    from ._tuning import apply_threads, tuning_for
+
+    tuning = tuning_for(pipeline) if tile_size is None or batch_size is None else None
+    if tuning is not None:
+        tile_size = tuning["tile"] if tile_size is None else tile_size
+        batch_size = tuning["batch_size"] if batch_size is None else batch_size
+        if not hasattr(pipeline, "submit"):
+            # the workers of a pool have their own thread count
+            apply_threads(tuning.get("threads"))
+    tile_size = TILE_SIZE_DEFAULT if tile_size is None else tile_size
+    if "b" not in axes or image.shape[axes.index("b")] != 1:
+        batch_size = 1
+    batch_size = max(1, batch_size or 1)
+
+    tiling = plan_tiling(input_spec, output_spec, image.shape, tile_size=tile_size, halo=halo)
+    spatial = {axis.name: axis for axis in tiling}
+    weights = {axis.name: _axis_weights(axis) for axis in tiling}
+    tiles = list(itertools.product(*[range(len(axis.starts)) for axis in tiling]))
+    result = None
+
+    def read_tile(tile_index: typing.Tuple[int, ...]) -> np.ndarray:
+        in_slices, pad = [], []
+        for name in axes:
+            if name in spatial:
+                axis = spatial[name]
+                start = axis.starts[tile_index[tiling.index(axis)]]
+                stop = min(start + axis.tile, axis.size)
+                in_slices.append(slice(start, stop))
+                pad.append((0, axis.tile - (stop - start)))
+            else:
+                in_slices.append(slice(None))
+                pad.append((0, 0))
+        tile = np.asarray(image[tuple(in_slices)])
+        if any(after for _, after in pad):
+            tile = np.pad(tile, pad, mode="symmetric")
+        return tile
+
+    def accumulate(tile_index: typing.Tuple[int, ...], prediction: xr.DataArray) -> None:
+        nonlocal result
+        positions = {axis.name: position for axis, position in zip(tiling, tile_index)}
+        out_axes = tuple(prediction.dims)
+        prediction = prediction.values
+        if result is None:
+            shape = tuple(
+                round(spatial[name].size * spatial[name].scale) if name in spatial else size
+                for name, size in zip(out_axes, prediction.shape)
+            )
+            result = _open_output(out, shape, np.result_type(prediction.dtype, np.float32))
+
+        out_slices, tile_slices = [], []
+        # product of the weights of each spatial axis, with size one along the other axes
+        weight = np.ones((), dtype="float32")
+        for name in out_axes:
+            if name in spatial:
+                axis_weight = weights[name][positions[name]]
+                start = round(spatial[name].starts[positions[name]] * spatial[name].scale)
+                out_slices.append(slice(start, start + len(axis_weight)))
+                tile_slices.append(slice(0, len(axis_weight)))
+                weight = weight[..., None] * axis_weight
+            else:
+                out_slices.append(slice(None))
+                tile_slices.append(slice(None))
+                weight = weight[..., None]
+        result[tuple(out_slices)] += prediction[tuple(tile_slices)] * weight
+
+    def read_batch(batch: typing.List[typing.Tuple[int, ...]]) -> xr.DataArray:
+        if len(batch) == 1:
+            return xr.DataArray(read_tile(batch[0]), dims=axes)
+        b = axes.index("b")
+        tensor = np.concatenate([read_tile(tile_index) for tile_index in batch], axis=b)
+        # a smaller last batch is filled up by repeating its last tile if the model needs it
+        fill = _valid_tile(input_spec.shape, b, len(batch)) - len(batch)
+        if fill > 0:
+            tensor = np.pad(tensor, [(0, fill) if index == b else (0, 0) for index in range(len(axes))], mode="edge")
+        return xr.DataArray(tensor, dims=axes)
+
+    def accumulate_batch(batch: typing.List[typing.Tuple[int, ...]], prediction: xr.DataArray) -> None:
+        nonlocal done
+        for position, tile_index in enumerate(batch):
+            accumulate(tile_index, prediction if len(batch) == 1 else prediction.isel(b=slice(position, position + 1)))
+        done += len(batch)
+        if progress is not None:
+            progress(done, len(tiles))
+
+    batches = [tiles[start : start + batch_size] for start in range(0, len(tiles), batch_size)]
+    # a pool of worker processes runs several batches at once, the others one after the other
+    max_in_flight = getattr(pipeline, "max_in_flight", 1) if hasattr(pipeline, "submit") else 0
+    pending: typing.Deque[typing.Tuple[typing.List[typing.Tuple[int, ...]], typing.Any]] = collections.deque()
+    done = 0
+    for batch in batches:
+        if cancel is not None and cancel.is_set():
+            for _, future in pending:
+                future.cancel()
+            raise PredictionCancelled()
+        tensor = read_batch(batch)
+        if not max_in_flight:
+            accumulate_batch(batch, pipeline(tensor)[0])
+        else:
+            pending.append((batch, pipeline.submit(tensor)))
+            if len(pending) < max_in_flight:
+                continue
+            # the batches are accumulated in order, whatever order the workers finish them in
+            pending_batch, future = pending.popleft()
+            accumulate_batch(pending_batch, future.result()[0])
+    while pending:
+        pending_batch, future = pending.popleft()
+        accumulate_batch(pending_batch, future.result()[0])
+
+    if isinstance(result, np.memmap):
+        result.flush()
+    return result
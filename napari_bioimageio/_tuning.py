@@ -0,0 +1,270 @@
+"""Per machine tuning of the tile size, batch size and thread count used to run a model."""
+
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import typing
+
+import numpy as np
+import xarray as xr
+
+from . import _utils
+from ._blobs import hash_file
+
+TUNING_DIRECTORY_NAME = "tuning"
+TUNING_FORMAT = 2
+TILE_SIZES_DEFAULT = (64, 128, 256, 512, 1024)
+BATCH_SIZES_DEFAULT = (1, 2, 4, 8)
+MEMORY_SAMPLE_INTERVAL = 0.01
+
+_tunings: typing.Dict[str, typing.Tuple[int, typing.Optional[str], typing.Dict[str, typing.Any]]] = {}
+_rdf_hashes: typing.Dict[str, typing.Tuple[int, str]] = {}
+_tunings_lock = threading.Lock()
+
+
+def host_name() -> str:
+    """Identifies the machine a tuning was measured on; a models directory can be shared by several."""
+    return f"{platform.node()}/{platform.machine()}/{os.cpu_count()}"
+
+
+def _tuning_file(folder_id: str) -> str:
+    # in the cache rather than in the model folder, which reinstalling the model replaces
+    return os.path.join(_utils.get_cache_path(), TUNING_DIRECTORY_NAME, *folder_id.split("/")) + ".json"
+
+
+def _rdf_hash(folder_id: str) -> typing.Optional[str]:
+    # the tunings measured for another rdf.yaml, e.g. other weights under the same version, are stale
+    rdf_file = os.path.join(_utils.get_models_path(), folder_id, "rdf.yaml")
+    try:
+        mtime_ns = os.stat(rdf_file).st_mtime_ns
+        with _tunings_lock:
+            cached = _rdf_hashes.get(rdf_file)
+            if cached is not None and cached[0] == mtime_ns:
+                return cached[1]
+        digest = hash_file(rdf_file)
+    except OSError:
+        return None
+    with _tunings_lock:
+        _rdf_hashes[rdf_file] = (mtime_ns, digest)
+    return digest
+
+
+def _read_tunings(tuning_file: str, rdf_hash: typing.Optional[str]) -> typing.Dict[str, typing.Any]:
+    try:
+        mtime_ns = os.stat(tuning_file).st_mtime_ns
+    except OSError:
+        return {}
+    with _tunings_lock:
+        cached = _tunings.get(tuning_file)
+    if cached is None or cached[0] != mtime_ns:
+        try:
+            with open(tuning_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("format") == TUNING_FORMAT:
+                cached = (mtime_ns, data["rdf_sha256"], data["hosts"])
+            else:
+                cached = (mtime_ns, None, {})
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            cached = (mtime_ns, None, {})
+        with _tunings_lock:
+            _tunings[tuning_file] = cached
+    return cached[2] if rdf_hash is not None and cached[1] == rdf_hash else {}
+
+
+def get_tuning(model_id: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """Gets the configuration tuned for a model on this machine.
+
+    Args:
+        model_id: string, id of the model, as given to load_model_by_id()
+    Returns:
+        Python dictionary with the tile size by axis ("tile"), "batch_size" and "threads", or None
+    """
+    folder_id = _utils._model_folder_id(model_id).strip("/")
+    return _read_tunings(_tuning_file(folder_id), _rdf_hash(folder_id)).get(host_name())
+
+
+def tuning_for(pipeline: typing.Any) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """Gets the configuration tuned on this machine for the model of a cached pipeline or a pool."""
+    model_id = getattr(pipeline, "model_id", None)
+    if model_id is None:
+        from ._pipelines import get_pipeline_cache
+
+        folder_id = get_pipeline_cache().model_id(pipeline)
+        if folder_id is None:
+            return None
+        # get_tuning() takes the id with the version appended, as given to load_model_by_id()
+        model_id = folder_id + "/"
+    return get_tuning(model_id)
+
+
+def apply_threads(threads: typing.Optional[int]) -> None:
+    """Sets the intra-op thread count of the deep learning libraries already imported."""
+    if not threads:
+        return
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads)
+    if "tensorflow" in sys.modules:
+        try:
+            sys.modules["tensorflow"].config.threading.set_intra_op_parallelism_threads(threads)
+        except RuntimeError:
+            # only possible before tensorflow initialized
+            pass
+
+
+def _fit(tensor: np.ndarray, shape: typing.Sequence[int]) -> np.ndarray:
+    # crops or mirrors the test tensor to the measured shape
+    tensor = tensor[tuple(slice(0, size) for size in shape)]
+    pad = [(0, size - current) for size, current in zip(shape, tensor.shape)]
+    if any(after for _, after in pad):
+        tensor = np.pad(tensor, pad, mode="symmetric" if min(tensor.shape) > 0 else "constant")
+    return tensor
+
+
+def _rss() -> int:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0
+
+
+def _measure(run: typing.Callable[[], typing.Any], repeats: int) -> typing.Tuple[float, int]:
+    """Times run() and samples the resident memory meanwhile.
+
+    Returns:
+        Tuple (seconds per run, peak resident memory growth in bytes)
+    """
+    run()  # warm up, e.g. kernel selection and allocations
+    baseline = peak = _rss()
+    stop = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not stop.wait(MEMORY_SAMPLE_INTERVAL):
+            peak = max(peak, _rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        for _ in range(repeats):
+            run()
+    finally:
+        elapsed = (time.perf_counter() - start) / repeats
+        stop.set()
+        sampler.join()
+    return elapsed, max(0, max(peak, _rss()) - baseline)
+
+
+def tune_model(
+    model_id: str,
+    tile_sizes: typing.Sequence[int] = TILE_SIZES_DEFAULT,
+    batch_sizes: typing.Sequence[int] = BATCH_SIZES_DEFAULT,
+    threads: typing.Optional[typing.Sequence[int]] = None,
+    max_memory: typing.Union[int, str, None] = None,
+    repeats: int = 3,
+    weight_format: typing.Optional[str] = None,
+    devices: typing.Optional[typing.Sequence[str]] = None,
+) -> typing.Dict[str, typing.Any]:
+    """Measures a model on this machine and saves the fastest configuration.
+
+    The first test input of the model is cropped or mirrored to a grid of tile sizes accepted by
+    its input shape (min + n * step), batched, and run with each thread count. The configuration
+    predicting the most pixels per second, not counting the halo, within max_memory is saved in
+    the cache directory, for this rdf.yaml of the model and under the name of this machine, so it
+    survives a reinstall of the same model. predict_tiled() then uses its tile size, batch size and
+    thread count by default.
+    Args:
+        model_id: string, id of the model, as given to load_model_by_id()
+        tile_sizes: list of wanted tile sizes, rounded up to sizes the model accepts
+        batch_sizes: list of batch sizes, only used if the model input has a batch axis
+        threads: list of intra-op thread counts, by default powers of two up to the number of cores
+        max_memory: int or string (e.g. "8G"), memory a configuration may use, None for no limit
+        repeats: int, runs measured per configuration
+        weight_format: string, weight format to run, None to let bioimageio.core choose
+        devices: list of device names (e.g. ["cuda"]), None to let bioimageio.core choose
+    Returns:
+        Python dictionary with the best configuration and all the measurements
+    """
+    from ._pipelines import use_pipeline
+    from ._tiling import HALO_DEFAULT, _output_halo, _valid_tile
+    from ._usage import parse_size
+
+    max_memory = parse_size(max_memory)
+    model = _utils.load_model(model_id)
+    if model is None:
+        raise FileNotFoundError(f"Model {model_id} is not installed")
+    input_spec, output_spec = model.inputs[0], model.outputs[0]
+    axes = tuple(input_spec.axes)
+    test_input = np.load(str(model.test_inputs[0]))
+    if threads is None:
+        threads = [2 ** i for i in range(int(np.log2(os.cpu_count() or 1)) + 1)]
+
+    spatial = [index for index, axis in enumerate(axes) if axis in "zyx"]
+    tile_shapes = sorted(
+        {tuple(_valid_tile(input_spec.shape, index, size) for index in spatial) for size in tile_sizes}
+    )
+    if "b" in axes:
+        batch_sizes = sorted({_valid_tile(input_spec.shape, axes.index("b"), size) for size in batch_sizes})
+    else:
+        batch_sizes = [1]
+    measurements = []
+    with use_pipeline(model_id, weight_format=weight_format, devices=devices) as pipeline:
+        # the deep learning library is imported when the pipeline is loaded
+        if "torch" not in sys.modules and "tensorflow" not in sys.modules:
+            # the thread count cannot be set, measuring it would only repeat the same runs
+            threads = [None]
+        for tile_shape in tile_shapes:
+            tile_shape = dict(zip(spatial, tile_shape))
+            for batch_size in batch_sizes:
+                shape = [
+                    tile_shape[index] if index in tile_shape else batch_size if axis == "b" else test_input.shape[index]
+                    for index, axis in enumerate(axes)
+                ]
+                tensor = xr.DataArray(_fit(test_input, shape), dims=axes)
+                useful = batch_size
+                for index in spatial:
+                    halo = _output_halo(output_spec, axes[index])
+                    halo = HALO_DEFAULT if halo is None else halo
+                    useful *= max(1, tile_shape[index] - 2 * halo)
+                for thread_count in threads:
+                    apply_threads(thread_count)
+                    try:
+                        seconds, memory = _measure(lambda: pipeline(tensor), repeats)
+                    except Exception as excep:
+                        # e.g. out of memory: larger tiles or batches will not do better
+                        print(f"Could not run the model on {shape} tiles:", str(excep))
+                        continue
+                    measurements.append(
+                        {
+                            "tile": {axes[index]: size for index, size in tile_shape.items()},
+                            "batch_size": batch_size,
+                            "threads": thread_count,
+                            "throughput": useful / seconds,
+                            "peak_memory": memory,
+                        }
+                    )
+
+    candidates = [m for m in measurements if max_memory is None or m["peak_memory"] <= max_memory]
+    if not candidates:
+        raise RuntimeError(f"No configuration of {model_id} could run within the memory limit")
+    best = dict(max(candidates, key=lambda m: m["throughput"]))
+    apply_threads(best["threads"])
+    best["weight_format"] = weight_format
+    best["devices"] = list(devices) if devices else None
+    best["tuned"] = time.time()
+
+    folder_id = _utils._model_folder_id(model_id).strip("/")
+    tuning_file = _tuning_file(folder_id)
+    rdf_hash = _rdf_hash(folder_id)
+    hosts = dict(_read_tunings(tuning_file, rdf_hash))
+    hosts[host_name()] = best
+    os.makedirs(os.path.dirname(tuning_file), exist_ok=True)
+    tmp_file = f"{tuning_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump({"format": TUNING_FORMAT, "rdf_sha256": rdf_hash, "hosts": hosts}, f, indent=2)
+    os.replace(tmp_file, tuning_file)
+    return {**best, "measurements": measurements}
@@ -0,0 +1,146 @@
+"""Disk usage accounting and least recently used eviction of the installed models."""
+
+import json
+import os
+import threading
+import time
+import typing
+
+USAGE_FORMAT = 1
+_SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(size: typing.Union[int, float, str, None]) -> typing.Optional[int]:
+    """Parses a size given in bytes or with a K, M, G or T suffix (powers of 1024), e.g. "20G".
+
+    Returns:
+        Size in bytes, None for None, an empty string or "none"
+    """
+    if size is None:
+        return None
+    if isinstance(size, (int, float)):
+        return int(size)
+    size = size.strip().upper().rstrip("B").rstrip("I")
+    if size in ("", "NONE"):
+        return None
+    unit = size[-1] if size[-1] in _SIZE_UNITS else ""
+    return int(float(size[: len(size) - len(unit)]) * _SIZE_UNITS[unit])
+
+
+class UsageLog:
+    """Time each model version was last used, persisted as JSON and shared between processes.
+
+    Concurrent writers merge with what is on disk before writing, so a timestamp can at worst be
+    lost to a simultaneous update, which only makes the eviction order approximate.
+    """
+
+    def __init__(self, usage_file: str):
+        self.usage_file = usage_file
+        self._lock = threading.Lock()
+
+    def _read(self) -> typing.Dict[str, float]:
+        try:
+            with open(self.usage_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("format") != USAGE_FORMAT:
+                return {}
+            return {str(k): float(v) for k, v in data["last_used"].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return {}
+
+    def _write(self, last_used: typing.Dict[str, float]) -> None:
+        tmp_file = f"{self.usage_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.usage_file), exist_ok=True)
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump({"format": USAGE_FORMAT, "last_used": last_used}, f)
+            os.replace(tmp_file, self.usage_file)
+        except OSError as excep:
+            print("Could not write the models usage:", str(excep))
+
+    def last_used(self) -> typing.Dict[str, float]:
+        """Gets the time (seconds since the epoch) each model version was last used, by model id."""
+        with self._lock:
+            return self._read()
+
+    def touch(self, model_id: str) -> None:
+        """Records that a model version is used now."""
+        with self._lock:
+            last_used = self._read()
+            last_used[model_id] = time.time()
+            self._write(last_used)
+
+    def forget(self, model_id: str) -> None:
+        """Forgets a removed model version."""
+        with self._lock:
+            last_used = self._read()
+            if last_used.pop(model_id, None) is not None:
+                self._write(last_used)
+
+
+def _folder_inodes(
+    folder: str, include_hidden: bool = True
+) -> typing.Dict[typing.Tuple[int, int], typing.List[int]]:
+    # [links found below folder, total number of links, size] by (device, inode)
+    inodes: typing.Dict[typing.Tuple[int, int], typing.List[int]] = {}
+    for directory, subdirectories, files in os.walk(folder):
+        if not include_hidden:
+            subdirectories[:] = [name for name in subdirectories if not name.startswith(".")]
+        for file_name in files:
+            try:
+                stat = os.stat(os.path.join(directory, file_name), follow_symlinks=False)
+            except OSError:
+                continue
+            inode = inodes.setdefault((stat.st_dev, stat.st_ino), [0, stat.st_nlink, stat.st_size])
+            inode[0] += 1
+    return inodes
+
+
+def folder_usage(folder: str) -> typing.Tuple[int, int]:
+    """Measures the disk usage of a model version directory whose files may be shared.
+
+    Args:
+        folder: string, path of the directory
+    Returns:
+        Tuple (size, exclusive size): the bytes of all its files, counting hard linked files once,
+        and the bytes freed by removing it, i.e. of the files no other model version links to
+    """
+    size = exclusive = 0
+    for links_here, links, file_size in _folder_inodes(folder).values():
+        size += file_size
+        # the only other link of an exclusive file is the blob store's
+        if links - links_here <= 1:
+            exclusive += file_size
+    return size, exclusive
+
+
+def directory_size(directory: str, include_hidden: bool = True) -> int:
+    """Gets the bytes used by all the files below directory, counting hard linked files once.
+
+    Args:
+        directory: string, path of the directory
+        include_hidden: bool, False to leave out the directories whose name starts with a dot,
+            e.g. the caches, locks and staging folders of the models directory
+    """
+    return sum(file_size for _, _, file_size in _folder_inodes(directory, include_hidden).values())
+
+
+def is_pinned(model_id: str, pinned: typing.Iterable[str]) -> bool:
+    """Tells if a model version is pinned, either itself or through its model id."""
+    return any(model_id == pin or model_id.startswith(pin + "/") for pin in (p.strip("/") for p in pinned) if pin)
+
+
+def eviction_order(
+    model_ids: typing.Iterable[str],
+    last_used: typing.Dict[str, float],
+    pinned: typing.Iterable[str] = (),
+) -> typing.List[str]:
+    """Orders the model versions that may be evicted, least recently used first.
+
+    Model versions never used are ordered as if last used when they were installed, which the
+    caller gives through last_used too. Pinned model versions, or all the versions of a pinned
+    model id, are never evicted.
+    """
+    pinned = list(pinned)
+    candidates = [model_id for model_id in model_ids if not is_pinned(model_id, pinned)]
+    return sorted(candidates, key=lambda model_id: (last_used.get(model_id, 0.0), model_id))
@@ -1,21 +1,46 @@
 """Helping library to ease interaction between napari and bioimageio.core."""
 
-import glob
+import contextlib
 import json
 import os
 import shutil
+import threading
+import time
 import typing
 import urllib.error
 import urllib.request
-import zipfile
 
 import bioimageio.core
 import bioimageio.spec
 import yaml
 from bioimageio.core.resource_io.nodes import ResourceDescription
 
+from . import _download, _usage
+from ._download import DownloadJob, DownloadManager
+from ._blobs import BlobStore
+from ._catalog import CatalogEntry, parse_collection
+from ._locks import FileLock, ModelLockedError, lock_file, locked, locked_model_ids
+from ._registry import ModelRegistry
+from ._watcher import ModelStoreEvent, ModelStoreWatcher
+
 MODELS_DIRECTORY_DEFAULT = os.path.expanduser("~/bioimageio-models")
 RDF_URL_DEFAULT = "https://raw.githubusercontent.com/bioimage-io/collection-bioimage-io/gh-pages/collection.json"
+CATALOG_TTL_DEFAULT = 3600
+# seconds without an answer from the server before falling back to the cached collection
+CATALOG_TIMEOUT = 30
+CACHE_DIRECTORY_NAME = ".cache"
+BLOBS_DIRECTORY_NAME = ".blobs"
+
+# libyaml bindings are used whenever PyYAML was built with them
+YamlDumper = getattr(yaml, "CDumper", yaml.Dumper)
+
+DOWNLOAD_WORKERS_DEFAULT = 3
+
+_registries: typing.Dict[str, ModelRegistry] = {}
+_registries_lock = threading.Lock()
+_download_manager: typing.Optional[DownloadManager] = None
+_swept_directories: typing.Set[str] = set()
+_usage_logs: typing.Dict[str, _usage.UsageLog] = {}
 
 
 def set_models_path(path: str) -> None:
@@ -46,101 +71,503 @@ def get_rdf_url() -> str:
     return os.environ.get("BIOIMAGEIO_NAPARI_RDF_URL", RDF_URL_DEFAULT)
 
 
-def get_model_list() -> typing.List[typing.Dict[str, str]]:
-    """Produces a convenient python dictionary with all the available models in BioimageIO collection.
+def set_catalog_ttl(seconds: float) -> None:
+    """Sets how long the cached collection JSON is served without contacting the server.
 
-    For each item in the collection it creates an entry per version available with the following fields:
-    id, version, name, description, tags, nickname, nickname_icon
+    Args:
+        seconds: float, time to live of the cached collection, 0 to always revalidate
+    """
+    os.environ["BIOIMAGEIO_NAPARI_CATALOG_TTL"] = str(seconds)
+
+
+def get_catalog_ttl() -> float:
+    """Gets the time to live in seconds of the cached collection JSON."""
+    try:
+        return float(os.environ.get("BIOIMAGEIO_NAPARI_CATALOG_TTL", CATALOG_TTL_DEFAULT))
+    except ValueError:
+        return CATALOG_TTL_DEFAULT
+
+
+def get_cache_path() -> str:
+    """Gets the cache directory, a hidden folder inside the models directory."""
+    return os.path.join(get_models_path(), CACHE_DIRECTORY_NAME)
+
+
+def _read_cached_collection(cache_file: str, meta_file: str) -> typing.Tuple[typing.Optional[bytes], typing.Dict]:
+    try:
+        with open(meta_file, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(cache_file, "rb") as f:
+            return f.read(), meta
+    except (OSError, ValueError):
+        return None, {}
+
+
+def _write_cached_collection(cache_file: str, meta_file: str, body: typing.Optional[bytes], meta: typing.Dict) -> None:
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        if body is not None:
+            with open(cache_file + ".tmp", "wb") as f:
+                f.write(body)
+            os.replace(cache_file + ".tmp", cache_file)
+        with open(meta_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(meta_file + ".tmp", meta_file)
+    except OSError as excep:
+        print("Could not write the collection cache:", str(excep))
+
+
+def _remove_cached_collection() -> None:
+    for name in ("collection.json", "collection.meta.json"):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(get_cache_path(), name))
+
+
+def fetch_collection(force: bool = False) -> typing.Optional[bytes]:
+    """Gets the raw collection JSON, going through an on-disk cache.
+
+    The cached body is served as is while it is younger than the catalog TTL, afterwards it is
+    revalidated with a conditional request (ETag / Last-Modified) so that an unchanged collection
+    costs a 304 instead of a full download. If the server cannot be reached or does not answer
+    within CATALOG_TIMEOUT seconds, the cached copy is used.
+    Args:
+        force: bool, true to revalidate the cache even if it has not expired
     Returns:
-        Python dictionary with all available models information
+        Bytes of the collection JSON, or None if it is neither reachable nor cached
     """
-    result: typing.List[typing.Dict[str, str]] = []
+    rdf_url = get_rdf_url()
+    cache_file = os.path.join(get_cache_path(), "collection.json")
+    meta_file = os.path.join(get_cache_path(), "collection.meta.json")
+    body, meta = _read_cached_collection(cache_file, meta_file)
+    if body is not None and meta.get("url") != rdf_url:
+        body, meta = None, {}
+
+    if body is not None and not force and time.time() - meta.get("fetched_at", 0) < get_catalog_ttl():
+        return body
+
+    request = urllib.request.Request(rdf_url)
+    if body is not None:
+        if meta.get("etag"):
+            request.add_header("If-None-Match", meta["etag"])
+        if meta.get("last_modified"):
+            request.add_header("If-Modified-Since", meta["last_modified"])
+
     try:
-        rdf_url = get_rdf_url()
-        with urllib.request.urlopen(rdf_url) as url:
-            data = json.loads(url.read().decode())
-            if isinstance(data, dict) and isinstance(data["collection"], list):
-                for summary in data["collection"]:
-                    if isinstance(summary, dict) and summary["type"] == "model":
-                        result.append(yaml.safe_load(yaml.dump(summary, default_flow_style=False)))
-            result = sorted(result, key=lambda d: d["name"])
-    except urllib.error.URLError as excep:
+        with urllib.request.urlopen(request, timeout=CATALOG_TIMEOUT) as url:
+            new_body = url.read()
+            meta = {
+                "url": rdf_url,
+                "etag": url.headers.get("ETag"),
+                "last_modified": url.headers.get("Last-Modified"),
+                "fetched_at": time.time(),
+            }
+        _write_cached_collection(cache_file, meta_file, new_body, meta)
+        return new_body
+    except urllib.error.HTTPError as excep:
+        if excep.code == 304 and body is not None:
+            meta["fetched_at"] = time.time()
+            _write_cached_collection(cache_file, meta_file, None, meta)
+            return body
         print(excep.reason)
+    except OSError as excep:
+        # unreachable, timed out or reset by the server
+        print("Could not fetch the model collection:", str(excep))
 
-    return result
+    return body
+
+
+def get_model_list() -> typing.List[CatalogEntry]:
+    """Produces a convenient list with all the available models in BioimageIO collection.
+
+    For each item in the collection it creates a compact, read-only dictionary-like entry with the following fields:
+    id, name, description, tags, versions, nickname, nickname_icon, rdf_source
+    Returns:
+        List with all available models information
+    """
+    for force in (False, True):
+        body = fetch_collection(force=force)
+        if body is None:
+            return []
+        try:
+            return parse_collection(json.loads(body))
+        except ValueError as excep:
+            # a truncated or corrupt copy, dropped so that it is downloaded again
+            print("Could not parse the model collection:", str(excep))
+            _remove_cached_collection()
+
+    return []
+
+
+def get_blob_store() -> BlobStore:
+    """Gets the content-addressed store deduplicating the files of the models directory."""
+    return BlobStore(os.path.join(get_models_path(), BLOBS_DIRECTORY_NAME))
 
 
-def get_downloaded_models() -> typing.List[ResourceDescription]:
+def get_model_registry() -> ModelRegistry:
+    """Gets the registry of the models installed in the current models directory."""
+    models_directory = get_models_path()
+    with _registries_lock:
+        if models_directory not in _registries:
+            _registries[models_directory] = ModelRegistry(
+                models_directory, os.path.join(get_cache_path(), "registry.json")
+            )
+        return _registries[models_directory]
+
+
+def get_downloaded_models() -> typing.List[typing.Dict[str, typing.Any]]:
     """Produces a convenient python dictionary with all the currently downloaded models.
 
+    The models are listed from the registry kept in the models directory, so rdf.yaml files
+    are only parsed again when they changed since the last listing.
     For each item in the collection it creates an entry per version available with the following fields:
     id, version, name, description, tags, nickname, nickname_icon
     Returns:
         Python dictionary with all available models information
     """
-    result: typing.List[typing.Dict[str, str]] = []
-    models_directory = get_models_path()
-    for file in glob.glob(models_directory + "/**/rdf.yaml", recursive=True):
-        model_info = bioimageio.core.load_raw_resource_description(file)
-        result.append(
-            bioimageio.spec.serialize_raw_resource_description_to_dict(
-                bioimageio.core.load_raw_resource_description(file)
-            )
-        )
+    cleanup_models_directory()
+    registry = get_model_registry()
+    result = registry.list_models()
+    for rdf_file, error in registry.failures().items():
+        print("Could not read model:", rdf_file, error)
 
     result = sorted(result, key=lambda d: d['name'])
 
     return result
 
 
-def download_model(model_id: str, overwrite: bool) -> typing.Any:
+def watch_models(
+    callback: typing.Callable[[typing.List[ModelStoreEvent]], None], interval: typing.Optional[float] = None
+) -> ModelStoreWatcher:
+    """Starts watching the models directory for installed, removed or modified model versions.
+
+    Args:
+        callback: function called from a background thread with the list of ModelStoreEvent
+            (kind, model_folder, summary) detected, kind being "added", "removed" or "modified"
+        interval: float, seconds between two checks of the directory when native notifications
+            are not available (see the optional watchdog package)
+    Returns:
+        Running watcher, call its stop() method to stop watching
+    """
+    return ModelStoreWatcher(get_model_registry(), callback, interval).start()
+
+
+def set_weight_formats(weight_formats: typing.Optional[typing.Sequence[str]]) -> None:
+    """Sets the weight formats installed by default, by order of preference.
+
+    Only the first format of the list provided by a model is downloaded, which saves the bytes of the
+    formats this machine cannot run; models providing none of them are installed with all their weights.
+    Args:
+        weight_formats: list of weight formats (e.g. ["torchscript", "onnx"]), None to install every format
+    """
+    os.environ["BIOIMAGEIO_NAPARI_WEIGHT_FORMATS"] = ",".join(weight_formats or [])
+
+
+def get_weight_formats() -> typing.Optional[typing.List[str]]:
+    """Gets the weight formats installed by default, None if every format is installed."""
+    weight_formats = [f.strip() for f in os.environ.get("BIOIMAGEIO_NAPARI_WEIGHT_FORMATS", "").split(",") if f.strip()]
+    return weight_formats or None
+
+
+def set_models_quota(quota: typing.Union[int, str, None]) -> None:
+    """Sets the disk space the models directory may use, least recently used models being evicted beyond.
+
+    Args:
+        quota: int, bytes, or string with a K, M, G or T suffix (e.g. "20G"); None for no limit
+    """
+    os.environ["BIOIMAGEIO_NAPARI_MODELS_QUOTA"] = "" if quota is None else str(quota)
+
+
+def get_models_quota() -> typing.Optional[int]:
+    """Gets the disk space in bytes the models directory may use, None if unlimited."""
+    try:
+        return _usage.parse_size(os.environ.get("BIOIMAGEIO_NAPARI_MODELS_QUOTA"))
+    except ValueError:
+        return None
+
+
+def set_pinned_models(model_ids: typing.Optional[typing.Sequence[str]]) -> None:
+    """Sets the models that are never evicted to respect the quota.
+
+    Args:
+        model_ids: list of model ids, with the version to pin a single version, or None to pin none
+    """
+    os.environ["BIOIMAGEIO_NAPARI_PINNED_MODELS"] = ",".join(model_ids or [])
+
+
+def get_pinned_models() -> typing.List[str]:
+    """Gets the models that are never evicted to respect the quota."""
+    pinned = os.environ.get("BIOIMAGEIO_NAPARI_PINNED_MODELS", "")
+    return [model_id.strip() for model_id in pinned.split(",") if model_id.strip()]
+
+
+def get_usage_log() -> _usage.UsageLog:
+    """Gets the log of the time each model of the current models directory was last loaded."""
+    models_directory = get_models_path()
+    with _registries_lock:
+        if models_directory not in _usage_logs:
+            _usage_logs[models_directory] = _usage.UsageLog(os.path.join(get_cache_path(), "usage.json"))
+        return _usage_logs[models_directory]
+
+
+def _installed_models() -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    # registry entries of the installed model versions, by id relative to the models directory
+    models_directory = get_models_path()
+    return {
+        os.path.relpath(os.path.dirname(rdf_file), models_directory).replace(os.sep, "/"): entry
+        for rdf_file, entry in get_model_registry().entries().items()
+        if entry["summary"] is not None
+    }
+
+
+def _last_used(installed: typing.Dict[str, typing.Dict[str, typing.Any]]) -> typing.Dict[str, float]:
+    # the models never loaded count as last used when installed
+    last_used = {model_id: entry["mtime_ns"] / 1e9 for model_id, entry in installed.items()}
+    last_used.update({model_id: t for model_id, t in get_usage_log().last_used().items() if model_id in installed})
+    return last_used
+
+
+def evict_models(keep: typing.Iterable[str] = ()) -> typing.List[str]:
+    """Removes the least recently used models until the models directory fits in its quota.
+
+    Pinned models, the models in keep and the models in use by any process are never removed.
+    Args:
+        keep: list of model ids (including the version) to keep
+    Returns:
+        List of the ids of the removed models
+    """
+    quota = get_models_quota()
+    if quota is None:
+        return []
+    models_directory = get_models_path()
+    # only the model folders count: evicting models cannot shrink the caches, locks or staging folders
+    used = _usage.directory_size(models_directory, include_hidden=False)
+    if used <= quota:
+        return []
+
+    keep = {str(model_id).strip("/") for model_id in keep}
+    installed = _installed_models()
+    candidates = [model_id for model_id in installed if model_id not in keep]
+    evicted = []
+    for model_id in _usage.eviction_order(candidates, _last_used(installed), get_pinned_models()):
+        if used <= quota:
+            break
+        try:
+            remove_model(model_id)
+        except ModelLockedError:
+            continue
+        print("Evicted model to respect the models quota:", model_id)
+        evicted.append(model_id)
+        used = _usage.directory_size(models_directory, include_hidden=False)
+    if used > quota:
+        print(f"The models directory uses {used} bytes, more than its quota of {quota} bytes")
+    return evicted
+
+
+def get_disk_usage() -> typing.Dict[str, typing.Any]:
+    """Reports the disk space used by the models directory and by each installed model.
+
+    Files shared by several models through the blob store are counted once in the total.
+    Returns:
+        Python dictionary with the bytes used by the models ("total"), which the quota applies to,
+        the bytes used by the caches, e.g. the prediction results ("cache"), the quota in bytes or
+        None ("quota"), and the list of installed models ("models", largest first) with for each: id, name, folder,
+        size (bytes of its files), exclusive_size (bytes freed by removing it), last_used (seconds
+        since the epoch) and pinned
+    """
+    models_directory = get_models_path()
+    installed = _installed_models()
+    last_used = _last_used(installed)
+    pinned = get_pinned_models()
+    models = []
+    for model_id, entry in installed.items():
+        folder = os.path.join(models_directory, model_id)
+        size, exclusive_size = _usage.folder_usage(folder)
+        models.append(
+            {
+                "id": model_id,
+                "name": entry["summary"].get("name"),
+                "folder": folder,
+                "size": size,
+                "exclusive_size": exclusive_size,
+                "last_used": last_used[model_id],
+                "pinned": _usage.is_pinned(model_id, pinned),
+            }
+        )
+    models.sort(key=lambda model: model["size"], reverse=True)
+    total = _usage.directory_size(models_directory, include_hidden=False) if os.path.isdir(models_directory) else 0
+    return {
+        "total": total,
+        "cache": _usage.directory_size(get_cache_path()) if os.path.isdir(get_cache_path()) else 0,
+        "quota": get_models_quota(),
+        "models": models,
+    }
+
+
+def download_model(
+    model_id: str,
+    overwrite: bool,
+    weight_formats: typing.Optional[typing.Sequence[str]] = None,
+    progress: typing.Optional[typing.Callable[[str, int, int], None]] = None,
+    cancel: typing.Optional[threading.Event] = None,
+) -> typing.Any:
     """Download an existing BioimageIO model in the local model folder.
 
-    The model contents will be decompressed in the
+    The model files are streamed to a hidden staging directory next to the
         [base model folder + model_id] directory
+    and checked against their declared sha256 before the staging directory is renamed into place,
+    so a crash never leaves a half installed model. An interrupted download is resumed rather than
+    restarted.
     Args:
         model_id: string, id of the model
         overwrite: bool, true to force re-install
+        weight_formats: list of weight formats by order of preference, only the first one available
+            is downloaded; defaults to get_weight_formats()
+        progress: function called with (file name, bytes received, expected file size or 0 if unknown)
+        cancel: event, when set the download stops with DownloadCancelled and can be resumed later
     Returns:
         String in YAML format with the full model information
     """
+    if weight_formats is None:
+        weight_formats = get_weight_formats()
     models_directory = get_models_path()
     model_download_folder = os.path.join(models_directory, str(model_id))
-    destination_file = os.path.join(model_download_folder, "model.zip")
     yaml_file = os.path.join(model_download_folder, "rdf.yaml")
-    if os.path.exists(model_download_folder):
-        if overwrite:
-            shutil.rmtree(model_download_folder)
-        else:
+    if os.path.exists(yaml_file) and not overwrite:
+        return convert_model_to_yaml_string(yaml_file)
+
+    # single flight: the processes asking for the same model version wait for the first one
+    install_lock = FileLock(lock_file(models_directory, model_id, "install"))
+    if not install_lock.acquire(cancel=cancel):
+        raise _download.DownloadCancelled()
+    try:
+        staging = _download.staging_folder(model_download_folder)
+        if _download.is_partial(model_download_folder):
+            # interrupted download of an older version of the plugin, made in place
+            if os.path.exists(staging):
+                shutil.rmtree(model_download_folder)
+            else:
+                os.rename(model_download_folder, staging)
+        elif os.path.exists(model_download_folder) and not overwrite:
+            # installed by another process while waiting for the lock
             return convert_model_to_yaml_string(yaml_file)
 
-    os.makedirs(model_download_folder)
-    resource_description = str(model_id)
-    bioimageio.core.export_resource_package(
-        resource_description, output_path=destination_file
-    )
-    with zipfile.ZipFile(destination_file, "r") as zip_ref:
-        zip_ref.extractall(model_download_folder)
-    os.remove(destination_file)
+        _download.fetch_package(
+            str(model_id),
+            staging,
+            weight_formats=weight_formats,
+            progress=progress,
+            cancel=cancel,
+            blobs=get_blob_store(),
+        )
+        # the new files are already on disk, in the staging directory
+        evict_models(keep=[str(model_id)])
+        overwritten = os.path.exists(model_download_folder)
+        _download.swap_in(staging, model_download_folder)
+        get_model_registry().add(model_download_folder)
+        if overwritten:
+            # only now, so that the files the new install shares with the old one were reused
+            get_blob_store().collect_garbage()
+    finally:
+        install_lock.release()
 
     return convert_model_to_yaml_string(yaml_file)
 
 
+def cleanup_models_directory() -> None:
+    """Removes the leftovers of crashed installs from the models directory, once per process.
+
+    Only the directories holding the versions of a model are listed: the ones of the installed
+    models, from the registry, and the ones of every install started, from their install locks.
+    """
+    models_directory = get_models_path()
+    with _registries_lock:
+        if models_directory in _swept_directories:
+            return
+        _swept_directories.add(models_directory)
+    if not os.path.isdir(models_directory):
+        return
+    parents = {os.path.dirname(os.path.dirname(rdf_file)) for rdf_file in get_model_registry().entries()}
+    for model_id in locked_model_ids(models_directory, "install"):
+        parents.add(os.path.dirname(os.path.join(models_directory, model_id)))
+    if _download.sweep_staging(sorted(parents)):
+        get_blob_store().collect_garbage()
+
+
+def set_download_workers(workers: int) -> None:
+    """Sets the number of models downloaded in parallel.
+
+    Args:
+        workers: int, number of parallel downloads, used by download managers created afterwards
+    """
+    os.environ["BIOIMAGEIO_NAPARI_DOWNLOAD_WORKERS"] = str(workers)
+
+
+def get_download_workers() -> int:
+    """Gets the number of models downloaded in parallel."""
+    try:
+        return max(1, int(os.environ.get("BIOIMAGEIO_NAPARI_DOWNLOAD_WORKERS", DOWNLOAD_WORKERS_DEFAULT)))
+    except ValueError:
+        return DOWNLOAD_WORKERS_DEFAULT
+
+
+def get_download_manager() -> DownloadManager:
+    """Gets the download queue shared by the model manager and download_models."""
+    global _download_manager
+    with _registries_lock:
+        if _download_manager is None:
+            _download_manager = DownloadManager(download_model, max_workers=get_download_workers())
+        return _download_manager
+
+
+def download_models(
+    model_ids: typing.Iterable[str],
+    overwrite: bool = False,
+    wait: bool = True,
+    weight_formats: typing.Optional[typing.Sequence[str]] = None,
+) -> typing.List[DownloadJob]:
+    """Downloads several BioimageIO models in parallel in the local model folder.
+
+    Args:
+        model_ids: iterable of strings, ids of the models (including the version)
+        overwrite: bool, true to force re-install
+        wait: bool, true to return once all the downloads finished
+        weight_formats: list of weight formats by order of preference, only the first one available
+            is downloaded; defaults to get_weight_formats()
+    Returns:
+        List of the download jobs, giving the state, progress and throughput of each download
+    """
+    manager = get_download_manager()
+    jobs = [manager.submit(str(model_id), overwrite, weight_formats) for model_id in model_ids]
+    if wait:
+        for job in jobs:
+            job.wait()
+
+    return jobs
+
+
 def remove_model(model_id: str) -> None:
     """Removes an existing locally downloaded model from the local model folder.
 
     The model directory
-        and all its contents will be removed
+        and all its contents will be removed, along with the stored files no other model links to
     Args:
         model_id: string, id of the model
+    Raises:
+        ModelLockedError: if the model is being installed or used by another thread or process
     """
     models_directory = get_models_path()
     model_remove_folder = os.path.join(
         models_directory,
         str(model_id),
     )
-    if os.path.exists(model_remove_folder):
-        shutil.rmtree(model_remove_folder)
+    with locked(lock_file(models_directory, model_id, "install"), blocking=False), locked(
+        lock_file(models_directory, model_id, "use"), blocking=False
+    ):
+        if os.path.exists(model_remove_folder):
+            shutil.rmtree(model_remove_folder)
+            get_model_registry().remove(model_remove_folder)
+            get_blob_store().collect_garbage()
+        get_usage_log().forget(str(model_id).strip("/"))
 
 
 def inspect_model(model_id: str) -> typing.Any:
@@ -163,9 +590,17 @@ def inspect_model(model_id: str) -> typing.Any:
         raise FileNotFoundError
 
 
+def _model_folder_id(model_id: str) -> str:
+    # load_model_by_id receives the model id followed by the version, the version is already part of the id
+    return str(model_id[:model_id.rfind("/")])
+
+
 def load_model(model_id: str) -> ResourceDescription:
     """Load an existing BioimageIO model in the local model folder as a BioimageIO resource.
 
+    The model cannot be removed while it is loading; use use_model() to keep it from being
+    removed for longer. The time of the load is recorded, the least recently loaded models being
+    the first evicted when the models directory exceeds its quota.
     Args:
         model_id: string, id of the model
     Returns:
@@ -174,14 +609,37 @@ def load_model(model_id: str) -> ResourceDescription:
     models_directory = get_models_path()
     model_download_folder = os.path.join(
         models_directory,
-        str(model_id[:model_id.rfind("/")]),
+        _model_folder_id(model_id),
     )
     destination_file = os.path.join(model_download_folder, "rdf.yaml")
-    if os.path.exists(model_download_folder):
-        return bioimageio.core.load_resource_description(destination_file)
+    with locked(lock_file(models_directory, _model_folder_id(model_id), "use"), shared=True):
+        if not os.path.exists(model_download_folder) and _download.swap_in_progress(model_download_folder):
+            # an overwrite is renaming the new install into place, under the install lock
+            with locked(lock_file(models_directory, _model_folder_id(model_id), "install")):
+                pass
+        if os.path.exists(model_download_folder):
+            get_usage_log().touch(_model_folder_id(model_id).strip("/"))
+            return bioimageio.core.load_resource_description(destination_file)
 
     return None
 
+
+@contextlib.contextmanager
+def use_model(model_id: str) -> typing.Iterator[ResourceDescription]:
+    """Context manager loading a model and keeping it from being removed until the block exits.
+
+    The lock is shared with the other threads and processes using the same models directory, so a
+    remove_model() call meanwhile fails with ModelLockedError.
+    Args:
+        model_id: string, id of the model, as given to load_model()
+    Returns:
+        BioImage.IO resource
+    """
+    models_directory = get_models_path()
+    with locked(lock_file(models_directory, _model_folder_id(model_id), "use"), shared=True):
+        yield load_model(model_id)
+
+
 def validate_model(destination_file: str) -> typing.Any:
     """Validates an existing BioimageIO model located in the specified destionation_file path.
 
@@ -191,23 +649,28 @@ def validate_model(destination_file: str) -> typing.Any:
         String in YAML format with the full validation information
     """
     if os.path.exists(destination_file):
-        return yaml.dump(bioimageio.spec.validate(destination_file))
+        return yaml.dump(bioimageio.spec.validate(destination_file), Dumper=YamlDumper)
 
     return None
 
 def convert_model_to_yaml_string(source_file: str) -> typing.Any:
     """Convenient alternative to get the info an existing model in the local model folder from a rdf.yaml file.
 
+    Files inside the models directory are read through the models registry, so they are only parsed
+    again if they changed since they were last listed.
     Args:
         source_file: path to the source file (normally "rdf.yaml")
     Returns:
         String in YAML format with the full model information
     """
     if os.path.exists(source_file):
-        return yaml.dump(
-            bioimageio.spec.serialize_raw_resource_description_to_dict(
+        models_directory = os.path.abspath(get_models_path())
+        if os.path.abspath(source_file).startswith(models_directory + os.sep):
+            summary = get_model_registry().summary(os.path.abspath(source_file))
+        else:
+            summary = bioimageio.spec.serialize_raw_resource_description_to_dict(
                 bioimageio.core.load_raw_resource_description(source_file)
             )
-        )
+        return yaml.dump(summary, Dumper=YamlDumper)
 
     return None
@@ -0,0 +1,136 @@
+"""Watcher reporting model versions added, removed or modified in a models directory."""
+
+import os
+import threading
+import typing
+
+from ._registry import ModelRegistry
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # watchdog is optional, the watcher then polls the registry
+    FileSystemEventHandler = object
+    Observer = None
+
+POLL_INTERVAL_DEFAULT = 2.0
+# with native notifications the registry is still revalidated from time to time, in case an event was missed
+NOTIFY_INTERVAL_DEFAULT = 60.0
+NOTIFY_DEBOUNCE = 0.5
+
+
+class ModelStoreEvent(typing.NamedTuple):
+    """Change of one model version directory."""
+
+    kind: str  # "added", "removed" or "modified"
+    model_folder: str
+    summary: typing.Dict[str, typing.Any]
+
+
+class _ChangeHandler(FileSystemEventHandler):
+    def __init__(self, models_directory: str, trigger: threading.Event):
+        super().__init__()
+        self.models_directory = models_directory
+        self.trigger = trigger
+
+    def on_any_event(self, event):
+        rel_path = os.path.relpath(event.src_path, self.models_directory)
+        # the registry and the staging areas live in hidden directories
+        if not any(part.startswith(".") for part in rel_path.split(os.sep) if part not in (".", "..")):
+            self.trigger.set()
+
+
+class ModelStoreWatcher:
+    """Reports changes of the installed models to a callback, from a background thread.
+
+    Changes are detected by revalidating the models registry, which only costs stat calls.
+    The revalidation is triggered by native file system notifications (inotify on Linux) when
+    the optional watchdog package is installed, and by polling every interval seconds otherwise.
+    The callback receives the list of ModelStoreEvent found by each revalidation.
+    """
+
+    def __init__(
+        self,
+        registry: ModelRegistry,
+        callback: typing.Callable[[typing.List[ModelStoreEvent]], None],
+        interval: typing.Optional[float] = None,
+    ):
+        self.registry = registry
+        self.callback = callback
+        self.interval = interval
+        self.native = False
+        self._trigger = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: typing.Optional[threading.Thread] = None
+        self._observer = None
+        self._snapshot: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+
+    def start(self) -> "ModelStoreWatcher":
+        """Takes the initial snapshot of the models and starts watching."""
+        self._snapshot = self.registry.entries()
+        if Observer is not None and os.path.isdir(self.registry.models_directory):
+            try:
+                self._observer = Observer()
+                self._observer.schedule(
+                    _ChangeHandler(self.registry.models_directory, self._trigger),
+                    self.registry.models_directory,
+                    recursive=True,
+                )
+                self._observer.start()
+                self.native = True
+            except OSError as excep:
+                print("Could not watch the models directory, falling back to polling:", str(excep))
+                self._observer = None
+        if self.interval is None:
+            self.interval = NOTIFY_INTERVAL_DEFAULT if self.native else POLL_INTERVAL_DEFAULT
+        self._thread = threading.Thread(target=self._run, name="ModelStoreWatcher", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stops watching, the callback is not called anymore once this returns."""
+        self._stopped.set()
+        self._trigger.set()
+        self.native = False
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def check(self) -> typing.List[ModelStoreEvent]:
+        """Revalidates the registry and computes the changes since the previous check."""
+        entries = self.registry.entries()
+        events = []
+        for rdf_file, entry in entries.items():
+            previous = self._snapshot.get(rdf_file)
+            if entry["summary"] is None:
+                if previous is not None and previous["summary"] is not None:
+                    events.append(ModelStoreEvent("removed", os.path.dirname(rdf_file), previous["summary"]))
+            elif previous is None or previous["summary"] is None:
+                events.append(ModelStoreEvent("added", os.path.dirname(rdf_file), entry["summary"]))
+            elif (previous["mtime_ns"], previous["size"]) != (entry["mtime_ns"], entry["size"]):
+                events.append(ModelStoreEvent("modified", os.path.dirname(rdf_file), entry["summary"]))
+        for rdf_file, previous in self._snapshot.items():
+            if rdf_file not in entries and previous["summary"] is not None:
+                events.append(ModelStoreEvent("removed", os.path.dirname(rdf_file), previous["summary"]))
+        self._snapshot = entries
+        return events
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            if self._trigger.wait(self.interval):
+                # let a burst of file system events (e.g. an install) settle
+                self._stopped.wait(NOTIFY_DEBOUNCE)
+            self._trigger.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                events = self.check()
+            except Exception as excep:
+                print("Could not check the models directory:", str(excep))
+                continue
+            if events and not self._stopped.is_set():
+                self.callback(events)
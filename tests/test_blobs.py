@@ -0,0 +1,89 @@
+"""Test the content-addressed store sharing the model files between versions."""
+
+import hashlib
+import os
+import threading
+import time
+
+from napari_bioimageio._blobs import BlobStore, hash_file, hash_files
+from napari_bioimageio._locks import FileLock
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+    return path
+
+
+def _store(tmp_path):
+    return BlobStore(str(tmp_path / "models" / ".blobs"))
+
+
+def test_hash_files(tmp_path):
+    contents = [b"", b"weights", os.urandom(3 << 20)]
+    paths = [_write(str(tmp_path / f"file{index}"), content) for index, content in enumerate(contents)]
+    expected = [hashlib.sha256(content).hexdigest() for content in contents]
+    assert hash_files(paths) == expected
+    assert hash_files(paths, max_workers=1) == expected
+    assert hash_file(paths[1]) == expected[1]
+
+
+def test_identical_files_are_stored_once(tmp_path):
+    store = _store(tmp_path)
+    first = _write(str(tmp_path / "models" / "model" / "1" / "weights.pt"), b"weights")
+    second = _write(str(tmp_path / "models" / "model" / "2" / "weights.pt"), b"weights")
+    digest = store.add(first)
+    assert store.add(second) == digest == hashlib.sha256(b"weights").hexdigest()
+    assert store.has(digest)
+    assert os.path.samefile(first, store.path(digest))
+    assert os.path.samefile(second, store.path(digest))
+    # adding a linked file again changes nothing
+    assert store.add(first, digest) == digest
+    assert os.stat(store.path(digest)).st_nlink == 3
+
+
+def test_materialize(tmp_path):
+    store = _store(tmp_path)
+    digest = store.add(_write(str(tmp_path / "models" / "model" / "1" / "weights.pt"), b"weights"))
+    destination = str(tmp_path / "models" / "model" / "2" / "sub" / "weights.pt")
+    assert store.materialize(digest, destination)
+    assert os.path.samefile(destination, store.path(digest))
+    assert not store.materialize(hashlib.sha256(b"missing").hexdigest(), str(tmp_path / "missing"))
+    assert not os.path.exists(tmp_path / "missing")
+
+
+def test_garbage_collection(tmp_path):
+    store = _store(tmp_path)
+    kept = _write(str(tmp_path / "models" / "model" / "1" / "kept.pt"), b"kept")
+    removed = _write(str(tmp_path / "models" / "model" / "1" / "removed.pt"), b"removed!")
+    kept_digest, removed_digest = store.add(kept), store.add(removed)
+
+    assert store.collect_garbage() == 0
+    os.remove(removed)
+    assert store.collect_garbage() == len(b"removed!")
+    assert store.has(kept_digest)
+    assert not store.has(removed_digest)
+
+
+def test_garbage_collection_waits_for_links(tmp_path):
+    store = _store(tmp_path)
+    digest = store.add(_write(str(tmp_path / "models" / "model" / "1" / "weights.pt"), b"weights"))
+    os.remove(str(tmp_path / "models" / "model" / "1" / "weights.pt"))
+
+    # an install checked the blob exists and is about to link it
+    link = FileLock(store.lock_file)
+    assert link.acquire(shared=True)
+    freed = []
+    collector = threading.Thread(target=lambda: freed.append(store.collect_garbage()))
+    collector.start()
+    time.sleep(0.3)
+    assert collector.is_alive()
+    destination = str(tmp_path / "models" / "model" / "2" / "weights.pt")
+    os.makedirs(os.path.dirname(destination))
+    os.link(store.path(digest), destination)
+    link.release()
+
+    collector.join(5)
+    assert freed == [0]
+    assert store.has(digest)
@@ -0,0 +1,116 @@
+"""Test the on-disk cache of the collection JSON and its conditional revalidation."""
+
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+from napari_bioimageio import _utils
+
+
+def _collection(*names):
+    return json.dumps(
+        {"collection": [{"type": "model", "id": f"model-{name}", "name": name} for name in names]}
+    ).encode()
+
+
+class CollectionServer(http.server.HTTPServer):
+    """Serves one collection JSON with an ETag, answering 304 to a matching If-None-Match."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), CollectionHandler)
+        self.body = _collection("A", "B")
+        self.etag = '"1"'
+        self.requests = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/collection.json"
+
+
+class CollectionHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):  # noqa: N802
+        self.server.requests.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == self.server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", self.server.etag)
+        self.send_header("Content-Length", str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    server = CollectionServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_MODELS_PATH", str(tmp_path / "models"))
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_RDF_URL", server.url)
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_CATALOG_TTL", "3600")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _names():
+    return [model["name"] for model in _utils.get_model_list()]
+
+
+def test_cached_collection_is_served_within_ttl(server):
+    assert _names() == ["A", "B"]
+    assert _names() == ["A", "B"]
+    assert server.requests == [None]
+    assert os.path.isfile(os.path.join(_utils.get_cache_path(), "collection.json"))
+
+
+def test_expired_collection_is_revalidated(server, monkeypatch):
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_CATALOG_TTL", "0")
+    assert _names() == ["A", "B"]
+    # unchanged: the server answers 304 and the cached body is used
+    assert _names() == ["A", "B"]
+    assert server.requests == [None, '"1"']
+
+    # changed on the server: the new body replaces the cached one
+    server.body, server.etag = _collection("C"), '"2"'
+    assert _names() == ["C"]
+    assert server.requests == [None, '"1"', '"1"']
+
+
+def test_unreachable_server_falls_back_to_the_cache(server, monkeypatch):
+    assert _names() == ["A", "B"]
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_CATALOG_TTL", "0")
+    server.shutdown()
+    server.server_close()
+    assert _names() == ["A", "B"]
+
+
+def test_unreachable_server_without_cache(server, monkeypatch):
+    server.shutdown()
+    server.server_close()
+    assert _utils.get_model_list() == []
+
+
+def test_corrupt_cache_is_fetched_again(server):
+    assert _names() == ["A", "B"]
+    with open(os.path.join(_utils.get_cache_path(), "collection.json"), "wb") as f:
+        f.write(b'{"collection": [')
+
+    # the truncated copy is dropped and downloaded without the conditional headers
+    assert _names() == ["A", "B"]
+    assert server.requests == [None, None]
+    assert _names() == ["A", "B"]
+    assert len(server.requests) == 2
+
+
+def test_corrupt_collection_on_the_server(server):
+    server.body = b"<html>not json</html>"
+    assert _utils.get_model_list() == []
+    assert not os.path.exists(os.path.join(_utils.get_cache_path(), "collection.json"))
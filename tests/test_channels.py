@@ -0,0 +1,68 @@
+"""Test the assembly of model input tensors from the channels of napari layers."""
+
+import numpy as np
+import pytest
+
+from napari_bioimageio import assemble_channels
+
+
+@pytest.fixture
+def channels():
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 256, (6, 8), dtype=np.uint8) for _ in range(3)]
+
+
+def _channels_first(tensor, axes):
+    # the tensor as cyx, for comparison with the stacked channels
+    if "b" in axes:
+        tensor = tensor.squeeze(axes.index("b"))
+        axes = axes.replace("b", "")
+    return np.transpose(tensor, [axes.index(axis) for axis in "cyx"])
+
+
+@pytest.mark.parametrize("axes", ["bcyx", "byxc", "cyx", "yxc"])
+def test_axes_and_dtype(channels, axes):
+    tensor = assemble_channels(channels, axes=axes)
+    assert tensor.dtype == np.float32 and tensor.flags.c_contiguous
+    assert tensor.shape[axes.index("c")] == 3 and ("b" not in axes or tensor.shape[axes.index("b")] == 1)
+    np.testing.assert_array_equal(_channels_first(tensor, axes), np.stack(channels).astype(np.float32))
+
+    tensor = assemble_channels(channels, axes=axes, dtype=None)
+    assert tensor.dtype == np.uint8
+    np.testing.assert_array_equal(_channels_first(tensor, axes), np.stack(channels))
+
+
+@pytest.mark.parametrize("axes", ["bcyx", "byxc"])
+def test_repeated_channel_is_a_writable_copy(channels, axes):
+    tensor = assemble_channels([channels[0]] * 3, axes=axes)
+    assert tensor.flags.writeable and tensor.flags.c_contiguous
+    np.testing.assert_array_equal(_channels_first(tensor, axes), np.stack([channels[0]] * 3).astype(np.float32))
+    # the channels are independent, e.g. for a model normalizing its input in place
+    tensor[(0, 0) if axes == "bcyx" else (0, slice(None), slice(None), 0)] = -1
+    assert (_channels_first(tensor, axes)[1:] == np.stack([channels[0]] * 2)).all()
+
+
+def test_value_range_and_scale(channels):
+    tensor = assemble_channels(channels, preserve_range=False)
+    np.testing.assert_allclose(tensor[0], np.stack(channels) / 255, rtol=1e-6)
+    with pytest.raises(ValueError):
+        assemble_channels(channels, dtype="uint8", preserve_range=False)
+
+    pytest.importorskip("skimage")
+    from skimage.transform import rescale
+
+    tensor = assemble_channels(channels, scale_factor=0.5, preserve_range=False)
+    assert tensor.shape == (1, 3, 3, 4)
+    expected = np.stack([rescale(channel, 0.5) for channel in channels])
+    np.testing.assert_allclose(tensor[0], expected, rtol=1e-5, atol=1e-6)
+
+
+def test_invalid_channels(channels):
+    with pytest.raises(ValueError):
+        assemble_channels([])
+    with pytest.raises(ValueError):
+        assemble_channels(channels, axes="byx")
+    with pytest.raises(ValueError):
+        assemble_channels(channels, axes="bczyx")
+    with pytest.raises(ValueError):
+        assemble_channels([channels[0], channels[1][:4]])
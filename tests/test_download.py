@@ -0,0 +1,237 @@
+"""Test the resumable download of model packages and the download queue against a local server."""
+
+import hashlib
+import http.client
+import http.server
+import os
+import socket
+import threading
+
+import pytest
+import yaml
+
+from napari_bioimageio import _download
+from napari_bioimageio._download import ChecksumError, DownloadCancelled, DownloadManager, fetch_file, fetch_package
+
+
+class FileServer(http.server.ThreadingHTTPServer):
+    """Serves in-memory files, honouring Range requests.
+
+    A file listed in stall is sent only up to that many bytes, then the connection hangs until
+    the test ends or the file is removed from stall.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FileHandler)
+        self.files = {}
+        self.stall = {}
+        self.requests = []
+        self.released = threading.Event()
+
+    def url(self, name):
+        return f"http://127.0.0.1:{self.server_address[1]}/{name}"
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):  # noqa: N802
+        name = self.path.lstrip("/")
+        self.server.requests.append((name, self.headers.get("Range")))
+        if name not in self.server.files:
+            self.send_error(404)
+            return
+        body = self.server.files[name]
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"][len("bytes=") : -1])
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        stall = self.server.stall.get(name)
+        if stall is None:
+            self.wfile.write(body[start:])
+            return
+        self.wfile.write(body[start:stall])
+        self.wfile.flush()
+        self.server.released.wait(10)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(_download, "DOWNLOAD_TIMEOUT", 0.5)
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.released.set()
+    server.shutdown()
+    server.server_close()
+
+
+def _content(size, seed=0):
+    return bytes((seed + index * 7) % 251 for index in range(size))
+
+
+def test_fetch_file_resumes_the_partial_file(server, tmp_path):
+    server.files["weights.pt"] = _content(10000)
+    destination = str(tmp_path / "weights.pt")
+    with open(destination + _download.PARTIAL_SUFFIX, "wb") as f:
+        f.write(server.files["weights.pt"][:4000])
+
+    received = []
+    fetch_file(server.url("weights.pt"), destination, progress=lambda done, size: received.append((done, size)))
+    with open(destination, "rb") as f:
+        assert f.read() == server.files["weights.pt"]
+    assert server.requests == [("weights.pt", "bytes=4000-")]
+    assert sum(done for done, _ in received) == 10000
+    assert received[-1][1] == 10000
+    assert not os.path.exists(destination + _download.PARTIAL_SUFFIX)
+
+
+def test_stalled_server_times_out_and_is_resumed(server, tmp_path):
+    server.files["weights.pt"] = _content(10000)
+    server.stall["weights.pt"] = 3000
+    destination = str(tmp_path / "weights.pt")
+    with pytest.raises(OSError) as excep:
+        fetch_file(server.url("weights.pt"), destination)
+    assert _download.is_transient(excep.value)
+
+    del server.stall["weights.pt"]
+    fetch_file(server.url("weights.pt"), destination)
+    with open(destination, "rb") as f:
+        assert f.read() == server.files["weights.pt"]
+
+
+def test_closed_connection_keeps_the_partial_file(server, tmp_path):
+    server.files["weights.pt"] = _content(10000)
+    server.stall["weights.pt"] = 6000
+    server.released.set()
+    destination = str(tmp_path / "weights.pt")
+    with pytest.raises(http.client.IncompleteRead) as excep:
+        fetch_file(server.url("weights.pt"), destination)
+    assert _download.is_transient(excep.value)
+    assert os.path.getsize(destination + _download.PARTIAL_SUFFIX) == 6000
+    assert not os.path.exists(destination)
+
+
+@pytest.fixture
+def package(server, monkeypatch):
+    # a package of two files, the rdf.yaml declaring the sha256 of the weights
+    server.files["weights.pt"] = _content(5000, seed=1)
+    server.files["config.json"] = b"{}"
+    digest = hashlib.sha256(server.files["weights.pt"]).hexdigest()
+    rdf = yaml.safe_dump({"name": "model", "weights": {"torchscript": {"source": "weights.pt", "sha256": digest}}})
+    content = {"rdf": rdf, "config.json": server.url("config.json"), "weights.pt": server.url("weights.pt")}
+    monkeypatch.setattr(_download, "get_package_content", lambda model_id, weight_formats=None: dict(content))
+    return content
+
+
+def test_interrupted_package_is_resumed_from_the_journal(server, package, tmp_path):
+    model_folder = str(tmp_path / "model" / "1")
+    cancel = threading.Event()
+
+    def progress(file_name, received, size):
+        if file_name == "weights.pt":
+            cancel.set()
+
+    server.stall["weights.pt"] = 2000
+    server.released.set()
+    with pytest.raises((DownloadCancelled, OSError)):
+        fetch_package("model/1", model_folder, progress=progress, cancel=cancel)
+    assert _download.is_partial(model_folder)
+    assert not os.path.exists(os.path.join(model_folder, "rdf.yaml"))
+
+    server.requests.clear()
+    del server.stall["weights.pt"]
+    fetch_package("model/1", model_folder)
+    # the finished file is not downloaded again, the partial one is resumed
+    assert [name for name, _ in server.requests] == ["weights.pt"]
+    assert server.requests[0][1] is not None
+    assert sorted(os.listdir(model_folder)) == ["config.json", "rdf.yaml", "weights.pt"]
+    with open(os.path.join(model_folder, "weights.pt"), "rb") as f:
+        assert f.read() == server.files["weights.pt"]
+
+
+def test_checksum_mismatch_is_downloaded_again(server, package, tmp_path):
+    model_folder = str(tmp_path / "model" / "1")
+    expected = server.files["weights.pt"]
+    server.files["weights.pt"] = b"corrupted"
+    with pytest.raises(ChecksumError):
+        fetch_package("model/1", model_folder)
+    assert not os.path.exists(os.path.join(model_folder, "weights.pt"))
+    assert not os.path.exists(os.path.join(model_folder, "rdf.yaml"))
+
+    server.files["weights.pt"] = expected
+    server.requests.clear()
+    fetch_package("model/1", model_folder)
+    assert [name for name, _ in server.requests] == ["weights.pt"]
+    assert not _download.is_partial(model_folder)
+
+
+def _install_from(server, tmp_path):
+    def install(model_id, overwrite, weight_formats=None, progress=None, cancel=None):
+        file_progress = None
+        if progress is not None:
+            file_progress = lambda received, size: progress(model_id, received, size)
+        fetch_file(server.url(model_id), str(tmp_path / model_id), progress=file_progress, cancel=cancel)
+
+    return install
+
+
+def test_stalled_download_is_retried(server, tmp_path):
+    server.files["a"] = _content(8000)
+    server.stall["a"] = 1000
+    manager = DownloadManager(_install_from(server, tmp_path), max_workers=1, retries=3, backoff=0.1)
+
+    job = manager.submit("a")
+    # the first attempt times out, the server recovers for the retry
+    threading.Timer(0.2, server.stall.pop, args=("a",)).start()
+    assert job.wait(10)
+    assert job.state == "done"
+    assert job.attempts == 2
+    assert server.requests == [("a", None), ("a", "bytes=1000-")]
+    assert (tmp_path / "a").read_bytes() == server.files["a"]
+
+
+def test_cancel_stalled_download(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(_download, "DOWNLOAD_TIMEOUT", 1)
+    server.files["a"] = _content(8000)
+    server.files["b"] = _content(100)
+    server.stall["a"] = 1000
+    manager = DownloadManager(_install_from(server, tmp_path), max_workers=1, retries=100, backoff=0.1)
+    stalled = manager.submit("a")
+    queued = manager.submit("b")
+    while stalled.bytes_done == 0:
+        assert not stalled.wait(0.05)
+
+    stalled.cancel()
+    assert stalled.wait(5)
+    assert stalled.state == "cancelled"
+    # the only worker is free again for the queued job
+    assert queued.wait(5)
+    assert queued.state == "done"
+    assert manager.jobs() == []
+
+
+def test_permanent_error_is_not_retried(server, tmp_path):
+    manager = DownloadManager(_install_from(server, tmp_path), max_workers=1, retries=3, backoff=0.1)
+    job = manager.submit("missing")
+    assert job.wait(5)
+    assert job.state == "failed"
+    assert job.attempts == 1
+
+
+def test_unreachable_server_is_transient():
+    with socket.socket() as unused:
+        unused.bind(("127.0.0.1", 0))
+        port = unused.getsockname()[1]
+    with pytest.raises(OSError) as excep:
+        fetch_file(f"http://127.0.0.1:{port}/a", "unused")
+    assert _download.is_transient(excep.value)
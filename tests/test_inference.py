@@ -0,0 +1,77 @@
+"""Test the inference jobs running in a QThread."""
+
+import gc
+import time
+
+import pytest
+
+QtCore = pytest.importorskip("qtpy.QtCore")
+
+from napari_bioimageio import _inference  # noqa: E402
+from napari_bioimageio._inference import run_inference  # noqa: E402
+from napari_bioimageio._tiling import PredictionCancelled  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+
+
+def _process_events_until(app, condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        app.processEvents(QtCore.QEventLoop.AllEvents, 50)
+
+
+def test_result_and_progress(app):
+    def function(value, progress, cancel):
+        for step in range(3):
+            progress("predicting", step + 1, 3)
+        return value * 2
+
+    calls = []
+    run_inference(
+        function,
+        21,
+        on_result=lambda result: calls.append(("result", result)),
+        on_progress=lambda stage, done, total: calls.append((stage, done, total)),
+        on_finished=lambda: calls.append("finished"),
+    )
+    _process_events_until(app, lambda: "finished" in calls)
+    assert calls == [("predicting", 1, 3), ("predicting", 2, 3), ("predicting", 3, 3), ("result", 42), "finished"]
+
+
+def test_error_and_cancel(app):
+    def failing(progress, cancel):
+        raise ValueError("broken model")
+
+    def cancellable(progress, cancel):
+        while not cancel.wait(0.01):
+            pass
+        raise PredictionCancelled()
+
+    calls = []
+    run_inference(failing, on_error=lambda excep: calls.append(str(excep)), on_finished=lambda: calls.append("done"))
+    job = run_inference(cancellable, on_cancelled=lambda: calls.append("cancelled"))
+    job.cancel()
+    _process_events_until(app, lambda: "cancelled" in calls and "done" in calls)
+    assert sorted(calls) == ["broken model", "cancelled", "done"]
+
+
+def test_finished_job_can_be_dropped(app):
+    # the caller drops the job as soon as it finished, as the example widgets do
+    holder = {}
+    finished = []
+
+    def on_finished():
+        finished.append(True)
+        holder.pop("job")
+        gc.collect()
+
+    holder["job"] = run_inference(lambda progress, cancel: time.sleep(0.05), on_finished=on_finished)
+    _process_events_until(app, lambda: finished and not _inference._running_jobs)
+    gc.collect()
+    for _ in range(5):
+        app.processEvents()
+    assert finished == [True]
@@ -0,0 +1,71 @@
+"""Test the label measurements against skimage's regionprops."""
+
+import numpy as np
+import pytest
+
+from napari_bioimageio import _labels
+from napari_bioimageio._labels import measure_labels, remove_labels
+
+measure = pytest.importorskip("skimage.measure")
+
+
+def _random_labels(shape, count, first=1, seed=0):
+    # blobs of random sizes, with labels first, first + 2, ... so some labels are missing
+    rng = np.random.default_rng(seed)
+    labels = np.zeros(shape, dtype=np.int32)
+    for index in range(count):
+        center = [rng.integers(0, size) for size in shape]
+        radius = [rng.integers(1, max(2, size // 6)) for size in shape]
+        box = tuple(slice(max(0, c - r), c + r) for c, r in zip(center, radius))
+        labels[box] = first + 2 * index
+    return labels
+
+
+def _check(labels):
+    table = measure_labels(labels)
+    regions = measure.regionprops(labels)
+    np.testing.assert_array_equal(table.labels, [region.label for region in regions])
+    np.testing.assert_array_equal(table.sizes, [region.area for region in regions])
+    np.testing.assert_array_equal(table.bboxes.reshape(len(regions), -1), [region.bbox for region in regions])
+    np.testing.assert_allclose(table.centroids.reshape(len(regions), -1), [region.centroid for region in regions])
+    border = [
+        any(low == 0 for low in region.bbox[: labels.ndim])
+        or any(high == size for high, size in zip(region.bbox[labels.ndim :], labels.shape))
+        for region in regions
+    ]
+    np.testing.assert_array_equal(table.border, border)
+    return table
+
+
+@pytest.mark.parametrize("shape", [(64, 80), (200, 150), (16, 20, 24)])
+@pytest.mark.parametrize("first", [1, 7])
+def test_measure_labels_matches_regionprops(shape, first):
+    table = _check(_random_labels(shape, 30, first=first))
+    assert table.labels[0] >= first
+    np.testing.assert_array_equal(table.index(table.labels), np.arange(len(table.labels)))
+
+
+def test_measure_labels_in_chunks(monkeypatch):
+    # the rows are summed a few at a time on large images
+    monkeypatch.setattr(_labels, "MEASURE_CHUNK_PIXELS", 100)
+    _check(_random_labels((120, 90), 25, first=3))
+
+
+@pytest.mark.parametrize("labels", [np.zeros((32, 32), dtype=np.int32), np.zeros((0, 5), dtype=np.int32)])
+def test_measure_empty_labels(labels):
+    table = measure_labels(labels)
+    assert len(table.labels) == len(table.sizes) == len(table.border) == 0
+    assert table.bboxes.shape == (0, 4)
+    assert table.centroids.shape == (0, 2)
+
+
+def test_remove_labels():
+    labels = _random_labels((100, 100), 20, first=5)
+    expected = labels.copy()
+    removed = [5, 9, 1000]
+    expected[np.isin(expected, removed)] = 0
+    assert remove_labels(labels, removed) is labels
+    np.testing.assert_array_equal(labels, expected)
+    # nothing to remove
+    np.testing.assert_array_equal(remove_labels(labels, []), expected)
+    np.testing.assert_array_equal(remove_labels(np.zeros((4, 4), dtype=np.int32), [1]), 0)
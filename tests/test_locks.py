@@ -0,0 +1,91 @@
+"""Test the shared/exclusive locks between threads and processes."""
+
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from napari_bioimageio import _locks
+from napari_bioimageio._locks import FileLock, ModelLockedError, lock_file, locked, locked_model_ids
+
+
+def test_shared_locks_exclude_an_exclusive_one(tmp_path):
+    path = str(tmp_path / "model.lock")
+    readers = [FileLock(path), FileLock(path)]
+    assert all(reader.acquire(shared=True) for reader in readers)
+    writer = FileLock(path)
+    assert not writer.acquire(blocking=False)
+    readers[0].release()
+    assert not writer.acquire(blocking=False)
+    readers[1].release()
+    assert writer.acquire(blocking=False)
+    assert not FileLock(path).acquire(shared=True, blocking=False)
+    writer.release()
+
+
+def test_blocking_acquisition_waits_for_the_release(tmp_path):
+    path = str(tmp_path / "model.lock")
+    holder = FileLock(path)
+    holder.acquire()
+    acquired = []
+
+    def wait():
+        lock = FileLock(path)
+        acquired.append(lock.acquire())
+        lock.release()
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    time.sleep(3 * _locks.LOCK_POLL_INTERVAL)
+    assert acquired == []
+    holder.release()
+    waiter.join(5)
+    assert acquired == [True]
+
+
+def test_cancelled_acquisition(tmp_path):
+    path = str(tmp_path / "model.lock")
+    with locked(path):
+        cancel = threading.Event()
+        threading.Timer(0.2, cancel.set).start()
+        start = time.monotonic()
+        assert not FileLock(path).acquire(cancel=cancel)
+        assert time.monotonic() - start < 5
+        with pytest.raises(ModelLockedError):
+            with locked(path, shared=True, cancel=cancel):
+                pass
+    # nothing was left held by the failed attempts
+    with locked(path, blocking=False):
+        pass
+
+
+@pytest.mark.skipif(_locks.fcntl is None, reason="the locks only coordinate threads without flock")
+def test_lock_held_by_another_process(tmp_path):
+    path = str(tmp_path / "model.lock")
+    # the child runs the module alone, without importing the package, and exits with 0 if it got the lock
+    script = (
+        "import runpy, sys; FileLock = runpy.run_path(sys.argv[1])['FileLock']; "
+        "sys.exit(0 if FileLock(sys.argv[2]).acquire(shared=sys.argv[3] == 'shared', blocking=False) else 1)"
+    )
+
+    def child(mode):
+        return subprocess.run([sys.executable, "-c", script, _locks.__file__, path, mode], timeout=60).returncode
+
+    with locked(path, shared=True):
+        assert child("shared") == 0
+        assert child("exclusive") == 1
+    with locked(path):
+        assert child("shared") == 1
+    assert child("exclusive") == 0
+
+
+def test_locked_model_ids(tmp_path):
+    models_directory = str(tmp_path)
+    assert locked_model_ids(models_directory, "install") == []
+    for model_id, kind in [("10.5281/zenodo.1/2", "install"), ("model/1", "install"), ("model/1", "use")]:
+        with locked(lock_file(models_directory, model_id, kind)):
+            pass
+    assert locked_model_ids(models_directory, "install") == ["10.5281/zenodo.1/2", "model/1"]
+    assert locked_model_ids(models_directory, "use") == ["model/1"]
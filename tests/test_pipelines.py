@@ -0,0 +1,146 @@
+"""Test the cache of loaded prediction pipelines."""
+
+import os
+import threading
+import time
+
+import pytest
+
+from napari_bioimageio import _pipelines, _utils
+from napari_bioimageio._locks import ModelLockedError
+from napari_bioimageio._pipelines import PipelineCache
+
+
+class FakePipeline:
+    def __init__(self, model):
+        self.model = model
+        self.unloaded = False
+
+    def unload(self):
+        self.unloaded = True
+
+
+@pytest.fixture
+def loads(tmp_path, monkeypatch):
+    # models loaded by the cache, each one a folder with an rdf.yaml and weights
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_MODELS_PATH", str(tmp_path / "models"))
+    loads = []
+
+    def load_model(model_id):
+        loads.append(model_id)
+        time.sleep(0.05)
+        if not os.path.exists(os.path.join(_utils.get_models_path(), _utils._model_folder_id(model_id))):
+            return None
+        return model_id
+
+    def create_prediction_pipeline(bioimageio_model, devices=None, weight_format=None):
+        if weight_format == "broken":
+            raise RuntimeError("cannot load these weights")
+        return FakePipeline(bioimageio_model)
+
+    monkeypatch.setattr(_utils, "load_model", load_model)
+    monkeypatch.setattr(_pipelines.bioimageio.core, "create_prediction_pipeline", create_prediction_pipeline)
+    for folder_id, size in [("model-a/1", 100), ("model-b/1", 200), ("model-c/1", 300)]:
+        _install(folder_id, size)
+    return loads
+
+
+def _install(folder_id, size):
+    folder = os.path.join(_utils.get_models_path(), folder_id)
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "weights.pt"), "wb") as f:
+        f.write(b"w" * size)
+    with open(os.path.join(folder, "rdf.yaml"), "w", encoding="utf-8") as f:
+        f.write(f"id: {folder_id}\n")
+
+
+def test_released_pipelines_stay_loaded(loads):
+    cache = PipelineCache(max_pipelines=2)
+    with cache.use("model-a/1/1") as first:
+        assert cache.model_id(first) == "model-a/1"
+    with cache.use("model-a/1/1") as second:
+        assert second is first
+    assert loads == ["model-a/1/1"]
+    # another weight format is another pipeline
+    with cache.use("model-a/1/1", weight_format="onnx") as onnx:
+        assert onnx is not first
+    assert [(info["id"], info["weight_format"], info["users"]) for info in cache.info()] == [
+        ("model-a/1", None, 0),
+        ("model-a/1", "onnx", 0),
+    ]
+
+
+def test_least_recently_used_pipelines_are_unloaded(loads):
+    cache = PipelineCache(max_pipelines=1)
+    a = cache.get("model-a/1/1")
+    b = cache.get("model-b/1/1")
+    # both checked out, neither may be unloaded
+    assert not a.unloaded and not b.unloaded
+    cache.release(a)
+    assert a.unloaded and not b.unloaded
+    cache.release(b)
+    assert not b.unloaded
+    assert [info["id"] for info in cache.info()] == ["model-b/1"]
+    cache.clear()
+    assert b.unloaded and cache.info() == []
+
+
+def test_memory_limit(loads):
+    cache = PipelineCache(max_pipelines=10, max_memory=450)
+    for model_id in ["model-a/1/1", "model-b/1/1", "model-c/1/1"]:
+        with cache.use(model_id):
+            pass
+    # the sizes are estimated from the files, the oldest pipelines go until the rest fits
+    assert [info["id"] for info in cache.info()] == ["model-c/1"]
+
+
+def test_concurrent_users_share_one_load(loads):
+    cache = PipelineCache()
+    pipelines = []
+
+    def run():
+        with cache.use("model-a/1/1") as pipeline:
+            pipelines.append(pipeline)
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(pipelines) == 8 and all(pipeline is pipelines[0] for pipeline in pipelines)
+    assert loads == ["model-a/1/1"]
+
+
+def test_reinstalled_model_is_loaded_again(loads):
+    cache = PipelineCache()
+    with cache.use("model-a/1/1") as first:
+        pass
+    rdf_file = os.path.join(_utils.get_models_path(), "model-a", "1", "rdf.yaml")
+    stat = os.stat(rdf_file)
+    os.utime(rdf_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    with cache.use("model-a/1/1") as second:
+        assert second is not first
+    assert first.unloaded
+    assert len(loads) == 2
+
+
+def test_load_errors_are_not_cached(loads):
+    cache = PipelineCache()
+    with pytest.raises(RuntimeError):
+        cache.get("model-a/1/1", weight_format="broken")
+    with pytest.raises(FileNotFoundError):
+        cache.get("missing/1/1")
+    assert cache.info() == []
+    # the failed loads left the model removable
+    _utils.remove_model("model-a/1")
+
+
+def test_cached_model_cannot_be_removed(loads):
+    cache = PipelineCache()
+    with cache.use("model-a/1/1"):
+        pass
+    with pytest.raises(ModelLockedError):
+        _utils.remove_model("model-a/1")
+    cache.discard("model-a/1")
+    _utils.remove_model("model-a/1")
+    assert not os.path.exists(os.path.join(_utils.get_models_path(), "model-a", "1"))
@@ -0,0 +1,62 @@
+"""Test the shared memory exchange of the inference pools with spawned worker processes."""
+
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from napari_bioimageio import _pool
+
+pytestmark = pytest.mark.skipif(_pool.shared_memory is None, reason="inference pools need Python 3.8 or later")
+
+# a pool whose workers run a pipeline doubling its input, in place of a model
+SCRIPT = textwrap.dedent(
+    """
+    import concurrent.futures
+    import multiprocessing
+    import sys
+
+    import numpy as np
+    import xarray as xr
+
+    from napari_bioimageio import _pool
+
+
+    def init_worker():
+        _pool._worker_pipeline = lambda tensor: [tensor * 2, tensor.sum("c", keepdims=True)]
+
+
+    def worker_modules():
+        return sorted(name for name in sys.modules if name.split(".")[0] in ("napari", "qtpy", "PyQt5", "PySide2"))
+
+
+    if __name__ == "__main__":
+        pool = _pool.InferencePool.__new__(_pool.InferencePool)
+        pool.workers = 2
+        pool._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=2, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker
+        )
+        with pool:
+            tensor = xr.DataArray(np.arange(2 * 3 * 4 * 5, dtype="float32").reshape(2, 3, 4, 5), dims=tuple("bcyx"))
+            for _ in range(3):
+                doubled, summed = pool(tensor)
+                np.testing.assert_array_equal(doubled.values, tensor.values * 2)
+                np.testing.assert_array_equal(summed.values, tensor.values.sum(1, keepdims=True))
+                assert doubled.dims == tensor.dims
+            assert pool._executor.submit(worker_modules).result() == []
+        print("done")
+    """
+)
+
+
+def test_pool_workers(tmp_path):
+    script = tmp_path / "run_pool.py"
+    script.write_text(SCRIPT)
+    # the resource tracker reports leaked or doubly unlinked blocks on stderr when the parent exits
+    process = subprocess.run(
+        [sys.executable, str(script)], cwd=str(tmp_path), capture_output=True, text=True, timeout=120
+    )
+    assert process.returncode == 0, process.stderr
+    assert process.stdout.strip() == "done"
+    assert "resource_tracker" not in process.stderr and "KeyError" not in process.stderr, process.stderr
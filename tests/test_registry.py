@@ -0,0 +1,126 @@
+"""Test the registry of the installed models, revalidated by stat."""
+
+import os
+
+import pytest
+import yaml
+
+from napari_bioimageio import _registry
+from napari_bioimageio._registry import ModelRegistry
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    # rdf.yaml files parsed by the registry, read as plain yaml
+    parsed = []
+
+    def parse_rdf(rdf_file):
+        parsed.append(rdf_file)
+        with open(rdf_file, "r", encoding="utf-8") as f:
+            return yaml.safe_load(f)
+
+    monkeypatch.setattr(_registry, "parse_rdf", parse_rdf)
+    return parsed
+
+
+def _install(models_directory, model_id, version, name):
+    folder = os.path.join(models_directory, model_id, version)
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "rdf.yaml"), "w", encoding="utf-8") as f:
+        yaml.safe_dump({"id": model_id, "name": name}, f)
+    return folder
+
+
+def _touch(path, offset):
+    # moves the mtime of path, as a later change on a file system with a coarse clock would
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + offset))
+
+
+def _registry_for(tmp_path):
+    models_directory = str(tmp_path / "models")
+    os.makedirs(models_directory, exist_ok=True)
+    return models_directory, ModelRegistry(models_directory, str(tmp_path / "models" / ".cache" / "registry.json"))
+
+
+def test_unchanged_models_are_not_parsed_again(tmp_path, parsed):
+    models_directory, registry = _registry_for(tmp_path)
+    _install(models_directory, "model-a", "1", "A")
+    _install(models_directory, "model-b", "2", "B")
+    assert sorted(model["name"] for model in registry.list_models()) == ["A", "B"]
+    assert len(parsed) == 2
+
+    # a new registry reads the persisted one and only stats the files
+    registry = ModelRegistry(models_directory, registry.registry_file)
+    assert sorted(model["name"] for model in registry.list_models()) == ["A", "B"]
+    assert len(parsed) == 2
+
+
+def test_modified_model_is_parsed_again(tmp_path, parsed):
+    models_directory, registry = _registry_for(tmp_path)
+    folder = _install(models_directory, "model-a", "1", "A")
+    registry.list_models()
+    _install(models_directory, "model-a", "1", "A renamed")
+    _touch(os.path.join(folder, "rdf.yaml"), 10**9)
+    assert [model["name"] for model in registry.list_models()] == ["A renamed"]
+    assert len(parsed) == 2
+
+
+def test_models_added_and_removed_outside_the_app(tmp_path, parsed):
+    models_directory, registry = _registry_for(tmp_path)
+    folder_a = _install(models_directory, "model-a", "1", "A")
+    registry.list_models()
+
+    # installed by another process: the parent directory changed
+    _install(models_directory, "model-b", "1", "B")
+    _touch(models_directory, 10**9)
+    assert sorted(model["name"] for model in registry.list_models()) == ["A", "B"]
+
+    # a new version of a known model
+    _install(models_directory, "model-a", "2", "A2")
+    _touch(os.path.dirname(folder_a), 10**9)
+    assert sorted(model["name"] for model in registry.list_models()) == ["A", "A2", "B"]
+
+    # removed by another process
+    os.remove(os.path.join(folder_a, "rdf.yaml"))
+    os.rmdir(folder_a)
+    assert sorted(model["name"] for model in registry.list_models()) == ["A2", "B"]
+    assert len(parsed) == 3
+
+
+def test_corrupt_registry_is_rebuilt(tmp_path, parsed):
+    models_directory, registry = _registry_for(tmp_path)
+    _install(models_directory, "model-a", "1", "A")
+    registry.list_models()
+    with open(registry.registry_file, "w", encoding="utf-8") as f:
+        f.write('{"format": 1, "dirs": [')
+
+    registry = ModelRegistry(models_directory, registry.registry_file)
+    assert [model["name"] for model in registry.list_models()] == ["A"]
+    assert registry.failures() == {}
+
+
+def test_corrupt_rdf_is_an_error_entry(tmp_path, parsed):
+    models_directory, registry = _registry_for(tmp_path)
+    _install(models_directory, "model-a", "1", "A")
+    broken = os.path.join(_install(models_directory, "model-b", "1", "B"), "rdf.yaml")
+    with open(broken, "w", encoding="utf-8") as f:
+        f.write("name: [unclosed\n")
+
+    assert [model["name"] for model in registry.list_models()] == ["A"]
+    failures = registry.failures()
+    assert list(failures) == [broken]
+    entry = registry.entries()[broken]
+    assert entry["summary"] is None and "error" in entry
+    with pytest.raises(ValueError):
+        registry.summary(broken)
+
+    # the broken file is not parsed again until it changes
+    count = len(parsed)
+    registry.list_models()
+    assert len(parsed) == count
+    with open(broken, "w", encoding="utf-8") as f:
+        yaml.safe_dump({"id": "model-b", "name": "B fixed"}, f)
+    _touch(broken, 10**9)
+    assert sorted(model["name"] for model in registry.list_models()) == ["A", "B fixed"]
+    assert registry.failures() == {}
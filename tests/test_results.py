@@ -0,0 +1,103 @@
+"""Test the cache of prediction results."""
+
+import os
+
+import numpy as np
+import pytest
+
+from napari_bioimageio import _results, _utils
+from napari_bioimageio._results import ResultCache, cached_prediction, hash_array
+
+
+@pytest.fixture
+def models_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_MODELS_PATH", str(tmp_path / "models"))
+    monkeypatch.setattr(_results, "_result_caches", {})
+    folder = tmp_path / "models" / "model" / "1"
+    folder.mkdir(parents=True)
+    (folder / "rdf.yaml").write_text("name: model\n")
+    return str(tmp_path / "models")
+
+
+def test_hash_array():
+    array = np.arange(24, dtype="float32").reshape(2, 3, 4)
+    assert hash_array(array) == hash_array(array.copy())
+    # views and arrays read in chunks are hashed by their values
+    assert hash_array(array[:, ::-1]) == hash_array(np.ascontiguousarray(array[:, ::-1]))
+    assert hash_array(array) != hash_array(array.astype("float64"))
+    assert hash_array(array) != hash_array(array.reshape(4, 3, 2))
+
+
+def test_results_are_cached_in_memory_and_on_disk(models_directory, tmp_path):
+    cache = ResultCache(str(tmp_path / "results"), max_size=None, max_memory=1 << 20)
+    inputs = [np.ones((4, 4), dtype="float32")]
+    key = cache.key("model/1/1", inputs, params={"threshold": 0.5})
+    assert key != cache.key("model/1/1", inputs, params={"threshold": 0.6})
+    assert key != cache.key("model/1/1", [np.zeros((4, 4), dtype="float32")], params={"threshold": 0.5})
+    assert cache.get(key) == (False, None)
+
+    value = {"labels": np.arange(16).reshape(4, 4), "scores": [0.5, 0.25], "name": "cells"}
+    assert cache.put(key, value) is value
+    # the caller's arrays stay its own
+    value["labels"][0, 0] = 100
+    found, cached = cache.get(key)
+    assert found and cached["labels"][0, 0] == 0 and cached["scores"] == [0.5, 0.25] and cached["name"] == "cells"
+    cached["labels"][0, 0] = 200
+    assert cache.get(key)[1]["labels"][0, 0] == 0
+
+    # a new cache finds the result on disk
+    cache = ResultCache(str(tmp_path / "results"), max_size=None, max_memory=1 << 20)
+    found, cached = cache.get(key)
+    assert found and cached["labels"].flags.writeable
+    np.testing.assert_array_equal(cached["labels"], np.arange(16).reshape(4, 4))
+
+
+def test_reinstalled_model_is_another_key(models_directory, tmp_path):
+    cache = ResultCache(str(tmp_path / "results"))
+    inputs = [np.ones((4, 4), dtype="float32")]
+    key = cache.key("model/1/1", inputs)
+    rdf_file = os.path.join(models_directory, "model", "1", "rdf.yaml")
+    stat = os.stat(rdf_file)
+    os.utime(rdf_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert cache.key("model/1/1", inputs) != key
+
+
+def test_least_recently_used_results_are_evicted(models_directory, tmp_path):
+    cache = ResultCache(str(tmp_path / "results"), max_size=None, max_memory=2500)
+    for index in range(3):
+        cache.put(f"key{index}", np.full(1000, index, dtype="uint8"))
+    # the oldest result left the memory, it is read from disk
+    assert list(cache._memory) == ["key1", "key2"]
+    assert cache.get("key0")[0] and list(cache._memory) == ["key2", "key0"]
+
+    for index, key in enumerate(["key1", "key2", "key0"]):
+        os.utime(cache._file(key), (index, index))
+    cache.max_size = 2 * os.path.getsize(cache._file("key0"))
+    cache.evict()
+    assert sorted(os.listdir(str(tmp_path / "results"))) == ["key0.npz", "key2.npz"]
+    cache.clear()
+    assert cache.get("key0") == (False, None) and os.listdir(str(tmp_path / "results")) == []
+
+
+def test_cached_prediction(models_directory, monkeypatch):
+    calls = []
+
+    def predict():
+        calls.append(True)
+        return np.ones((4, 4), dtype="float32") * len(calls)
+
+    inputs = [np.ones((4, 4), dtype="float32")]
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_RESULT_CACHE", "0")
+    cached_prediction("model/1/1", inputs, predict)
+    cached_prediction("model/1/1", inputs, predict)
+    assert len(calls) == 2
+
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_RESULT_CACHE", "1")
+    first = cached_prediction("model/1/1", inputs, predict)
+    second = cached_prediction("model/1/1", inputs, predict)
+    assert len(calls) == 3
+    np.testing.assert_array_equal(first, second)
+    assert os.path.isdir(os.path.join(_utils.get_cache_path(), "results"))
+
+    # results that cannot be cached are returned as they are
+    assert cached_prediction("model/1/1", [np.zeros(4)], lambda: object) is object
@@ -0,0 +1,167 @@
+"""Test the model manager search index against a plain scan of the models."""
+
+import copy
+import random
+
+from napari_bioimageio import _search
+from napari_bioimageio._catalog import parse_collection
+from napari_bioimageio._search import SearchIndex, split_filter
+
+
+def _filter(models, filter_id, filter_tag):
+    # the scan the index replaced, with the empty terms dropped
+    terms_id = split_filter(filter_id)
+    terms_tag = split_filter(filter_tag)
+    filtered = {}
+    for model in models:
+        if not terms_id and not terms_tag:
+            filtered[model["id"]] = model
+            continue
+        if any(
+            term in model["name"].lower()
+            or ("nickname" in model and term in model["nickname"].lower())
+            or term in str(model["id"]).lower()
+            for term in terms_id
+        ):
+            filtered[model["id"]] = model
+        elif any(term in ",".join(model["tags"]).lower() for term in terms_tag):
+            filtered[model["id"]] = model
+    return filtered
+
+
+def _models():
+    return [
+        {
+            "id": "10.5281/zenodo.6200999",
+            "name": "NucleiSegmentation",
+            "nickname": "conscientious-seashell",
+            "tags": ["nuclei", "unet", "hpa"],
+        },
+        {
+            "id": "10.5281/zenodo.6200635",
+            "name": "CellSegmentation",
+            "nickname": "loyal-parrot",
+            "tags": ["cells", "unet", "hpa"],
+        },
+        {
+            "id": "10.5281/zenodo.5910854",
+            "name": "HPA Classification",
+            "tags": ["classification", "hpa"],
+        },
+        {
+            "id": "10.5281/zenodo.5764892",
+            "name": "Platynereis EM membranes",
+            "nickname": "affable-shark",
+            "tags": ["3D", "EM"],
+        },
+    ]
+
+
+def _random_models(rng, count):
+    words = ["nuclei", "cell", "unet", "stardist", "hpa", "em", "3d", "membrane", "shark", "parrot", "Sea"]
+    models = []
+    for index in range(count):
+        model = {
+            "id": f"10.5281/zenodo.{rng.randrange(10**6, 10**7)}/{index}",
+            "name": " ".join(rng.sample(words, rng.randint(1, 3))),
+            "tags": rng.sample(words, rng.randint(0, 4)),
+        }
+        if rng.random() < 0.5:
+            model["nickname"] = "-".join(rng.sample(words, 2))
+        models.append(model)
+    return models
+
+
+def _random_filter(rng, models):
+    terms = []
+    for _ in range(rng.randint(0, 3)):
+        model = rng.choice(models)
+        text = rng.choice([model["name"], model["id"], model.get("nickname", ""), ",".join(model["tags"]), "xyz"])
+        start = rng.randint(0, len(text))
+        terms.append(text[start : start + rng.randint(0, 6)])
+    return ";".join(terms)
+
+
+def test_empty_filters_return_all_models():
+    models = _models()
+    index = SearchIndex()
+    index.sync(models)
+    assert list(index.search("", "")) == [model["id"] for model in models]
+    assert list(index.search(";", ";;")) == [model["id"] for model in models]
+
+
+def test_separated_terms():
+    index = SearchIndex()
+    index.sync(_models())
+    assert set(index.search("nuclei;cellseg")) == {"10.5281/zenodo.6200999", "10.5281/zenodo.6200635"}
+    # an empty term does not disable the other ones
+    assert set(index.search("nuclei;")) == {"10.5281/zenodo.6200999"}
+    assert set(index.search("5910854", "em")) == {"10.5281/zenodo.5910854", "10.5281/zenodo.5764892"}
+
+
+def test_nickname_matches():
+    index = SearchIndex()
+    index.sync(_models())
+    assert set(index.search("Parrot")) == {"10.5281/zenodo.6200635"}
+    assert set(index.search("shark")) == {"10.5281/zenodo.5764892"}
+
+
+def test_tag_matches():
+    index = SearchIndex()
+    index.sync(_models())
+    assert set(index.search(filter_tag="UNET")) == {"10.5281/zenodo.6200999", "10.5281/zenodo.6200635"}
+    # the tags are matched joined by commas
+    assert set(index.search(filter_tag="3d,em")) == {"10.5281/zenodo.5764892"}
+    assert index.search(filter_tag="parrot") == {}
+
+
+def test_reindex_after_refresh():
+    models = _models()
+    index = SearchIndex()
+    assert index.sync(models)
+    assert not index.sync(models)
+
+    # a refreshed catalog: one model removed, one replaced, one added
+    refreshed = [dict(models[0], tags=["nuclei", "stardist"])] + models[2:]
+    refreshed.append({"id": "10.5281/zenodo.7000000", "name": "Unet cells", "tags": ["unet"]})
+    assert index.sync(refreshed)
+    assert len(index) == len(refreshed)
+    assert set(index.search("loyal")) == set()
+    assert set(index.search(filter_tag="stardist")) == {"10.5281/zenodo.6200999"}
+    assert set(index.search(filter_tag="unet")) == {"10.5281/zenodo.7000000"}
+    assert list(index.search()) == [model["id"] for model in refreshed]
+
+
+def test_refetched_catalog_is_not_reindexed(monkeypatch):
+    collection = {"collection": [dict(model, type="model") for model in _models()]}
+    index = SearchIndex()
+    assert index.sync(parse_collection(collection))
+    postings = copy.deepcopy((index._ids.postings, index._tags.postings))
+
+    # the same catalog fetched again: new entries with the same content
+    added = []
+    add = _search._Field.add
+    monkeypatch.setattr(_search._Field, "add", lambda self, key, text: added.append(key) or add(self, key, text))
+    refetched = parse_collection(copy.deepcopy(collection))
+    assert not index.sync(refetched)
+    assert added == []
+    assert (index._ids.postings, index._tags.postings) == postings
+    # the index hands out the refetched entries
+    assert all(model is entry for model, entry in zip(index.search("").values(), refetched))
+
+    collection["collection"][0]["tags"] = ["nuclei"]
+    assert index.sync(parse_collection(collection))
+    # only the modified model is added again, to both fields
+    assert added == ["10.5281/zenodo.6200999"] * 2
+
+
+def test_same_results_as_scan():
+    rng = random.Random(0)
+    index = SearchIndex()
+    for _ in range(10):
+        models = _random_models(rng, rng.randint(0, 60))
+        index.sync(models)
+        for _ in range(300):
+            filter_id = _random_filter(rng, models) if models else ""
+            filter_tag = _random_filter(rng, models) if models else ""
+            assert list(index.search(filter_id, filter_tag)) == list(_filter(models, filter_id, filter_tag))
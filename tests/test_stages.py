@@ -0,0 +1,138 @@
+"""Test the graph of processing stages and the memoization of their results."""
+
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from napari_bioimageio._stages import StageCache, StageGraph
+from napari_bioimageio._tiling import PredictionCancelled
+
+
+def _stage(name, calls, barrier=None):
+    def function(*inputs, progress, cancel):
+        calls.append(name)
+        progress(0, 1)
+        if barrier is not None:
+            # returns only once the other stages waiting on the barrier run too
+            barrier.wait()
+        progress(1, 1)
+        return [name, *inputs]
+
+    return function
+
+
+def test_independent_stages_run_concurrently():
+    calls = []
+    reports = []
+    graph = StageGraph().add_input("image", "image")
+    barrier = threading.Barrier(2, timeout=5)
+    graph.add("nuclei", _stage("nuclei", calls, barrier), ["image"], label="Nuclei")
+    graph.add("cells", _stage("cells", calls, barrier), ["image"], label="Cells")
+    graph.add("merged", _stage("merged", calls), ["nuclei", "cells"])
+
+    results = graph.run(progress=lambda *report: reports.append(report))
+    assert sorted(calls[:2]) == ["cells", "nuclei"] and calls[2] == "merged"
+    assert results["merged"] == ["merged", ["nuclei", "image"], ["cells", "image"]]
+    assert set(reports) == {("Nuclei", 0, 1), ("Nuclei", 1, 1), ("Cells", 0, 1), ("Cells", 1, 1)} | {
+        ("merged", 0, 1),
+        ("merged", 1, 1),
+    }
+
+    # only the stages the outputs depend on are run
+    calls.clear()
+    graph.stages["nuclei"] = graph.stages["nuclei"]._replace(function=_stage("nuclei", calls))
+    assert list(graph.run(outputs=["nuclei"])) == ["nuclei"] and calls == ["nuclei"]
+
+
+def test_stages_are_added_after_their_dependencies():
+    graph = StageGraph().add_input("image", 1)
+    with pytest.raises(ValueError):
+        graph.add("cells", _stage("cells", []), ["nuclei"])
+    with pytest.raises(ValueError):
+        graph.add("image", _stage("image", []))
+    with pytest.raises(ValueError):
+        graph.run(outputs=["unknown"])
+
+
+def test_first_error_stops_the_run():
+    cancelled = []
+
+    def failing(progress, cancel):
+        time.sleep(0.05)
+        raise RuntimeError("broken model")
+
+    def slow(progress, cancel):
+        # a long stage stops when another stage failed
+        if cancel.wait(5):
+            cancelled.append(True)
+            raise PredictionCancelled()
+
+    after = []
+    graph = StageGraph().add("failing", failing).add("slow", slow)
+    graph.add("after", lambda failing, progress, cancel: after.append(True), ["failing"])
+    start = time.monotonic()
+    with pytest.raises(RuntimeError, match="broken model"):
+        graph.run()
+    assert time.monotonic() - start < 2
+    assert cancelled == [True] and after == []
+
+
+def test_cancel():
+    cancel = threading.Event()
+    started = threading.Event()
+
+    def slow(progress, cancel):
+        started.set()
+        cancel.wait(5)
+        raise PredictionCancelled()
+
+    graph = StageGraph().add("slow", slow)
+    threading.Thread(target=lambda: started.wait(5) and cancel.set()).start()
+    start = time.monotonic()
+    with pytest.raises(PredictionCancelled):
+        graph.run(cancel=cancel)
+    assert time.monotonic() - start < 2
+
+
+def test_unchanged_stages_are_not_run_again():
+    cache = StageCache()
+    calls = []
+
+    def graph(image, threshold):
+        graph = StageGraph(cache).add_input("image", image)
+        graph.add("prediction", _stage("prediction", calls), ["image"], key="model")
+        graph.add("labels", _stage("labels", calls), ["prediction"], key=threshold)
+        return graph
+
+    image = np.zeros((8, 8), dtype="float32")
+    first = graph(image, 0.5).run()
+    assert calls == ["prediction", "labels"]
+    calls.clear()
+    assert graph(image.copy(), 0.5).run() == first and calls == []
+    # another threshold only runs the stage it affects
+    graph(image, 0.6).run()
+    assert calls == ["labels"]
+    # another image runs both again
+    calls.clear()
+    graph(image + 1, 0.6).run()
+    assert calls == ["prediction", "labels"]
+    # a cached output does not need the stages it depends on
+    calls.clear()
+    assert graph(image, 0.5).run(outputs=["labels"]) == {"labels": first["labels"]} and calls == []
+
+
+def test_stage_cache_memory_limit():
+    cache = StageCache(max_memory=2500)
+    for index in range(3):
+        cache.put(f"key{index}", [np.zeros(1000, dtype="uint8"), "small"])
+    assert cache.get("key0") == (False, None)
+    assert cache.get("key2")[0] and cache.get("key1")[0]
+    cache.put("key3", np.zeros(1000, dtype="uint8"))
+    # key1 was used more recently than key2
+    assert cache.get("key1")[0] and not cache.get("key2")[0]
+    cache.put("large", np.zeros(3000, dtype="uint8"))
+    assert cache.get("large") == (False, None)
+    cache.clear()
+    assert cache.get("key1") == (False, None)
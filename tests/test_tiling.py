@@ -0,0 +1,72 @@
+"""Test the tiling plan, its blend weights and the tiled prediction."""
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from napari_bioimageio._tiling import _axis_weights, plan_tiling, predict_tiled
+
+
+def _specs(halo=8, scale=1.0):
+    input_spec = SimpleNamespace(axes="bcyx", shape=SimpleNamespace(min=[1, 1, 32, 32], step=[1, 0, 16, 16]))
+    output_spec = SimpleNamespace(
+        axes="bcyx", shape=SimpleNamespace(scale=[1, 1, scale, scale], offset=[0, 0, 0, 0]), halo=[0, 0, halo, halo]
+    )
+    return input_spec, output_spec
+
+
+class IdentityPipeline:
+    """Pipeline returning its input, whose output must then be the image whatever the tiling."""
+
+    def __init__(self, halo=8):
+        input_spec, output_spec = _specs(halo)
+        self.input_specs, self.output_specs = [input_spec], [output_spec]
+        self.calls = 0
+
+    def __call__(self, tensor):
+        self.calls += 1
+        return [tensor.astype("float32")]
+
+
+@pytest.mark.parametrize("size", [20, 100, 257, 1000])
+@pytest.mark.parametrize("tile_size", [32, 64, 100])
+@pytest.mark.parametrize("halo", [0, 4, 8])
+@pytest.mark.parametrize("scale", [1.0, 2.0])
+def test_blend_weights_sum_to_one(size, tile_size, halo, scale):
+    input_spec, output_spec = _specs(halo, scale)
+    for axis in plan_tiling(input_spec, output_spec, (1, 1, size, size), tile_size=tile_size):
+        total = np.zeros(round(axis.size * axis.scale), dtype="float32")
+        for start, weight in zip(axis.starts, _axis_weights(axis)):
+            start = round(start * axis.scale)
+            assert np.all(weight >= 0)
+            total[start : start + len(weight)] += weight
+        np.testing.assert_allclose(total, 1, atol=1e-5)
+
+
+@pytest.mark.parametrize("shape", [(1, 2, 100, 70), (1, 2, 257, 129), (1, 2, 20, 300)])
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_identity_reproduces_input(shape, batch_size):
+    image = np.random.default_rng(0).random(shape, dtype="float32")
+    pipeline = IdentityPipeline()
+    prediction = predict_tiled(pipeline, image, tile_size=64, batch_size=batch_size)
+    assert prediction.shape == image.shape
+    np.testing.assert_allclose(prediction, image, atol=1e-5)
+    # the image was predicted in several tiles
+    assert pipeline.calls > 1
+
+
+def test_progress_and_output_file(tmp_path):
+    image = np.random.default_rng(1).random((1, 1, 150, 90), dtype="float32")
+    reports = []
+    prediction = predict_tiled(
+        IdentityPipeline(),
+        image,
+        tile_size=48,
+        batch_size=1,
+        out=str(tmp_path / "prediction.npy"),
+        progress=lambda done, total: reports.append((done, total)),
+    )
+    np.testing.assert_allclose(np.load(tmp_path / "prediction.npy"), image, atol=1e-5)
+    np.testing.assert_allclose(prediction, image, atol=1e-5)
+    assert reports[-1][0] == reports[-1][1] == len(reports)
@@ -0,0 +1,94 @@
+"""Test the per machine tuning of the tiled predictions."""
+
+import contextlib
+import os
+import shutil
+import sys
+import types
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from napari_bioimageio import _pipelines, _tuning, _utils
+from napari_bioimageio._tuning import get_tuning, tune_model
+
+
+class FakeTorch(types.ModuleType):
+    def __init__(self):
+        super().__init__("torch")
+        self.threads = []
+
+    def set_num_threads(self, threads):
+        self.threads.append(threads)
+
+
+@pytest.fixture
+def model(tmp_path, monkeypatch):
+    # an installed model whose pipeline imports its deep learning library when it is loaded
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_MODELS_PATH", str(tmp_path / "models"))
+    folder = tmp_path / "models" / "model" / "1"
+    folder.mkdir(parents=True)
+    (folder / "rdf.yaml").write_text("name: model\n")
+    np.save(str(folder / "test_input.npy"), np.random.default_rng(0).random((1, 1, 40, 40), dtype="float32"))
+    input_spec = SimpleNamespace(axes="bcyx", shape=SimpleNamespace(min=[1, 1, 16, 16], step=[1, 0, 16, 16]))
+    output_spec = SimpleNamespace(axes="bcyx", halo=[0, 0, 4, 4])
+    description = SimpleNamespace(
+        inputs=[input_spec], outputs=[output_spec], test_inputs=[str(folder / "test_input.npy")]
+    )
+    monkeypatch.setattr(_utils, "load_model", lambda model_id: description)
+    monkeypatch.delitem(sys.modules, "torch", raising=False)
+    monkeypatch.delitem(sys.modules, "tensorflow", raising=False)
+    torch = FakeTorch()
+
+    @contextlib.contextmanager
+    def use_pipeline(model_id, weight_format=None, devices=None):
+        sys.modules["torch"] = torch
+        yield lambda tensor: [tensor]
+
+    monkeypatch.setattr(_pipelines, "use_pipeline", use_pipeline)
+    yield SimpleNamespace(model_id="model/1/1", folder=str(folder), torch=torch)
+    sys.modules.pop("torch", None)
+
+
+def test_tuning_is_saved_for_this_machine(model):
+    result = tune_model(model.model_id, tile_sizes=(16, 30), batch_sizes=(1, 2), threads=[1, 2], repeats=1)
+    # tile sizes rounded up to the model's steps, the backend imported by the pipeline is tuned too
+    assert sorted({tuple(m["tile"].values()) for m in result["measurements"]}) == [(16, 16), (32, 32)]
+    assert {m["batch_size"] for m in result["measurements"]} == {1, 2}
+    assert {m["threads"] for m in result["measurements"]} == {1, 2}
+    assert model.torch.threads[-1] == result["threads"]
+
+    tuning = get_tuning(model.model_id)
+    assert tuning == {key: value for key, value in result.items() if key != "measurements"}
+    assert not os.path.exists(os.path.join(model.folder, "tuning.json"))
+    assert os.path.isfile(os.path.join(_utils.get_cache_path(), "tuning", "model", "1.json"))
+
+
+def test_tuning_survives_a_reinstall(model):
+    tuning = tune_model(model.model_id, tile_sizes=(16,), repeats=1)
+    tuning.pop("measurements")
+
+    # the same model swapped in again
+    staging = model.folder + ".staging"
+    shutil.copytree(model.folder, staging)
+    shutil.rmtree(model.folder)
+    os.rename(staging, model.folder)
+    assert get_tuning(model.model_id) == tuning
+
+    # another rdf.yaml under the same version invalidates it
+    with open(os.path.join(model.folder, "rdf.yaml"), "a", encoding="utf-8") as f:
+        f.write("description: retrained\n")
+    stat = os.stat(os.path.join(model.folder, "rdf.yaml"))
+    os.utime(os.path.join(model.folder, "rdf.yaml"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert get_tuning(model.model_id) is None
+
+
+def test_other_machines_are_kept(model, monkeypatch):
+    tune_model(model.model_id, tile_sizes=(16,), repeats=1)
+    with monkeypatch.context() as patch:
+        patch.setattr(_tuning, "host_name", lambda: "other-machine")
+        assert get_tuning(model.model_id) is None
+        tune_model(model.model_id, tile_sizes=(32,), repeats=1)
+        assert get_tuning(model.model_id)["tile"] == {"y": 32, "x": 32}
+    assert get_tuning(model.model_id)["tile"] == {"y": 16, "x": 16}
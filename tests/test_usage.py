@@ -0,0 +1,98 @@
+"""Test the disk usage accounting and the least recently used eviction of the models."""
+
+import os
+import time
+
+import pytest
+import yaml
+
+from napari_bioimageio import _registry, _usage, _utils
+from napari_bioimageio._locks import lock_file, locked
+
+
+@pytest.mark.parametrize(
+    "size, expected",
+    [(None, None), ("", None), ("none", None), (1000, 1000), ("1000", 1000), ("2K", 2048), ("1.5G", 3 << 29)],
+)
+def test_parse_size(size, expected):
+    assert _usage.parse_size(size) == expected
+
+
+def test_eviction_order():
+    last_used = {"a/1": 3.0, "a/2": 1.0, "b/1": 2.0}
+    assert _usage.eviction_order(["a/1", "a/2", "b/1", "c/1"], last_used) == ["c/1", "a/2", "b/1", "a/1"]
+    assert _usage.eviction_order(["a/1", "a/2", "b/1"], last_used, pinned=["a"]) == ["b/1"]
+    assert _usage.eviction_order(["a/1", "a/2", "b/1"], last_used, pinned=["a/2/", "ab"]) == ["b/1", "a/1"]
+
+
+@pytest.fixture
+def models_directory(tmp_path, monkeypatch):
+    def parse_rdf(rdf_file):
+        with open(rdf_file, "r", encoding="utf-8") as f:
+            return yaml.safe_load(f)
+
+    monkeypatch.setattr(_registry, "parse_rdf", parse_rdf)
+    models_directory = str(tmp_path / "models")
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_MODELS_PATH", models_directory)
+    monkeypatch.delenv("BIOIMAGEIO_NAPARI_MODELS_QUOTA", raising=False)
+    monkeypatch.delenv("BIOIMAGEIO_NAPARI_PINNED_MODELS", raising=False)
+    return models_directory
+
+
+def _install(models_directory, model_id, size, installed_at):
+    folder = os.path.join(models_directory, model_id)
+    os.makedirs(folder)
+    with open(os.path.join(folder, "weights.pt"), "wb") as f:
+        f.write(b"w" * size)
+    rdf_file = os.path.join(folder, "rdf.yaml")
+    with open(rdf_file, "w", encoding="utf-8") as f:
+        yaml.safe_dump({"id": model_id, "name": model_id}, f)
+    os.utime(rdf_file, (installed_at, installed_at))
+    return folder
+
+
+def test_shared_files_are_counted_once(models_directory):
+    first = _install(models_directory, "model/1", 1000, time.time())
+    second = _install(models_directory, "model/2", 500, time.time())
+    _utils.get_blob_store().add(os.path.join(first, "weights.pt"))
+    assert _usage.folder_usage(first) == (1000 + os.path.getsize(os.path.join(first, "rdf.yaml")),) * 2
+
+    # the new version shares the weights of the old one
+    os.remove(os.path.join(second, "weights.pt"))
+    os.link(os.path.join(first, "weights.pt"), os.path.join(second, "weights.pt"))
+    rdf_size = os.path.getsize(os.path.join(first, "rdf.yaml"))
+    assert _usage.folder_usage(first) == (1000 + rdf_size, rdf_size)
+    assert _usage.directory_size(models_directory, include_hidden=False) == 1000 + 2 * rdf_size
+
+
+def test_least_recently_used_models_are_evicted(models_directory, monkeypatch):
+    now = time.time()
+    _install(models_directory, "old/1", 1000, now - 400)
+    _install(models_directory, "used/1", 1000, now - 300)
+    _install(models_directory, "pinned/1", 1000, now - 200)
+    _install(models_directory, "busy/1", 1000, now - 100)
+    _install(models_directory, "new/1", 1000, now)
+    # loaded since its install, so more recently used than the new model
+    _utils.get_usage_log().touch("used/1")
+    # the caches do not count against the quota
+    os.makedirs(_utils.get_cache_path(), exist_ok=True)
+    with open(os.path.join(_utils.get_cache_path(), "results.bin"), "wb") as f:
+        f.write(b"c" * 10000)
+
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_PINNED_MODELS", "pinned")
+    assert _utils.evict_models() == []
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_MODELS_QUOTA", "10K")
+    assert _utils.evict_models() == []
+
+    monkeypatch.setenv("BIOIMAGEIO_NAPARI_MODELS_QUOTA", "2500")
+    with locked(lock_file(models_directory, "busy/1", "use"), shared=True):
+        assert _utils.evict_models(keep=["new/1"]) == ["old/1", "used/1"]
+    assert sorted(model["id"] for model in _utils.get_disk_usage()["models"]) == ["busy/1", "new/1", "pinned/1"]
+    assert _utils.get_usage_log().last_used() == {}
+
+    # nothing else may be evicted, the quota stays exceeded
+    with locked(lock_file(models_directory, "busy/1", "use"), shared=True):
+        assert _utils.evict_models(keep=["new/1"]) == []
+    assert _utils.evict_models() == ["busy/1"]
+    usage = _utils.get_disk_usage()
+    assert usage["total"] <= 2500 < usage["total"] + usage["cache"]